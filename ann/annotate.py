@@ -10,7 +10,20 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import copy
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+import batch as vb
+import bloom
+import db_pool
 import file_utils as fu
+import intervals as iv
+import lookup_engine as le
+import planner as pl
+import query_cache as qc
+import reference as rf
+import snapshot
 import utils as u
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
@@ -46,38 +59,50 @@ def collapseGeneNames(row, indices, region, cnt):
     return ";".join(collapsed)
 
 
+"""Names of the columns of the bigRefSeq tables, after their id column
+"""
+REF_SEQ_NAMES = [
+    "chr",
+    "start",
+    "end",
+    "haplotypeReference",
+    "haplotypeAlternate",
+    "name",
+    "name2",
+    "transcriptStrand",
+    "positionType",
+    "frame",
+    "mrnaCoord",
+    "codonCoord",
+    "spliceDist",
+    "referenceCodon",
+    "referenceAA",
+    "variantCodon",
+    "variantAA",
+    "changesAA",
+    "functionalClass",
+    "codingCoordStr",
+    "proteinCoordStr",
+    "inCodingRegion",
+    "spliceInfo",
+    "uorfChange",
+]
+
+
 """"Collapces bigRefSegTable
 """
 
 
 def collapseRefSeq(line):
-    names = [
-        "chr",
-        "start",
-        "end",
-        "haplotypeReference",
-        "haplotypeAlternate",
-        "name",
-        "name2",
-        "transcriptStrand",
-        "positionType",
-        "frame",
-        "mrnaCoord",
-        "codonCoord",
-        "spliceDist",
-        "referenceCodon",
-        "referenceAA",
-        "variantCodon",
-        "variantAA",
-        "changesAA",
-        "functionalClass",
-        "codingCoordStr",
-        "proteinCoordStr",
-        "inCodingRegion",
-        "spliceInfo",
-        "uorfChange",
-    ]
-    fields = line.strip().split("\t")
+    return collapseRefSeqFields(line.strip().split("\t"))
+
+
+"""Collapses the fields of a bigRefSeq row, without its id column
+"""
+
+
+def collapseRefSeqFields(fields):
+    names = REF_SEQ_NAMES
     fcount = 0
     collapsed = []
 
@@ -90,14 +115,14 @@ def collapseRefSeq(line):
     return ";".join(collapsed)
 
 
-def binarySearchUniqueAndSorted(arg0, key):
-    low = 0
-    high = len(arg0) - 1
+def binarySearchUniqueAndSorted(arg0, key, low=0, high=None):
+    if high is None:
+        high = len(arg0) - 1
     mid = 0
     obj = 0
 
     while low <= high:
-        mid = (low + high) / 2
+        mid = (low + high) // 2
         obj = arg0[mid]
 
         if obj < key:
@@ -110,6 +135,28 @@ def binarySearchUniqueAndSorted(arg0, key):
     return -1  # NOT_FOUND
 
 
+"""Galloping search for key in arg0 starting at index start
+
+For keys that come in increasing order: probes start + 1, 3, 7, ... until
+it passes key, then binary searches the last step, so a key d entries
+past the previous one costs O(log d) probes. Keys before start are
+searched in arg0[:start].
+"""
+
+
+def gallopSearchUniqueAndSorted(arg0, key, start=0):
+    n = len(arg0)
+    if start >= n or arg0[start] > key:
+        return binarySearchUniqueAndSorted(arg0, key, 0, min(start, n) - 1)
+
+    bound = 1
+    while start + bound < n and arg0[start + bound] < key:
+        bound = bound * 2
+    return binarySearchUniqueAndSorted(
+        arg0, key, start + bound // 2, min(start + bound, n - 1)
+    )
+
+
 """Cleans characters not accepted by MySQL
 """
 
@@ -147,249 +194,1189 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""Base class for a single annotation stage
+
+Each stage annotates one parsed record (the list of fields of a VCF line)
+at a time, keeps its own counters, and writes them to the .count.log file
+once the whole file has been processed. Stages are driven either one file
+pass at a time (runStage) or all together in a single pass (runPipeline).
+
+Records are handed to a stage in batches: prefetch() sees the whole batch
+(a batch.VariantBatch, which iterates like the list of records) before
+annotate() is called on each record of it. Stages that support them
+take these options instead of sending one query per record:
+    indexed=True  - answer lookups from reference data held in memory
+    batched=True  - fetch rows for the whole batch with one query
+    sweep=windows - for coordinate-sorted input (see scanSortedWindows),
+                    read each chromosome's rows once and merge-walk them
 """
 
 
-def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
-):
+class Stage(object):
+    # Lines starting with any of these prefixes are copied through unchanged
+    headers = ("##", "#CHROM", "CHROM")
+    # Mode used to open the .count.log file
+    logmode = "a"
+    # Counters written by writeLog(); each is a sum over records
+    counters = ()
+    # Whether each table the stage reads holds the rows of one chromosome,
+    # and whether indexed=True maps a table's snapshot if it has one rather
+    # than loading it; used by the planner (see planner.py)
+    chromTables = False
+    snapshotIndexes = True
+
+    def __init__(
+        self,
+        cursor,
+        format="vcf",
+        sep="\t",
+        indexed=False,
+        batched=False,
+        sweep=None,
+        window=1,
+    ):
+        self.cursor = cursor
+        # Lookups on the reference database over cursor, see reference.py
+        self.reference = rf.reader(cursor)
+        self.inds = getFormatSpecificIndices(format=format)
+        self.sep = sep
+        self.indexed = indexed
+        self.batched = batched
+        self.sweep = sweep
+        # Lookup results of this job, see memoized()
+        self.memo = {}
+        # Lookups kept in flight at once by the stage's LookupEngine
+        self.window = window
+        self.engine = None
+        # Point lookups checked against a Bloom filter, and those it ruled
+        # out; see mayHaveRow()
+        self.filter_checks = 0
+        self.filter_skips = 0
+
+    def isHeader(self, line):
+        return line.startswith(self.headers)
+
+    def prefetch(self, records):
+        pass
+
+    def annotate(self, fields):
+        raise NotImplementedError
+
+    # fetch(*args), remembered under key for the rest of the job so lines
+    # at the same position (merged and multi-sample inputs) share a lookup.
+    # With shared=True the result also goes through the host's query cache
+    # (see usesQueryCache), so later jobs share it as well; fetches with
+    # side effects on the stage must pass shared=False.
+    def memoized(self, key, fetch, *args, shared=True):
+        if key not in self.memo:
+            if len(self.memo) >= MEMO_SIZE:
+                self.memo = {}
+            self.memo[key] = self.fetchShared(key, fetch, args, shared)
+        return self.memo[key]
+
+    # fetch(*args), through the host's query cache if shared
+    def fetchShared(self, key, fetch, args, shared=True):
+        if not (shared and self.usesQueryCache()):
+            return fetch(*args)
+        value = qc.cache.get(self.cacheName(), key)
+        if value is qc.MISSING:
+            value = fetch(*args)
+            qc.cache.put(self.cacheName(), key, value)
+        return value
+
+    # Whether the stage sends a query per variant rather than answering
+    # lookups from memory
+    def queriesPerVariant(self):
+        return not self.indexed and self.sweep is None
+
+    # The query cache stands in for per-variant database queries, so it is
+    # not used when lookups are answered from memory
+    def usesQueryCache(self):
+        return qc.cache is not None and self.queriesPerVariant()
+
+    # The memoized lookups annotate() is going to make for fields, as
+    # (key, name of the fetch method, args) triples, so that a LookupEngine
+    # can make those of a whole batch ahead of it; only stages that query
+    # per variant list them
+    def lookups(self, fields):
+        return []
+
+    # Makes the lookups of the batch ahead of annotate(), up to window of
+    # them at a time (see lookup_engine.py)
+    def prefetchLookups(self, records):
+        if self.window <= 1 or not self.queriesPerVariant():
+            return
+        if self.engine is None:
+            self.engine = le.LookupEngine(self, self.window)
+        self.engine.prefetch(records)
+
+    # A copy of the stage for a lane of its LookupEngine: lookups on it go
+    # over cursor and fill state of its own, so copies on other lanes and
+    # the stage itself are left alone
+    def lookupCopy(self, cursor):
+        slot = copy.copy(self)
+        slot.cursor = cursor
+        slot.reference = rf.reader(cursor)
+        slot.memo = {}
+        slot.engine = None
+        slot.filter_checks = 0
+        slot.filter_skips = 0
+        return slot
+
+    # Empties the memo if count more results would not fit in it
+    def makeRoom(self, count):
+        if len(self.memo) + count > MEMO_SIZE:
+            self.memo = {}
+
+    # False if the Bloom filter of table (see bloom.py) rules out a row at
+    # (chr, pos), so the query for it can be skipped
+    def mayHaveRow(self, table, chr, pos):
+        if table not in bloom.filters:
+            return True
+        self.filter_checks = self.filter_checks + 1
+        if bloom.filters[table].mayContain(chr, pos):
+            return True
+        self.filter_skips = self.filter_skips + 1
+        return False
+
+    # Writes how many point lookups the Bloom filters ruled out, if any
+    # were checked
+    def writeFilterLog(self, fh_log, name):
+        if self.filter_checks > 0:
+            fh_log.write(
+                f"Skipped by Bloom filter: {str(self.filter_skips)} of "
+                + f"{str(self.filter_checks)} {name} lookups\n"
+            )
 
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + ".count.log"
-    fh_log = open(logcountfile, "w")
-    var_count = 0
+    # Releases what the stage holds once the input is done
+    def close(self):
+        if self.engine is not None:
+            self.engine.close()
+            self.engine = None
 
-    inds = getFormatSpecificIndices(format=format)
+    # Name the stage's lookups are kept under in the query cache; it must
+    # change with any option that changes their results
+    def cacheName(self):
+        return getattr(self, "table", None) or type(self).__name__
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    # Lookup strategies the planner may pick for the stage besides point
+    # queries (see planner.py)
+    @classmethod
+    def plannerStrategies(cls):
+        return ()
+
+    # Reference tables read by the lookups of a variant on chrom, for a
+    # stage created with kwargs
+    @classmethod
+    def plannerTables(cls, kwargs, chrom):
+        return []
+
+    def writeLog(self, fh_log):
+        pass
+
+    def counterValues(self):
+        return dict((name, getattr(self, name)) for name in self.counters)
+
+    # Adds the counters of a stage that annotated another part of the input;
+    # counters saved before a counter was added count as 0
+    def addCounters(self, values):
+        for name in self.counters:
+            setattr(self, name, getattr(self, name) + values.get(name, 0))
+
+
+"""Rows of index overlapping each position of batch (a VariantBatch),
+keyed on (chrom, pos) with chrom as named by chromName
+
+Each chromosome's positions are looked up with one overlappingMany() call.
+"""
+
+
+def prefetchRegionRows(index, chromName, batch, margin=0):
+    rows = {}
+    for chrom, positions in batch.positionsByChrom(chromName).items():
+        found = index.overlappingMany(chrom, positions, margin)
+        for pos, pos_rows in zip(positions, found):
+            rows[(chrom, pos)] = pos_rows
+    return rows
+
+
+"""Number of lookup results a stage remembers within a job
+"""
+MEMO_SIZE = 10000
 
+
+"""Number of records read and annotated together
+"""
+BATCH_SIZE = 1000
+
+
+"""Columns read from the cpgIslandExt and tfbsConsSites tables
+"""
+SITE_COLUMNS = "chrom, chromStart, chromEnd, name"
+
+
+"""Yields lists of up to batchSize stripped lines from fh
+"""
+
+
+def readBatches(fh, batchSize=BATCH_SIZE):
+    lines = []
     for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
+        lines.append(line.strip())
+        if len(lines) >= batchSize:
+            yield lines
+            lines = []
+    if len(lines) > 0:
+        yield lines
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = (
-                'select * from dbSNP where CHR="'
-                + str(chr)
-                + '" AND POS='
-                + str(pos)
-                + ' AND ( REF="'
-                + str(ref)
-                + '" OR REF ="'
-                + str(compRef)
-                + '" )  AND INFO = "'
-                + varclass
-                + '" ;'
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+"""Annotates a batch of lines with each stage in turn, returns output lines
 
-            fields[2] = "."
-            rsids = []
-            mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
+A stage sees every record of the batch before the next stage starts, which
+gives the same result as running the stages one file pass at a time.
+waves, if given, groups the indices of stages into runs of consecutive
+stages; the stages of a wave with more than one stage are run at the same
+time by executor, threads at a time (see annotateWave).
+"""
 
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
 
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
+def annotateLines(stages, lines, waves=None, executor=None, threads=1):
+    records = [None] * len(lines)
+    # Columns of the last stage's records, reused while the records are
+    # the same lines read with the same format
+    columns = None
+
+    if waves is None or executor is None:
+        waves = [[k] for k in range(len(stages))]
+
+    for wave in waves:
+        if len(wave) > 1:
+            annotateWave([stages[k] for k in wave], lines, records, executor, threads)
+            columns = None
+            continue
+
+        stage = stages[wave[0]]
+        batch = []
+        for i in range(len(lines)):
+            if stage.isHeader(lines[i]):
+                continue
+            if records[i] is None:
+                records[i] = lines[i].split(stage.sep)
+            else:
+                # Each file pass strips the line it reads back in
+                records[i][-1] = records[i][-1].rstrip()
+            batch.append(i)
+
+        if columns is None or columns[0] != (batch, stage.inds):
+            variants = vb.VariantBatch([records[i] for i in batch], stage.inds)
+            columns = ((batch, stage.inds), variants)
+        else:
+            variants = columns[1]
+            variants.records = [records[i] for i in batch]
+
+        stage.prefetch(variants)
+        stage.prefetchLookups(variants)
+        for i in batch:
+            records[i] = stage.annotate(records[i])
+
+    out = []
+    for i in range(len(lines)):
+        if records[i] is None:
+            out.append(lines[i])
+        else:
+            out.append("\t".join(records[i]))
+    return out
+
+
+"""Column the stages write their annotations to
+"""
+INFO_IND = 7
+
+
+"""Annotates records with the stages of a wave at the same time
+
+The stages must not read what the others write and may only change a
+record as mergeAnnotation() can redo. Each stage annotates its own copy of
+the records; stage j of the wave runs in task j % threads of executor,
+after the stages before it in that task, so stages that share a
+connection (see driver.waveConnections) never run at the same time. The
+changes are then applied to the records in stage order, as if the stages
+had run one after another. Where that is not possible, the stage
+annotates the record again with the real one -- from its memoized
+lookups, and without counting the record twice.
+"""
 
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
 
+def annotateWave(wave, lines, records, executor, threads):
+    batches = []
+    for stage in wave:
+        batch = []
+        for i in range(len(lines)):
+            if stage.isHeader(lines[i]):
+                continue
+            if records[i] is None:
+                records[i] = lines[i].split(stage.sep)
+            batch.append(i)
+        batches.append(batch)
+
+    bases = {}
+    for batch in batches:
+        for i in batch:
+            records[i][-1] = records[i][-1].rstrip()
+            bases[i] = list(records[i])
+
+    def annotateCopies(stage, batch):
+        copies = [list(bases[i]) for i in batch]
+        variants = vb.VariantBatch(copies, stage.inds)
+        stage.prefetch(variants)
+        stage.prefetchLookups(variants)
+        return [stage.annotate(copy) for copy in copies]
+
+    def annotateTask(task):
+        return [annotateCopies(wave[j], batches[j]) for j in task]
+
+    tasks = [range(t, len(wave), threads) for t in range(min(threads, len(wave)))]
+    futures = [executor.submit(annotateTask, task) for task in tasks]
+    results = [None] * len(wave)
+    for task, future in zip(tasks, futures):
+        for j, annotated in zip(task, future.result()):
+            results[j] = annotated
+
+    for stage, batch, annotated in zip(wave, batches, results):
+        for i, fields in zip(batch, annotated):
+            # Each file pass strips the line it reads back in
+            records[i][-1] = records[i][-1].rstrip()
+            merged = mergeAnnotation(bases[i], fields, records[i])
+            if merged is None:
+                records[i] = annotateAgain(stage, records[i])
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+                records[i] = merged
+
+
+"""What current becomes if annotated the way record was, or None if that
+cannot be told from record and annotated
+
+A stage may put the same text in front of every column -- GadAll prefixes
+them with a space -- and may add text at the end of INFO. Most stages
+start that text with ";" unless INFO already ends with one; some always
+do. So text added without a ";" to an INFO that ended with one gets one
+where current does not end with one, and text added to an INFO that did
+not end with ";" can only be redone where current does not either. Other
+changes cannot be redone.
+"""
 
-            linenum = linenum + 1
 
+def mergeAnnotation(record, annotated, current):
+    if len(annotated) != len(record) or len(current) != len(record):
+        return None
+
+    merged = []
+    for j in range(len(record)):
+        before = record[j]
+        after = annotated[j]
+        lead = (len(after) - len(after.lstrip(" "))) - (
+            len(before) - len(before.lstrip(" "))
+        )
+        if lead < 0 or not after[lead:].startswith(before):
+            return None
+        prefix = after[:lead]
+        added = after[lead + len(before) :]
+
+        if len(added) == 0:
+            merged.append(prefix + current[j])
+        elif j != INFO_IND:
+            return None
+        elif current[j].endswith(";") == before.endswith(";"):
+            merged.append(prefix + current[j] + added)
+        elif before.endswith(";") and not added.startswith(";"):
+            merged.append(prefix + current[j] + ";" + added)
+        elif before.endswith(";"):
+            merged.append(prefix + current[j] + added)
         else:
-            fh_out.write(line + "\n")
+            return None
+    return merged
+
+
+"""Annotates fields with stage again, leaving its counters as they were
+"""
+
+
+def annotateAgain(stage, fields):
+    before = stage.counterValues()
+    fields = stage.annotate(fields)
+    stage.addCounters(subtractCounters(before, stage.counterValues()))
+    return fields
+
+
+"""values - other, for counters as returned by Stage.counterValues()
+"""
+
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+def subtractCounters(values, other):
+    if isinstance(values, list):
+        return [subtractCounters(v, o) for v, o in zip(values, other)]
+    return dict((name, values[name] - other[name]) for name in values)
+
+
+"""Runs a single stage over basefile + tmpextin and writes basefile + tmpextout
+"""
+
+
+def runStage(stage, vcf, tmpextin="", tmpextout=".1", batchSize=BATCH_SIZE):
+    fh = open(vcf + tmpextin)
+    fh_out = open(vcf + tmpextout, "w")
+
+    try:
+        for lines in readBatches(fh, batchSize):
+            for line in annotateLines([stage], lines):
+                fh_out.write(line + "\n")
+    finally:
+        stage.close()
+
+    fh_log = open(vcf + ".count.log", stage.logmode)
+    stage.writeLog(fh_log)
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+"""Runs all stages over the input in a single pass
+
+Each record is parsed once and handed from stage to stage in memory, so
+there are no intermediate files. Output and .count.log are the same as
+running the stages one after another with runStage. With waves and
+threads > 1, the stages of each wave run at the same time in a pool of
+that many threads (see annotateLines).
 """
 
 
-def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def runPipeline(stages, vcf, outfile, batchSize=BATCH_SIZE, waves=None, threads=1):
+    fh = open(vcf)
     fh_out = open(outfile, "w")
+
+    executor = None
+    if waves is not None and threads > 1:
+        executor = ThreadPoolExecutor(threads)
+
+    try:
+        for lines in readBatches(fh, batchSize):
+            for line in annotateLines(stages, lines, waves, executor, threads):
+                fh_out.write(line + "\n")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for stage in stages:
+            stage.close()
+
+    fh_log = open(vcf + ".count.log", "w")
+    for stage in stages:
+        stage.writeLog(fh_log)
+    fh_log.close()
+
+    fh.close()
+    fh_out.close()
+
+
+"""Per-chromosome (min, max) positions of a coordinate-sorted input
+
+Returns None if the input is not sorted, i.e. a chromosome shows up in more
+than one block or positions go down within a block. Chromosomes are keyed
+without their "chr" prefix so every stage can map them to its own naming.
+"""
+
+
+def scanSortedWindows(vcf, format="vcf", sep="\t"):
     inds = getFormatSpecificIndices(format=format)
+    windows = {}
+    chrom = None
+    last = None
+
     fh = open(vcf)
+    try:
+        for line in fh:
+            line = line.strip()
+            if line.startswith("#") or line.startswith("CHROM") or len(line) == 0:
+                continue
+            fields = line.split(sep)
+            c = fields[inds[0]].strip().replace("chr", "")
+            try:
+                pos = int(fields[inds[1]].strip())
+            except ValueError:
+                return None
+
+            if c != chrom:
+                if c in windows:
+                    return None
+                chrom = c
+                windows[c] = (pos, pos)
+            elif pos < last:
+                return None
+            else:
+                windows[c] = (windows[c][0], pos)
+            last = pos
+    finally:
+        fh.close()
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
+    return windows
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
+class DbSnpStage(Stage):
+    headers = ("#",)
+    logmode = "w"
+    counters = ("var_count", "line_count", "filter_checks", "filter_skips")
+
+    def __init__(self, cursor, format="vcf", varclass="SNV", sep="\t", **options):
+        Stage.__init__(self, cursor, format=format, sep=sep, **options)
+        self.varclass = varclass
+        self.var_count = 0
+        self.line_count = 0
+        # Rows fetched by prefetch() keyed on (chr, pos), or None
+        self.batchRows = None
+
+        # With indexed=True, the dbSNP store in the snapshot directory (if
+        # any) answers the lookups; positions are galloped through from
+        # the last hit since inputs are mostly sorted
+        self.store = None
+        if self.indexed and iv.snapshotDir is not None:
+            self.store = snapshot.getDbSnp(iv.snapshotDir, iv.snapshotVersion)
+        self.storeChrom = None
+        self.storePositions = None
+        self.storeNext = 0
+
+    def position(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace("chr", "")
+        return chr, fields[self.inds[1]].strip()
+
+    # Fetches the dbSNP rows for every position in the batch with one query
+    # per chromosome; lookup() then filters them on REF like the SQL does
+    def prefetch(self, records):
+        if not self.batched or self.store is not None:
+            return
+
+        # Positions the Bloom filter rules out are left out of the query
+        positions = {}
+        for fields in records:
+            chr, pos = self.position(fields)
+            if bloom.mayContain("dbSNP", chr, pos):
+                positions.setdefault(chr, set()).add(int(pos))
+
+        self.batchRows = {}
+        for chr in positions:
+            rows = self.reference.point(
+                "dbSNP",
+                "CHR",
+                "POS",
+                chr,
+                sorted(positions[chr]),
+                [("INFO", self.varclass)],
             )
+            pos_ind = self.reference.column("dbSNP", "POS")
+            for row, match in zip(rows, self.matchRows(rows)):
+                self.batchRows.setdefault((chr, int(row[pos_ind])), []).append(match)
+
+    def cacheName(self):
+        return "dbSNP." + self.varclass
+
+    # dbSNP is only held in memory as the snapshot store
+    @classmethod
+    def plannerStrategies(cls):
+        if iv.snapshotDir is not None and snapshot.getDbSnp(
+            iv.snapshotDir, iv.snapshotVersion
+        ):
+            return (pl.BATCHED, pl.INDEXED)
+        return (pl.BATCHED,)
+
+    @classmethod
+    def plannerTables(cls, kwargs, chrom):
+        return ["dbSNP"]
+
+    # Without the store or batching, every position is a query, indexed or not
+    def queriesPerVariant(self):
+        return self.store is None and not self.batched
+
+    def lookups(self, fields):
+        chr, pos = self.position(fields)
+        if not bloom.mayContain("dbSNP", chr, pos):
+            return []
+        return [((chr, pos), "queryRows", (chr, pos))]
+
+    # Matches as (rsID, GMAF) pairs
+    def lookup(self, chr, pos, ref, compRef):
+        if self.store is not None:
+            return self.storeLookup(chr, pos, ref, compRef)
+
+        # Rows at the position, shared by every allele there
+        if not self.mayHaveRow("dbSNP", chr, pos):
+            rows = []
+        elif self.batchRows is not None:
+            rows = self.batchRows.get((chr, int(pos)), [])
+        else:
+            rows = self.memoized((chr, pos), self.queryRows, chr, pos)
+        return [(rsid, gmaf) for (rsid, gmaf, r) in rows if r in (ref, compRef)]
+
+    def storeLookup(self, chr, pos, ref, compRef):
+        if chr != self.storeChrom:
+            self.storeChrom = chr
+            self.storePositions = self.store.positions(chr)
+            self.storeNext = 0
+
+        k = gallopSearchUniqueAndSorted(self.storePositions, int(pos), self.storeNext)
+        if k < 0:
+            return []
+        self.storeNext = k
+        return [
+            (rsid, gmaf)
+            for (rsid, r, gmaf, info) in self.store.records(chr, k)
+            if r in (ref, compRef) and info == self.varclass
+        ]
+
+    def queryRows(self, chr, pos):
+        rows = self.reference.point(
+            "dbSNP", "CHR", "POS", chr, [pos], [("INFO", self.varclass)]
+        )
+        return self.matchRows(rows)
+
+    # (rsID, GMAF, REF) of each of rows fetched from dbSNP
+    def matchRows(self, rows):
+        ref_ind = self.reference.column("dbSNP", "REF")
+        return [(str(row[3]), str(row[7]), u.text(row[ref_ind])) for row in rows]
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr, pos = self.position(fields)
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+
+        compRef = getComplementary(ref)
+        matches = self.lookup(chr, pos, ref, compRef)
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = "."
+        rsids = []
+        mafs = []
+        if len(matches) > 0:
+            for rsid, gmaf in matches:
+                rsids.append(rsid)
+                if gmaf != ".":
+                    mafs.append("GMAF=" + gmaf)
+
+            maf_str = ""
+            if len(mafs) > 0:
+                maf_str = ";" + ";".join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if str(fields[7]) == ".":
+                fields[7] = "DB" + maf_str
+            else:
+                fields[7] = fields[7] + ";DB;VC=" + self.varclass + maf_str
 
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
+            fields[2] = str(";".join(rsids))
+
+        self.line_count = self.line_count + 1
+        return fields
+
+    def writeLog(self, fh_log):
+        # Total has always been one more than the number of records
+        linenum = self.line_count + 1
+        ratioInDbSnp = (self.var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
+        self.writeFilterLog(fh_log, "dbSNP")
+
+
+def getSnpsFromDbSnp(
+    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
+):
+    with db_pool.connection() as conn:
+        stage = DbSnpStage(conn.cursor(), format=format, varclass=varclass, sep=sep)
+        # dbSNP is the first stage and always reads the raw input
+        runStage(stage, vcf, tmpextin="", tmpextout=tmpextout)
+
+
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+"""
+
+
+class BigRefGeneStage(Stage):
+    headers = ("#",)
+    counters = ("filter_checks", "filter_skips")
+
+    def __init__(self, cursor, format="vcf", sep="\t", **options):
+        Stage.__init__(self, cursor, format=format, sep=sep, **options)
+
+        # With indexed=True all three tables are held in memory and a
+        # variant is resolved without a query
+        self.equalBase = None
+        self.equalNoBase = None
+        self.unequal = None
+        if self.indexed:
+            self.equalBase = iv.getPointIndex(
+                self.reference, "chrom_pos_equal_base", "CHR", "start"
+            )
+            self.equalNoBase = iv.getPointIndex(
+                self.reference, "chrom_pos_equal_nobase", "CHR", "start"
+            )
+            self.unequal = iv.getIndex(
+                self.reference, "chrom_pos_unequal", "CHR", "start", "end"
             )
 
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
+        # Allele columns of the base tier
+        self.ref_ind = None
+        self.alt_ind = None
+        if self.reference is not None:
+            self.ref_ind = self.reference.column(
+                "chrom_pos_equal_base", "haplotypeReference"
+            )
+            self.alt_ind = self.reference.column(
+                "chrom_pos_equal_base", "haplotypeAlternate"
             )
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+    # The first tier with a match wins; the base tier has to match the
+    # allele or its complement, which is checked in memory so that every
+    # allele at a position shares that position's rows
+    def lookup(self, chr, pos, ref, alt, compRef, compAlt):
+        alleles = [(ref, alt), (compRef, compAlt)]
+        rows = [
+            row
+            for row in self.tierRows(0, chr, pos)
+            if (u.text(row[self.ref_ind]), u.text(row[self.alt_ind])) in alleles
+        ]
+        if len(rows) > 0:
+            return rows
+
+        rows = self.tierRows(1, chr, pos)
+        if len(rows) > 0:
+            return rows
+
+        return self.tierRows(2, chr, pos)
+
+    # Collapsed annotation of the matching rows, or None if there are none
+    def collapsedLookup(self, chr, pos, ref, alt, compRef, compAlt):
+        rows = self.lookup(chr, pos, ref, alt, compRef, compAlt)
+        if len(rows) == 0:
+            return None
+
+        m = set([])
+        for row in rows:
+            fields_row = [str(x) for x in row[1:]]
+            # As if the row had been joined into a stripped line
+            fields_row[-1] = fields_row[-1].rstrip()
+            m.add(collapseRefSeqFields(fields_row))
+        return ";".join(m)
+
+    # Rows of tier (0 = chrom_pos_equal_base, 1 = chrom_pos_equal_nobase,
+    # 2 = chrom_pos_unequal) at pos
+    def tierRows(self, tier, chr, pos):
+        if self.equalBase is not None:
+            if tier == 0:
+                return self.equalBase.at(chr, pos)
+            if tier == 1:
+                return self.equalNoBase.at(chr, pos)
+            return self.unequal.overlapping(chr, pos)
+        if tier < 2:
+            table = ["chrom_pos_equal_base", "chrom_pos_equal_nobase"][tier]
+            if not self.mayHaveRow(table, chr, pos):
+                return []
+        # Only the collapsed result (see annotate) goes to the query cache
+        return self.memoized(
+            (tier, chr, pos), self.queryTier, tier, chr, pos, shared=False
+        )
+
+    def queryTier(self, tier, chr, pos):
+        if tier == 2:
+            return self.reference.overlapping(
+                "chrom_pos_unequal", "CHR", "start", "end", chr, pos
+            )
+        table = ["chrom_pos_equal_base", "chrom_pos_equal_nobase"][tier]
+        return self.reference.point(table, "CHR", "start", chr, [pos])
 
-            if len(rows) > 0:
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
+    # (chr, pos, ref, alt, compRef, compAlt) of fields
+    def variant(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace("chr", "")
 
-                fields[7] = fields[7] + ";" + ";".join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace(".;", "", 1)
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+        return chr, pos, ref, alt, getComplementary(ref), getComplementary(alt)
 
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+    def queriesPerVariant(self):
+        return self.equalBase is None
 
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+    @classmethod
+    def plannerStrategies(cls):
+        return (pl.INDEXED,)
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+    @classmethod
+    def plannerTables(cls, kwargs, chrom):
+        return ["chrom_pos_equal_base", "chrom_pos_equal_nobase", "chrom_pos_unequal"]
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
+    def lookups(self, fields):
+        variant = self.variant(fields)
+        return [(variant[:4], "collapsedLookup", variant)]
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+    def annotate(self, fields):
+        chr, pos, ref, alt, compRef, compAlt = self.variant(fields)
 
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+        collapsed = self.memoized(
+            (chr, pos, ref, alt),
+            self.collapsedLookup,
+            chr,
+            pos,
+            ref,
+            alt,
+            compRef,
+            compAlt,
+        )
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+        if collapsed is not None:
+            fields[7] = fields[7] + ";" + collapsed
+            if str(fields[7]).startswith(".;"):
+                fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
+        return fields
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+    def writeLog(self, fh_log):
+        self.writeFilterLog(fh_log, "RefGene tier")
 
-            if keep_going:
-                fh_out.write(line + "\n")
 
-            vcf_linenum = vcf_linenum + 1
+def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
+    with db_pool.connection() as conn:
+        stage = BigRefGeneStage(conn.cursor(), format=format, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-        else:
-            fh_out.write(line + "\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Exon structure of one refGene transcript, parsed once
+
+Exons are kept sorted by start with the running maximum end, so exonsAt()
+finds the exons containing a position by bisect instead of checking every
+exon. Exon numbers count from the 5' end, i.e. backwards on the - strand.
+"""
+
+
+class TranscriptModel(object):
+    def __init__(self, row):
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.strand = str(row[3])
+
+        exonsSt = u.text(row[9]).split(",")
+        exonsEn = u.text(row[10]).split(",")
+        exons = sorted(
+            (int(exonsSt[e]), int(exonsEn[e]), e) for e in range(self.exonCount)
+        )
+        self.starts = [x[0] for x in exons]
+        self.ends = [x[1] for x in exons]
+        self.numbers = [x[2] for x in exons]
+        self.maxEnds = []
+        maxEnd = None
+        for end in self.ends:
+            if maxEnd is None or end > maxEnd:
+                maxEnd = end
+            self.maxEnds.append(maxEnd)
+
+    # Indices (in exonStarts order) of the exons with start <= pos <= end
+    def exonsAt(self, pos):
+        found = []
+        k = bisect_right(self.starts, pos) - 1
+        while k >= 0 and self.maxEnds[k] >= pos:
+            if self.ends[k] >= pos:
+                found.append(self.numbers[k])
+            k = k - 1
+        return sorted(found)
+
+    def exonNumber(self, e):
+        if self.strand == "-":
+            return self.exonCount - e
+        return e + 1
+
+
+"""Transcript models parsed so far, keyed by refGene row; emptied once it
+holds MEMO_SIZE of them, like the stage memos (see Stage.memoized)
+"""
+_transcripts = {}
+
+
+def getTranscriptModel(row):
+    global _transcripts
+    model = _transcripts.get(row)
+    if model is None:
+        if len(_transcripts) >= MEMO_SIZE:
+            _transcripts = {}
+        model = TranscriptModel(row)
+        _transcripts[row] = model
+    return model
 
 
 """Get information about location in gene structures
+
+With indexed=True the refGene rows come from an interval index (widened by
+promoter_offset) instead of a query per variant. Either way each
+transcript's exons are parsed once (see TranscriptModel), and refGene and
+CpG island lookups are remembered per position.
 """
 
 
+class GeneStage(Stage):
+    headers = ("#",)
+    counters = (
+        "interGenic_count",
+        "cds_count",
+        "utr3_count",
+        "utr5_count",
+        "intronic_count",
+        "non_coding_intronic_count",
+        "exonic_count",
+        "non_coding_exonic_count",
+        "promoter_count",
+    )
+
+    def __init__(
+        self,
+        cursor,
+        format="vcf",
+        table="refGene",
+        promoter_offset=500,
+        sep="\t",
+        **options,
+    ):
+        Stage.__init__(self, cursor, format=format, sep=sep, **options)
+        self.table = table
+        self.promoter_offset = promoter_offset
+
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+        self.index = None
+        if self.indexed:
+            self.index = iv.getIndex(
+                self.reference, self.table, "chrom", "txStart", "txEnd"
+            )
+        self.batchRows = None
+
+    def chromName(self, chr):
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr
+
+    def prefetch(self, records):
+        self.batchRows = None
+        if self.index is not None and isinstance(records, vb.VariantBatch):
+            self.batchRows = prefetchRegionRows(
+                self.index, self.chromName, records, int(self.promoter_offset)
+            )
+
+    def lookup(self, chr, pos):
+        if self.batchRows is not None and (chr, int(pos)) in self.batchRows:
+            return self.batchRows[(chr, int(pos))]
+        if self.index is not None:
+            return self.index.overlapping(chr, pos, int(self.promoter_offset))
+
+        offset = int(self.promoter_offset)
+        return self.reference.overlapping(
+            self.table,
+            "chrom",
+            "txStart",
+            "txEnd",
+            chr,
+            int(pos) - offset,
+            int(pos) + offset,
+        )
+
+    def cacheName(self):
+        return self.table + "+" + str(self.promoter_offset)
+
+    def queriesPerVariant(self):
+        return self.index is None
+
+    # CpG islands are queried whatever the strategy
+    @classmethod
+    def plannerStrategies(cls):
+        return (pl.INDEXED,)
+
+    @classmethod
+    def plannerTables(cls, kwargs, chrom):
+        return [kwargs.get("table", "refGene")]
+
+    def lookups(self, fields):
+        chr = self.chromName(fields[self.inds[0]].strip())
+        pos = fields[self.inds[1]].strip()
+        return [((chr, pos), "lookup", (chr, pos))]
+
+    def lookupCpgIsland(self, chr, pos):
+        return self.memoized(("cpg", chr, int(pos)), self.queryCpgIsland, chr, pos)
+
+    def queryCpgIsland(self, chr, pos):
+        return self.reference.first(
+            "cpgIslandExt",
+            "chrom",
+            "chromStart",
+            "chromEnd",
+            chr,
+            pos,
+            select=SITE_COLUMNS,
+        )
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        info_field = clean_mysql_chars(fields[7]).strip()
+
+        rows = self.memoized((chr, pos), self.lookup, chr, pos)
+        info = []
+
+        if len(rows) > 0:
+            cnt = 1
+            for row in rows:
+                # count location
+                positionType = str(u.parse_field(info_field, "positionType", ";", "="))
+
+                if positionType == "intron":
+                    self.intronic_count = self.intronic_count + 1
+                elif positionType == "non_coding_intron":
+                    self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                elif positionType == "CDS":
+                    self.cds_count = self.cds_count + 1
+                elif positionType == "non_coding_exon":
+                    self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                elif positionType == "utr5":
+                    self.utr5_count = self.utr5_count + 1
+                elif positionType == "utr3":
+                    self.utr3_count = self.utr3_count + 1
+
+                model = getTranscriptModel(row)
+                txtStart = model.txStart
+                txtEnd = model.txEnd
+                cdsStart = model.cdsStart
+                cdsEnd = model.cdsEnd
+                exonCount = model.exonCount
+                strand = model.strand
+
+                promoter_plus = txtStart - int(self.promoter_offset)
+                promoter_minus = txtEnd + int(self.promoter_offset)
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if cdsStart == cdsEnd:
+                    for e in model.exonsAt(pos):
+                        exons.append(
+                            "non_coding_exon="
+                            + "ex"
+                            + str(model.exonNumber(e))
+                            + "/"
+                            + str(exonCount)
+                        )
+                    if len(exons) > 0:
+                        region = ";".join(exons)
+                elif u.isBetween(pos, cdsStart, cdsEnd):
+                    for e in model.exonsAt(pos):
+                        exons.append(
+                            "exon="
+                            + "ex"
+                            + str(model.exonNumber(e))
+                            + "/"
+                            + str(exonCount)
+                        )
+                        self.exonic_count = self.exonic_count + 1
+                    if len(exons) > 0:
+                        region = ";".join(exons)
+
+                elif (
+                    u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")
+                ) or (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                    cpg = self.lookupCpgIsland(chr, pos)
+                    if cpg is not None:
+                        region = "putativePromoterRegion=" + "".join(
+                            str(cpg[3]).split()
+                        )
+                        self.promoter_count = self.promoter_count + 1
+
+                else:
+                    region = ""
+
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=row,
+                            indices=indicesKnownGenes,
+                            region=region,
+                            cnt=cnt,
+                        )
+                    )
+
+                cnt = cnt + 1
+
+            str_info = ";".join(info)
+            fields[7] = fields[7] + ";" + str_info
+
+        else:
+            fields[7] = fields[7] + ";positionType=interGenic"
+            self.interGenic_count = self.interGenic_count + 1
+
+        return fields
+
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
+
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
+
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
+
+        print(f"In '3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In '3 UTR {str(self.utr3_count)}\n")
+
+        print(f"In '5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In '5 UTR {str(self.utr5_count)}\n")
+
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
+
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
+
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
+
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
+
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
+
+
 def getGenes(
     vcf,
     format="vcf",
@@ -399,6 +1386,30 @@ def getGenes(
     tmpextout=".3",
     sep="\t",
 ):
+    with db_pool.connection() as conn:
+        stage = GeneStage(
+            conn.cursor(),
+            format=format,
+            table=table,
+            promoter_offset=promoter_offset,
+            sep=sep,
+        )
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
+
+
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+
+
+def getExonsEtAl(
+    vcf,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+):
 
     basefile = vcf
     vcf = basefile + tmpextin
@@ -420,8 +1431,9 @@ def getGenes(
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    pool = db_pool.getPool()
+    conn = pool.acquire()
+    reference = rf.reader(conn.cursor())
     linenum = 1
 
     for line in fh:
@@ -439,47 +1451,19 @@ def getGenes(
             info_field = clean_mysql_chars(fields[7]).strip()
             this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
 
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '" AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
+            rows = reference.overlapping(
+                table,
+                "chrom",
+                "txStart",
+                "txEnd",
+                chr,
+                int(pos) - int(promoter_offset),
+                int(pos) + int(promoter_offset),
             )
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
             info = []
-
             if len(rows) > 0:
                 cnt = 1
                 for row in rows:
-                    # count location
-                    positionType = str(
-                        u.parse_field(info_field, "positionType", ";", "=")
-                    )
-
-                    if positionType == "intron":
-                        intronic_count = intronic_count + 1
-                    elif positionType == "non_coding_intron":
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif positionType == "CDS":
-                        cds_count = cds_count + 1
-                    elif positionType == "non_coding_exon":
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif positionType == "utr5":
-                        utr5_count = utr5_count + 1
-                    elif positionType == "utr3":
-                        utr3_count = utr3_count + 1
-
                     txtStart = int(row[4])
                     txtEnd = int(row[5])
                     cdsStart = int(row[6])
@@ -511,240 +1495,15 @@ def getGenes(
                                     + "/"
                                     + str(exonCount)
                                 )
+                                non_coding_exonic_count = non_coding_exonic_count + 1
                         if len(exons) > 0:
-                            region = ";".join(exons)
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + "\n")
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
-
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
-
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
-
-
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-
-
-def getExonsEtAl(
-    vcf,
-    format="vcf",
-    table="refGene",
-    promoter_offset=500,
-    tmpextin=".2",
-    tmpextout=".3",
-    sep="\t",
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '"   AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=non_coding_exon;" + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = "positionType=non_coding_intron"
-
-                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
-                        cds_count = cds_count + 1
+                            region = "positionType=non_coding_exon;" + ";".join(exons)
+                        else:
+                            non_coding_intronic_count = non_coding_intronic_count + 1
+                            region = "positionType=non_coding_intron"
+
+                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
+                        cds_count = cds_count + 1
                         for e in range(0, exonCount):
                             if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
                                 exnum = e + 1
@@ -789,18 +1548,15 @@ def getExonsEtAl(
                         region = "positionType=utr3"
 
                     elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
+                        rows = reference.first(
+                            "cpgIslandExt",
+                            "chrom",
+                            "chromStart",
+                            "chromEnd",
+                            chr,
+                            pos,
+                            select=SITE_COLUMNS,
                         )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
 
                         if rows is not None:
                             region = "putativePromoterRegion=" + "".join(
@@ -809,18 +1565,15 @@ def getExonsEtAl(
                             promoter_count = promoter_count + 1
 
                     elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
+                        rows = reference.first(
+                            "cpgIslandExt",
+                            "chrom",
+                            "chromStart",
+                            "chromEnd",
+                            chr,
+                            pos,
+                            select=SITE_COLUMNS,
                         )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
 
                         if rows is not None:
                             region = "putativePromoterRegion=" + "".join(
@@ -890,508 +1643,461 @@ def getExonsEtAl(
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
+    pool.release(conn)
 
 
 """Overlap with tfbsConsSites
-"""
-
-
-def addOverlapWithTfbsConsSites(
-    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
-):
-
-    allowed_chrom = [
-        "1",
-        "2",
-        "3",
-        "4",
-        "5",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-        "11",
-        "12",
-        "13",
-        "14",
-        "15",
-        "16",
-        "17",
-        "18",
-        "19",
-        "20",
-        "21",
-        "22",
-        "X",
-        "Y",
-    ]
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line + "\n")
-
-        # header line
-        elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex = chr.replace("chr", "")
-
-            if chrIndex in allowed_chrom:
-                isOverlap = False
-                sql = (
-                    "select chrom, chromStart, chromEnd, name "
-                    + "from tfbsConsSites"
-                    + chrIndex
-                    + " where  chromStart <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd;"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = (
-                            str(row[3])
-                            + "."
-                            + str(row[0])
-                            + "."
-                            + str(row[1])
-                            + "."
-                            + str(row[2])
-                        )
-                        t = t.strip()
-                        records.append("tfbsRegion" + "=" + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
 
-                    fh_out.write("\t".join(fields) + "\n")
-
-                else:  # chrom is not on the list
-                    fh_out.write(line + "\n")
-
-            else:  # chrom is not on the list
-                fh_out.write(line + "\n")
-
-        linenum = linenum + 1
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with GadAll table
+The sites are split over one tfbsConsSites<chrom> table per chromosome.
+With indexed=True, or on a chromosome that has a sweep window (sorted
+input), the first variant on a chromosome loads that chromosome's sites
+into an IntervalArray and later variants are answered from it. The sites
+are dropped when the chromosome changes, so only one chromosome is held at
+a time; an input whose chromosomes are not in one block each loads a
+chromosome again when it comes back.
 """
 
 
-def addOverlapWithGadAll(
-    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
+class TfbsConsSitesStage(Stage):
+    counters = ("var_count", "line_count")
+    allowed_chrom = snapshot.TFBS_CHROMS
+    chromTables = True
+    snapshotIndexes = False
+
+    def __init__(
+        self, cursor, format="vcf", table="tfbsConsSites", sep="\t", **options
+    ):
+        Stage.__init__(self, cursor, format=format, sep=sep, **options)
+        self.table = table
+        self.var_count = 0
+        self.line_count = 0
+
+        # Sites of the chromosome loaded last, keyed by chromosome
+        self.sites = {}
+
+    @classmethod
+    def plannerStrategies(cls):
+        return (pl.SWEEP, pl.INDEXED)
+
+    @classmethod
+    def plannerTables(cls, kwargs, chrom):
+        if chrom not in cls.allowed_chrom:
+            return []
+        return ["tfbsConsSites" + chrom]
+
+    def loadSites(self, chrIndex):
+        if chrIndex not in self.sites:
+            table = "tfbsConsSites" + chrIndex
+            self.sites = {}
+            window = None
+            if self.sweep is not None:
+                window = self.sweep.get(chrIndex)
+            if window is not None:
+                # Only the sites the input's positions can reach
+                rows = self.reference.overlapping(
+                    table,
+                    None,
+                    "chromStart",
+                    "chromEnd",
+                    None,
+                    *window,
+                    select=SITE_COLUMNS,
+                )
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
+                rows = self.reference.rows(table, select=SITE_COLUMNS)
+            self.sites[chrIndex] = iv.IntervalArray(rows, 1, 2)
+        return self.sites[chrIndex]
+
+    def lookups(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        pos = fields[self.inds[1]].strip()
+        chrIndex = chr.replace("chr", "")
+        if chrIndex not in self.allowed_chrom:
+            return []
+        return [((chrIndex, pos), "lookup", (chrIndex, pos))]
+
+    def lookup(self, chrIndex, pos):
+        if self.indexed or (self.sweep is not None and chrIndex in self.sweep):
+            return self.loadSites(chrIndex).overlapping(pos)
+
+        return self.reference.overlapping(
+            "tfbsConsSites" + chrIndex,
+            None,
+            "chromStart",
+            "chromEnd",
+            None,
+            pos,
+            select=SITE_COLUMNS,
+        )
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        # For some reason this table has no "chr" preceeding number
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        chrIndex = chr.replace("chr", "")
+
+        if chrIndex in self.allowed_chrom:
+            rows = self.memoized((chrIndex, pos), self.lookup, chrIndex, pos)
+            records = []
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+            if len(rows) > 0:
+                self.line_count = self.line_count + 1
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+                for row in rows:
+                    self.var_count = self.var_count + 1
+                    t = (
+                        str(row[3])
+                        + "."
+                        + str(row[0])
+                        + "."
+                        + str(row[1])
+                        + "."
+                        + str(row[2])
+                    )
+                    t = t.strip()
+                    records.append("tfbsRegion" + "=" + t)
 
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
+                if str(fields[7]).endswith(";"):
+                    fields[7] = fields[7] + ";".join(records)
                 else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+                    fields[7] = fields[7] + ";" + ";".join(records)
 
+        return fields
 
-""" Overlap with gwasCatalog table """
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In {str(self.table)}: {str(self.var_count)} in "
+            + f"{str(self.line_count)} variants\n"
+        )
 
 
-def addOverlapWithGwasCatalog(
-    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
+def addOverlapWithTfbsConsSites(
+    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
 ):
+    with db_pool.connection() as conn:
+        stage = TfbsConsSitesStage(conn.cursor(), format=format, table=table, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""Base class for stages that report "In <table>: N in M variants"
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+Subclasses that set indexColumns to the (chrom, start, end) column names of
+their table load it once into an interval index when indexed=True.
+"""
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
+class OverlapStage(Stage):
+    counters = ("var_count", "line_count")
+    defaultTable = None
+    indexColumns = None
+
+    def __init__(self, cursor, format="vcf", table=None, sep="\t", **options):
+        Stage.__init__(self, cursor, format=format, sep=sep, **options)
+        self.table = table if table is not None else self.defaultTable
+        self.var_count = 0
+        self.line_count = 0
+
+        self.index = None
+        if self.indexed and self.indexColumns is not None:
+            self.index = iv.getIndex(self.reference, self.table, *self.indexColumns)
+        # Rows prefetched for the batch, keyed on (chrom, pos), or None
+        self.batchRows = None
+
+        # Merge walk over the rows of the chromosome being swept
+        self.sweepChrom = None
+        self.sweeper = None
+
+    # Chromosome name as the stage's table writes it
+    def chromName(self, chr):
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr
+
+    # Looks up all positions of the batch in the index at once
+    def prefetch(self, records):
+        self.batchRows = None
+        if self.index is not None and isinstance(records, vb.VariantBatch):
+            self.batchRows = prefetchRegionRows(self.index, self.chromName, records)
+
+    # Rows prefetched for the stage's batch are not carried over to later
+    # batches; the copy looks them up in the index
+    def lookupCopy(self, cursor):
+        slot = Stage.lookupCopy(self, cursor)
+        slot.batchRows = None
+        slot.sweepChrom = None
+        slot.sweeper = None
+        return slot
+
+    # Tables without indexColumns are queried even when indexed or swept
+    def queriesPerVariant(self):
+        return self.index is None and (
+            self.sweep is None or self.indexColumns is None
+        )
+
+    @classmethod
+    def plannerStrategies(cls):
+        return (pl.SWEEP, pl.INDEXED)
+
+    @classmethod
+    def plannerTables(cls, kwargs, chrom):
+        return [kwargs.get("table") or cls.defaultTable]
+
+    def lookups(self, fields):
+        chr = self.chromName(fields[self.inds[0]].strip())
+        pos = fields[self.inds[1]].strip()
+        return [((chr, pos), "lookup", (chr, pos))]
+
+    # Rows overlapping pos from memory, or None if they have to be queried
+    def regionRows(self, chr, pos):
+        if self.batchRows is not None:
+            rows = self.batchRows.get((chr, int(pos)))
+            if rows is not None:
+                return rows
+        if self.index is not None:
+            return self.index.overlapping(chr, pos)
+        if self.sweep is not None and self.indexColumns is not None:
+            return self.sweepRows(chr, pos)
+        return None
+
+    # Rows of the table overlapping pos
+    def lookup(self, chr, pos):
+        rows = self.regionRows(chr, pos)
+        if rows is not None:
+            return rows
+        return self.reference.overlapping(self.table, *self.indexColumns, chr, pos)
+
+    # The first row overlapping pos, or None
+    def firstRow(self, chr, pos):
+        rows = self.regionRows(chr, pos)
+        if rows is not None:
+            return rows[0] if len(rows) > 0 else None
+        return self.reference.first(self.table, *self.indexColumns, chr, pos)
+
+    def sweepRows(self, chr, pos):
+        if chr != self.sweepChrom:
+            self.sweepChrom = chr
+            self.sweeper = None
+            window = self.sweep.get(chr.replace("chr", ""))
+            if window is not None:
+                self.sweeper = iv.getSweep(
+                    self.reference, self.table, chr, window, *self.indexColumns
                 )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
 
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+        if self.sweeper is None:
+            return None
+        # None when pos is behind the sweep, i.e. the input is not sorted
+        return self.sweeper.overlapping(pos)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In {str(self.table)}: {str(self.var_count)} in "
+            + f"{str(self.line_count)} variants\n"
+        )
 
 
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""Overlap with GadAll table
 """
 
 
-def addOverlapWitHUGOGeneNomenclature(
-    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
-):
+class GadAllStage(OverlapStage):
+    defaultTable = "gadAll"
+    indexColumns = ("chromosome", "chromStart", "chromEnd")
+
+    # For some reason this table has no "chr" preceeding number
+    def chromName(self, chr):
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+        return chr
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        # For some reason this table has no "chr" preceeding number
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+
+        pos = fields[inds[1]].strip()
+        rows = self.memoized((chr, pos), self.lookup, chr, pos)
+        records = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]))
+                    records.append(str(self.table) + "=" + str(row[3]))
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + ";".join(records)
+            else:
+                fields[7] = fields[7] + ";" + ";".join(records)
+            # Annotated lines have always been written out tab-space separated
+            fields = fields[:1] + [" " + f for f in fields[1:]]
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+        return fields
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+def addOverlapWithGadAll(
+    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
+):
+    with db_pool.connection() as conn:
+        stage = GadAllStage(conn.cursor(), format=format, table=table, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+""" Overlap with gwasCatalog table """
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
+class GwasCatalogStage(OverlapStage):
+    defaultTable = "gwasCatalog"
+    # Matched on chromEnd only, i.e. the interval [chromEnd, chromEnd]
+    indexColumns = ("chrom", "chromEnd", "chromEnd")
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        rows = self.memoized((chr, pos), self.lookup, chr, pos)
+        records = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(
+                    str(self.table)
+                    + "="
+                    + str("pubMedID")
+                    + "="
+                    + str(row[5])
+                    + ",trait="
+                    + str(row[10])
                 )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + ";".join(records)
+            else:
+                fields[7] = fields[7] + ";" + ";".join(records)
 
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
+        return fields
 
-                    records_str = ",".join(records).replace(";", ",")
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
-                    else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+def addOverlapWithGwasCatalog(
+    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
+):
+    with db_pool.connection() as conn:
+        stage = GwasCatalogStage(conn.cursor(), format=format, table=table, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
+class HugoStage(OverlapStage):
+    defaultTable = "hugo"
+    indexColumns = ("chrom", "chromStart", "chromEnd")
 
-"""Overlap with segdup regions genomicSuperDups
-"""
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
 
+        pos = fields[inds[1]].strip()
+        rows = self.memoized((chr, pos), self.lookup, chr, pos)
+        records = []
 
-def addOverlapWithGenomicSuperDups(
-    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + "," + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append("HGNC_GeneAnnotation" + "=" + t)
+
+            records_str = ",".join(records).replace(";", ",")
+
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + records_str
+            else:
+                fields[7] = fields[7] + ";" + records_str
+
+        return fields
+
+
+def addOverlapWitHUGOGeneNomenclature(
+    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
 ):
+    with db_pool.connection() as conn:
+        stage = HugoStage(conn.cursor(), format=format, table=table, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""Overlap with segdup regions genomicSuperDups
+"""
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+class GenomicSuperDupsStage(OverlapStage):
+    defaultTable = "genomicSuperDups"
+    indexColumns = ("chrom", "chromStart", "chromEnd")
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    def lookup(self, chr, pos):
+        return self.firstRow(chr, pos)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
+        pos = fields[inds[1]].strip()
+        rows = self.memoized((chr, pos), self.lookup, chr, pos)
 
-                fh_out.write("\t".join(fields) + "\n")
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            otherChrom = rows[7]
+            otherStart = rows[8]
+            otherEnd = rows[9]
+            fields[7] = (
+                fields[7]
+                + ";"
+                + str(self.table)
+                + "="
+                + str(isOverlap)
+                + ";"
+                + "otherChrom="
+                + str(otherChrom)
+                + ";otherStart="
+                + str(otherStart)
+                + ";otherEnd="
+                + str(otherEnd)
+            )
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+        return fields
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(
+    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
+):
+    with db_pool.connection() as conn:
+        stage = GenomicSuperDupsStage(
+            conn.cursor(), format=format, table=table, sep=sep
+        )
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1421,8 +2127,9 @@ def addOverlapWithRefGene(
     endName = "txEnd"
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    pool = db_pool.getPool()
+    conn = pool.acquire()
+    reference = rf.reader(conn.cursor())
     linenum = 1
 
     for line in fh:
@@ -1441,24 +2148,10 @@ def addOverlapWithRefGene(
                 pos = fields[inds[1]].strip()
                 isOverlap = False
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
                 overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = reference.overlapping(
+                    table, "chrom", startName, endName, chr, pos
+                )
 
                 if len(rows) > 0:
                     line_count = line_count + 1
@@ -1490,7 +2183,7 @@ def addOverlapWithRefGene(
     )
     fh_log.close()
 
-    conn.close()
+    pool.release(conn)
     fh.close()
     fh_out.close()
 
@@ -1499,259 +2192,266 @@ def addOverlapWithRefGene(
 """
 
 
-def addOverlapWithCytoband(
-    vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = "txStart"
-    endName = "txEnd"
+class CytobandStage(OverlapStage):
+    def __init__(self, cursor, format="vcf", table="cytoBand", sep="\t", **options):
+        self.colindex = 12
+        self.startName = "txStart"
+        self.endName = "txEnd"
+
+        if table == "cytoBand":
+            self.colindex = 3
+            self.startName = "chromStart"
+            self.endName = "chromEnd"
+
+        self.indexColumns = ("chrom", self.startName, self.endName)
+        OverlapStage.__init__(
+            self, cursor, format=format, table=table, sep=sep, **options
+        )
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        overlapsWith = []
+        rows = self.memoized((chr, pos), self.lookup, chr, pos)
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ";".join([str(x) for x in overlapsWith])
+
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + str(self.table) + "=" + str(cytoband)
+            else:
+                fields[7] = fields[7] + ";" + str(self.table) + "=" + str(cytoband)
 
-    if table == "cytoBand":
-        colindex = 3
-        startName = "chromStart"
-        endName = "chromEnd"
+        return fields
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+def addOverlapWithCytoband(
+    vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
+):
+    with db_pool.connection() as conn:
+        stage = CytobandStage(conn.cursor(), format=format, table=table, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+"""Method to find overlap with CNV tables
+"""
 
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
+class CnvStage(OverlapStage):
+    defaultTable = "dgv_Cnv"
+    indexColumns = ("chrom", "chromStart", "chromEnd")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    def lookup(self, chr, pos):
+        return self.firstRow(chr, pos)
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        pos = fields[inds[1]].strip()
+        rows = self.memoized((chr, pos), self.lookup, chr, pos)
 
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + str(self.table) + "=" + str(isOverlap)
+            else:
+                fields[7] = fields[7] + ";" + str(self.table) + "=" + str(isOverlap)
 
-"""Method to find overlap with CNV tables
-"""
+        return fields
 
 
 def addOverlapWithCnvDatabase(
     vcf, format="vcf", table="dgv_Cnv", tmpextin="", tmpextout=".1", sep="\t"
 ):
+    with db_pool.connection() as conn:
+        stage = CnvStage(conn.cursor(), format=format, table=table, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+"""CNV tables annotated by CnvTablesStage, in output order
+"""
+CNV_TABLES = ["dgv_Cnv", "abParts_IG_T_CelReceptors", "mcCarroll_Cnv", "conrad_Cnv"]
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+"""Overlap with several CNV tables at once
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+Gives the same INFO flags and .count.log lines as a CnvStage per table, in
+the order of tables, but looks a variant up in all of them together: from
+the tables' interval indexes or sweeps where there are any, and with one
+UNION ALL query over the remaining tables otherwise.
+"""
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+class CnvTablesStage(Stage):
+    def __init__(self, cursor, format="vcf", tables=None, sep="\t", **options):
+        Stage.__init__(self, cursor, format=format, sep=sep, **options)
+        self.tables = tables if tables is not None else CNV_TABLES
+        self.stages = [
+            CnvStage(cursor, format=format, table=table, sep=sep, **options)
+            for table in self.tables
+        ]
+
+    def prefetch(self, records):
+        for stage in self.stages:
+            stage.prefetch(records)
+
+    def cacheName(self):
+        return ",".join(self.tables)
+
+    # The per-table stages hold the cursor and per-batch state, so the copy
+    # gets copies of its own
+    def lookupCopy(self, cursor):
+        slot = Stage.lookupCopy(self, cursor)
+        slot.stages = [stage.lookupCopy(cursor) for stage in self.stages]
+        return slot
+
+    def queriesPerVariant(self):
+        return any([stage.queriesPerVariant() for stage in self.stages])
+
+    @classmethod
+    def plannerStrategies(cls):
+        return (pl.SWEEP, pl.INDEXED)
+
+    @classmethod
+    def plannerTables(cls, kwargs, chrom):
+        return list(kwargs.get("tables") or CNV_TABLES)
+
+    def lookups(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        pos = fields[self.inds[1]].strip()
+        return [((chr, pos), "lookup", (chr, pos))]
+
+    # Names of the tables with a row overlapping pos
+    def lookup(self, chr, pos):
+        hits = set()
+        query = []
+        for stage in self.stages:
+            rows = stage.regionRows(chr, pos)
+            if rows is None:
+                query.append(stage.table)
+            elif len(rows) > 0:
+                hits.add(stage.table)
+
+        if len(query) > 0:
+            hits.update(
+                self.reference.tablesOverlapping(
+                    query, "chrom", "chromStart", "chromEnd", chr, pos
+                )
+            )
+        return hits
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        hits = self.memoized((chr, pos), self.lookup, chr, pos)
+
+        for stage in self.stages:
+            if stage.table in hits:
+                stage.line_count = stage.line_count + 1
+                stage.var_count = stage.var_count + 1
+                isOverlap = True
+                if str(fields[7]).endswith(";"):
+                    fields[7] = fields[7] + str(stage.table) + "=" + str(isOverlap)
+                else:
+                    fields[7] = (
+                        fields[7] + ";" + str(stage.table) + "=" + str(isOverlap)
+                    )
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        return fields
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def writeLog(self, fh_log):
+        for stage in self.stages:
+            stage.writeLog(fh_log)
 
+    def counterValues(self):
+        return [stage.counterValues() for stage in self.stages]
 
-"""Method to find overlap with targetScanS tables
-"""
+    def addCounters(self, values):
+        for stage, stage_values in zip(self.stages, values):
+            stage.addCounters(stage_values)
 
 
-def addOverlapWithMiRNA(
-    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
+def addOverlapWithCnvDatabases(
+    vcf, format="vcf", tables=None, tmpextin="", tmpextout=".1", sep="\t"
 ):
+    with db_pool.connection() as conn:
+        stage = CnvTablesStage(conn.cursor(), format=format, tables=tables, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+"""Method to find overlap with targetScanS tables
+"""
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
+class MiRNAStage(OverlapStage):
+    defaultTable = "targetScanS"
+    indexColumns = ("chrom", "chromStart", "chromEnd")
+
+    def lookup(self, chr, pos):
+        return self.firstRow(chr, pos)
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        rows = self.memoized((chr, pos), self.lookup, chr, pos)
+
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = (
+                str(rows[4])
+                + ","
+                + str(rows[1])
+                + "_"
+                + str(rows[2])
+                + "_"
+                + str(rows[3])
+            )
+            t = "miRNAsites=" + t.strip()
+            if str(fields[7]).endswith(";"):
+                fields[7] = fields[7] + t
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+                fields[7] = fields[7] + ";" + t
 
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
+        return fields
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In miRNAsites: {str(self.var_count)} in "
+            + f"{str(self.line_count)} variants\n"
+        )
 
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(
+    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
+):
+    with db_pool.connection() as conn:
+        stage = MiRNAStage(conn.cursor(), format=format, table=table, sep=sep)
+        runStage(stage, vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 ### EOF
@@ -0,0 +1,122 @@
+# batch.py
+#
+# Columnar batches of variants and batch-at-a-time overlap lookups
+#
+# A stage that is handed a whole batch of records can look all of their
+# positions up against a sorted reference array at once instead of one
+# bisect per record. With NumPy installed that is a single searchsorted
+# over the batch; without it the same lookups run one position at a time.
+#
+##
+
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+"""The records of one batch, with their coordinates in columns
+
+chromCodes[i] indexes chroms, the distinct chromosome names as they are
+written in the input; positions[i] is -1 where the position is not a
+number. The records themselves (lists of fields) are what the stages
+annotate and what is written out, so a batch can be iterated like the list
+of records. Stages do not change CHROM or POS other than by padding them,
+so the columns hold for every stage a batch goes through. REF and ALT are
+left in the records, since the stages that match on them read them
+alongside other fields of the record.
+"""
+
+
+class VariantBatch(object):
+    def __init__(self, records, inds):
+        self.records = records
+        self.chroms = []
+        self.chromCodes = array("H")
+        self.positions = array("q")
+
+        codes = {}
+        for fields in records:
+            chrom = fields[inds[0]].strip() if len(fields) > inds[0] else ""
+            if chrom not in codes:
+                codes[chrom] = len(self.chroms)
+                self.chroms.append(chrom)
+            self.chromCodes.append(codes[chrom])
+            try:
+                self.positions.append(int(fields[inds[1]].strip()))
+            except (ValueError, IndexError):
+                self.positions.append(-1)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    # Distinct valid positions of the batch, grouped by chromosome name as
+    # mapped by chromName
+    def positionsByChrom(self, chromName):
+        groups = {}
+        for code, pos in zip(self.chromCodes, self.positions):
+            if pos >= 0:
+                groups.setdefault(chromName(self.chroms[code]), set()).add(pos)
+        return dict((chrom, sorted(p)) for chrom, p in groups.items())
+
+
+"""A sorted reference column in the form matchesMany() searches fastest:
+an int64 NumPy array if NumPy is installed (sharing memory with arrays
+and memoryviews), otherwise the sequence itself
+"""
+
+
+def column(values):
+    if np is None:
+        return values
+    if isinstance(values, list):
+        return np.array(values, dtype=np.int64)
+    return np.frombuffer(values, dtype=np.int64)
+
+
+"""Indices k of the intervals [starts[k] - margin, ends[k] + margin] that
+contain each of positions
+
+starts is sorted and maxEnds[k] is the largest of ends[:k + 1], as in
+intervals.IntervalIndex. Returns one list per position, in no particular
+order. With NumPy, the last start at or before each position is found with
+one searchsorted over all of them, and positions whose maxEnds there falls
+short -- most of them, for sparse tables -- are rejected without a walk.
+"""
+
+
+def matchesMany(starts, ends, maxEnds, positions, margin=0):
+    found = [[] for p in positions]
+    if len(positions) == 0 or len(starts) == 0:
+        return found
+
+    if np is None:
+        candidates = []
+        for i, pos in enumerate(positions):
+            candidates.append((i, bisect_right(starts, pos + margin) - 1))
+    else:
+        pos = np.asarray(positions, dtype=np.int64)
+        last = np.searchsorted(starts, pos + margin, side="right") - 1
+        reach = np.asarray(maxEnds)[np.maximum(last, 0)] >= pos - margin
+        hit = np.nonzero((last >= 0) & reach)[0]
+        candidates = zip(hit.tolist(), last[hit].tolist())
+
+    for i, k in candidates:
+        pos = positions[i]
+        while k >= 0 and maxEnds[k] >= pos - margin:
+            if ends[k] >= pos - margin:
+                found[i].append(k)
+            k = k - 1
+    return found
+
+
+### EOF
@@ -0,0 +1,244 @@
+# binning.py
+#
+# UCSC bin index for the reference interval tables
+#
+# A predicate like "chromStart <= pos AND pos <= chromEnd" cannot be
+# answered from a B-tree on (chrom, chromStart), so MySQL scans every row of
+# the chromosome. UCSC tables carry a "bin" column instead: each row sits in
+# the smallest bin of a fixed hierarchy that holds all of it, and only the
+# bins on the path from a position up to the root can hold rows overlapping
+# it. Adding "bin IN (...)" to a query lets it use an index on (chrom, bin).
+#
+# Usage: python binning.py [<table> ...]
+#   adds and backfills a bin column and a (chrom, bin) index on the tables
+#   that lack them
+#
+##
+
+import os
+import sys
+
+if __name__ == "__main__":
+    # The secret cache is shared with the utility scripts, see common/
+    sys.path.insert(
+        1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+    )
+
+import snapshot
+
+"""Bin hierarchy, as in the UCSC kent source (binRange.c)
+
+Standard bins cover coordinates up to 2^29 in 5 levels of 128kb, 1Mb, 8Mb,
+64Mb and 512Mb; extended bins (numbered from 4681) add a 4Gb level for rows
+that end past 2^29.
+"""
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_OFFSETS_EXTENDED = [
+    4096 + 512 + 64 + 8 + 1,
+    512 + 64 + 8 + 1,
+    64 + 8 + 1,
+    8 + 1,
+    1,
+    0,
+]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_OFFSET_OLD_TO_EXTENDED = 4681
+BIN_MAX_STANDARD = 1 << 29
+
+"""Tables given a bin column by main(), with the (chrom, start, end)
+columns their bins are computed from
+
+These are the snapshot tables; gwasCatalog is looked up on chromEnd only
+but its rows still span [chromStart, chromEnd). The tfbsConsSites tables
+hold one chromosome each and are queried without a chrom predicate, so
+their chrom column is None and they are indexed on bin alone.
+"""
+BIN_TABLES = [
+    (
+        table,
+        None if table.startswith("tfbsConsSites") else chrom_col,
+        "chromStart" if start_col == end_col else start_col,
+        end_col,
+    )
+    for (table, chrom_col, start_col, end_col) in snapshot.SNAPSHOT_TABLES
+]
+
+
+"""Bin of the half-open range [start, end)
+
+Zero-length rows (start == end) are binned on start.
+"""
+
+
+def binFromRange(start, end):
+    offsets = BIN_OFFSETS
+    base = 0
+    if end > BIN_MAX_STANDARD:
+        offsets = BIN_OFFSETS_EXTENDED
+        base = BIN_OFFSET_OLD_TO_EXTENDED
+
+    startBin = start >> BIN_FIRST_SHIFT
+    endBin = max(end - 1, start) >> BIN_FIRST_SHIFT
+    for offset in offsets:
+        if startBin == endBin:
+            return base + offset + startBin
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    raise ValueError(f"Range {start}-{end} is out of range for binning")
+
+
+"""All bins that can hold a row overlapping the half-open range [start, end)
+"""
+
+
+def overlappingBins(start, end):
+    start = max(start, 0)
+    end = max(end, start + 1)
+    bins = []
+
+    schemes = [(BIN_OFFSETS_EXTENDED, BIN_OFFSET_OLD_TO_EXTENDED, end)]
+    if start < BIN_MAX_STANDARD:
+        schemes.insert(0, (BIN_OFFSETS, 0, min(end, BIN_MAX_STANDARD)))
+
+    for offsets, base, last in schemes:
+        shift = BIN_FIRST_SHIFT
+        for offset in offsets:
+            first = base + offset + (start >> shift)
+            bins.extend(range(first, base + offset + ((last - 1) >> shift) + 1))
+            shift = shift + BIN_NEXT_SHIFT
+    return bins
+
+
+"""Tables checked for a bin column so far
+"""
+_hasBin = {}
+
+
+def hasBinColumn(cursor, table):
+    if table not in _hasBin:
+        cursor.execute("select * from " + table + " limit 0;")
+        cursor.fetchall()
+        _hasBin[table] = "bin" in [str(d[0]).lower() for d in cursor.description]
+    return _hasBin[table]
+
+
+"""SQL to AND onto a query for the rows of table whose [start, end]
+overlaps [low, high]
+
+Returns "" if table has no bin column. The candidate bins are those of
+[low - 1, high + 1), which also covers rows that end exactly at low and
+zero-length rows.
+"""
+
+
+def rangeClause(cursor, table, low, high):
+    if not hasBinColumn(cursor, table):
+        return ""
+    bins = overlappingBins(int(low) - 1, int(high) + 1)
+    return " AND bin IN (" + ",".join([str(b) for b in bins]) + ")"
+
+
+"""SQL expression computing binFromRange(start_col, end_col) for a row
+"""
+
+
+def binSql(start_col, end_col):
+    last = "GREATEST(" + end_col + " - 1, " + start_col + ")"
+
+    def levels(offsets, base):
+        cases = []
+        shift = BIN_FIRST_SHIFT
+        for offset in offsets[:-1]:
+            cases.append(
+                f"WHEN ({start_col} >> {shift}) = ({last} >> {shift}) "
+                + f"THEN {base + offset} + ({start_col} >> {shift})"
+            )
+            shift = shift + BIN_NEXT_SHIFT
+        return "CASE " + " ".join(cases) + f" ELSE {base + offsets[-1]} END"
+
+    return (
+        f"CASE WHEN {end_col} <= {BIN_MAX_STANDARD} "
+        + f"THEN {levels(BIN_OFFSETS, 0)} "
+        + f"ELSE {levels(BIN_OFFSETS_EXTENDED, BIN_OFFSET_OLD_TO_EXTENDED)} END"
+    )
+
+
+"""Adds a bin column to table if it has none, fills it in, and adds a
+(chrom, bin) index -- or a (bin) index if chrom_col is None -- if no index
+starts with those columns
+
+The column is appended after the existing ones, since the stages read rows
+by column position. Returns a list of what was changed.
+"""
+
+
+def addBinIndex(conn, table, chrom_col, start_col, end_col):
+    cursor = conn.cursor()
+    changes = []
+
+    if not hasBinColumn(cursor, table):
+        cursor.execute(
+            "alter table "
+            + table
+            + " add column bin smallint unsigned not null default 0;"
+        )
+        cursor.execute(
+            "update " + table + " set bin = " + binSql(start_col, end_col) + ";"
+        )
+        _hasBin[table] = True
+        changes.append("bin column")
+
+    cursor.execute("show index from " + table + ";")
+    names = [str(d[0]).lower() for d in cursor.description]
+    key_ind = names.index("key_name")
+    seq_ind = names.index("seq_in_index")
+    col_ind = names.index("column_name")
+    indexes = {}
+    for row in cursor.fetchall():
+        indexes.setdefault(row[key_ind], {})[int(row[seq_ind])] = str(row[col_ind])
+
+    wanted = ["bin"] if chrom_col is None else [chrom_col, "bin"]
+    found = False
+    for columns in indexes.values():
+        prefix = [columns.get(i + 1, "").lower() for i in range(len(wanted))]
+        if prefix == [c.lower() for c in wanted]:
+            found = True
+    if not found:
+        cursor.execute(
+            "create index "
+            + table
+            + "_"
+            + "_".join(wanted)
+            + " on "
+            + table
+            + " ("
+            + ", ".join(wanted)
+            + ");"
+        )
+        changes.append("(" + ", ".join(wanted) + ") index")
+
+    conn.commit()
+    return changes
+
+
+def main():
+    import db_pool
+
+    tables = sys.argv[1:]
+
+    with db_pool.connection() as conn:
+        for table, chrom_col, start_col, end_col in BIN_TABLES:
+            if len(tables) > 0 and table not in tables:
+                continue
+            try:
+                changes = addBinIndex(conn, table, chrom_col, start_col, end_col)
+                print(f"{table}: " + (", ".join(changes) if changes else "unchanged"))
+            except Exception as e:
+                print(f"{table}: skipped ({e})")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
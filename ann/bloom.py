@@ -0,0 +1,210 @@
+# bloom.py
+#
+# Bloom filters over the positions of the point-keyed reference tables
+#
+# Most variant positions have no row in chrom_pos_equal_base or
+# chrom_pos_equal_nobase, and rare ones none in dbSNP either, yet a stage
+# pays a round trip to find that out. main() builds a Bloom filter of the
+# (chrom, pos) keys of each of those tables for one reference version, at
+# a chosen false positive rate; driver.configure loads the filters of the
+# current reference version, and the stages skip the query for a position
+# the filter of its table rules out. A filter never rules out a key it
+# holds, so only the queries that would have come back empty are skipped.
+# Filters of another reference version are not used, since a stale filter
+# could rule out rows that were added since.
+#
+# Usage: python bloom.py <directory> <reference version> [<false positive rate>]
+#
+##
+
+import hashlib
+import math
+import os
+import sys
+
+if __name__ == "__main__":
+    # The secret cache is shared with the utility scripts, see common/
+    sys.path.insert(
+        1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+    )
+
+import reference as rf
+import snapshot
+import utils as u
+
+"""False positive rate filters are built for by default
+"""
+FALSE_POSITIVE_RATE = 0.01
+
+BLOOM_MAGIC = b"GASBLOOM"
+
+
+"""Bloom filter of (chrom, pos) keys over a bit array
+
+Key k sets bits (h1 + i * h2) mod size for i < hashes, where h1 and h2
+are the two halves of the key's BLAKE2b digest. bits is a bytearray while
+the filter is built and a memory-mapped section once it is loaded, so
+annotator processes on the same host share one copy in the page cache.
+"""
+
+
+class BloomFilter(object):
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    def positions(self, chrom, pos):
+        key = (u.text(chrom) + ":" + str(int(pos))).encode("utf-8")
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, chrom, pos):
+        for b in self.positions(chrom, pos):
+            self.bits[b >> 3] = self.bits[b >> 3] | (1 << (b & 7))
+
+    # False only if no row was added at (chrom, pos)
+    def mayContain(self, chrom, pos):
+        for b in self.positions(chrom, pos):
+            if not self.bits[b >> 3] & (1 << (b & 7)):
+                return False
+        return True
+
+
+"""Empty filter sized for count keys at false positive rate rate
+"""
+
+
+def sizedFor(count, rate=FALSE_POSITIVE_RATE):
+    count = max(count, 1)
+    size = max(8, int(math.ceil(-count * math.log(rate) / (math.log(2) ** 2))))
+    hashes = max(1, int(round(size / float(count) * math.log(2))))
+    return BloomFilter(size, hashes)
+
+
+def filterPath(directory, table):
+    return os.path.join(directory, table + ".bloom")
+
+
+"""Builds the filter of table from an RDS cursor and writes it to
+<directory>/<table>.bloom
+
+Keys are streamed from the server fetchSize rows at a time; only the bit
+array is held in memory. Returns the number of keys added.
+"""
+
+
+def buildFilter(cursor, directory, table, chrom_col, pos_col, version, rate):
+    cursor.execute("select count(*) from " + table + ";")
+    count = int(cursor.fetchall()[0][0])
+    bloom = sizedFor(count, rate)
+
+    cursor.execute("select " + chrom_col + ", " + pos_col + " from " + table + ";")
+    added = 0
+    while True:
+        rows = cursor.fetchmany(rf.FETCH_SIZE)
+        if len(rows) == 0:
+            break
+        for chrom, pos in rows:
+            if chrom is None or pos is None:
+                continue
+            bloom.add(chrom, pos)
+            added = added + 1
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    header = {
+        "version": version,
+        "table": table,
+        "byteorder": sys.byteorder,
+        "size": bloom.size,
+        "hashes": bloom.hashes,
+        "keys": added,
+        "rate": rate,
+        "sections": {},
+    }
+    path = filterPath(directory, table)
+    snapshot.writeSections(path + ".tmp", BLOOM_MAGIC, header, [("bits", bloom.bits)])
+    os.replace(path + ".tmp", path)
+    return added
+
+
+"""Filters in use, keyed by table; set by load()
+"""
+filters = {}
+
+
+"""Maps the filters in directory that were built for reference version
+and makes them the ones in use
+"""
+
+
+def load(directory, version):
+    global filters
+    loaded = {}
+    for table, chrom_col, pos_col in rf.POINT_TABLES:
+        path = filterPath(directory, table)
+        if not os.path.isfile(path):
+            continue
+        mapped = snapshot.MappedFile(path, BLOOM_MAGIC)
+        if mapped.header["version"] != str(version):
+            print(
+                f"Bloom filter of {table} is for reference version "
+                + f"{mapped.header['version']}, not {version}; not used"
+            )
+            continue
+        loaded[table] = BloomFilter(
+            mapped.header["size"], mapped.header["hashes"], mapped.section("bits", "B")
+        )
+    filters = loaded
+
+
+"""False if the filter of table rules out a row at (chrom, pos); True if
+there may be one or table has no filter
+"""
+
+
+def mayContain(table, chrom, pos):
+    bloom = filters.get(table)
+    return bloom is None or bloom.mayContain(chrom, pos)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(
+            "Usage: python bloom.py <directory> <reference version> "
+            + "[<false positive rate>]"
+        )
+        sys.exit(1)
+
+    import pymysql
+
+    directory = sys.argv[1]
+    version = sys.argv[2]
+    rate = float(sys.argv[3]) if len(sys.argv) > 3 else FALSE_POSITIVE_RATE
+
+    conn = u.db_connect()
+    for table, chrom_col, pos_col in rf.POINT_TABLES:
+        try:
+            # Unbuffered cursor, so the keys are streamed from the server
+            count = buildFilter(
+                conn.cursor(pymysql.cursors.SSCursor),
+                directory,
+                table,
+                chrom_col,
+                pos_col,
+                version,
+                rate,
+            )
+            print(f"{table}: {count} keys")
+        except Exception as e:
+            print(f"{table}: skipped ({e})")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,164 @@
+# db_pool.py
+#
+# Shared connections to the reference database
+#
+# Opening a MySQL connection (plus the TLS handshake and the Secrets
+# Manager lookup in utils.db_connect) costs more than many of the queries
+# a stage sends, so all stages of a job borrow connections from one pool
+# instead of opening their own. Every job runs in a process of its own (see
+# annotator.py), so connections are reused between the stages and file
+# passes of a job, never from one job to the next.
+#
+##
+
+import threading
+from contextlib import contextmanager
+
+import reference as rf
+import utils as u
+
+"""Number of idle connections kept open between uses
+"""
+POOL_SIZE = 4
+
+
+"""A small pool of reference database connections
+
+acquire() hands out an idle connection after checking it is still alive
+(reconnecting if it is not) or opens a new one; release() returns it.
+Connections are handed back with their read transaction ended, so a stage
+never sees a snapshot left over from an earlier one.
+"""
+
+
+class ConnectionPool(object):
+    def __init__(self, connect=u.db_connect, size=POOL_SIZE):
+        self.connect = connect
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+        self.opened = 0
+        self.acquired = 0
+        self.reconnects = 0
+
+    def open(self):
+        conn = self.connect()
+        with self.lock:
+            self.opened = self.opened + 1
+        return conn
+
+    def acquire(self):
+        conn = None
+        with self.lock:
+            self.acquired = self.acquired + 1
+            if len(self.idle) > 0:
+                conn = self.idle.pop()
+
+        if conn is not None:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                discard(conn)
+                conn = None
+                with self.lock:
+                    self.reconnects = self.reconnects + 1
+
+        if conn is None:
+            conn = self.open()
+        return conn
+
+    def release(self, conn):
+        try:
+            conn.rollback()
+        except Exception:
+            discard(conn)
+            return
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        discard(conn)
+
+    def closeAll(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            discard(conn)
+
+    def stats(self):
+        with self.lock:
+            reused = max(0, self.acquired - self.opened)
+            ratio = (reused / float(self.acquired)) if self.acquired > 0 else 0.0
+            return {
+                "opened": self.opened,
+                "acquired": self.acquired,
+                "reconnects": self.reconnects,
+                "reuse_ratio": round(ratio, 4),
+            }
+
+
+"""Closes a connection, ignoring errors from one that is already broken
+"""
+
+
+def discard(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+"""Process-wide pool, created on first use
+
+Its connections are to the local copy of the reference database if one is
+configured (see reference.connect), to RDS otherwise.
+"""
+
+
+def getPool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(connect=rf.connect)
+        return _pool
+
+
+"""Drops the process-wide pool without closing its connections
+
+Called at the start of a worker process: connections inherited from the
+parent share its sockets, so the worker must neither use nor close them.
+"""
+
+
+def reset():
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+"""Borrows a connection from the process-wide pool for a with-block
+
+A connection that raised inside the block is closed rather than reused.
+"""
+
+
+@contextmanager
+def connection():
+    pool = getPool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    except Exception:
+        discard(conn)
+        raise
+    else:
+        pool.release(conn)
+
+
+### EOF
@@ -12,168 +12,854 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import sys
 import os
+import io
+import contextlib
+import hashlib
+import json
+import multiprocessing
 import file_utils as fu
 import annotate as ann
+import bloom
+import db_pool
+import intervals as iv
+import planner
+import query_cache as qc
+import reference as rf
+import stage_store as ss
 
 
-def run(infile, format):
+"""Annotation stages in pipeline order: stage class, keyword arguments
+and the label printed once the stage is done
+"""
+STAGES = [
+    (ann.DbSnpStage, {}, "dbSNP"),
+    (ann.BigRefGeneStage, {}, "BigRefGene"),
+    (ann.GeneStage, {"table": "refGene", "promoter_offset": 500}, "refGene"),
+    (ann.CytobandStage, {"table": "cytoBand"}, "Cytoband"),
+    (ann.GadAllStage, {"table": "gadAll"}, "gadAll"),
+    (ann.GwasCatalogStage, {"table": "gwasCatalog"}, "GwasCatalog"),
+    (ann.MiRNAStage, {"table": "targetScanS"}, "miRNA"),
+    (ann.HugoStage, {"table": "hugo"}, "HUGO Gene Nomenclature Committee"),
+    (ann.CnvTablesStage, {"tables": ann.CNV_TABLES}, ", ".join(ann.CNV_TABLES)),
+    (ann.GenomicSuperDupsStage, {"table": "genomicSuperDups"}, "genomicSuperDups"),
+    (ann.TfbsConsSitesStage, {"table": "tfbsConsSites"}, "addOverlapWithTfbsConsSites"),
+]
 
-    print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
+"""Labels of the stages whose output each stage reads, by stage label
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+dbSNP may replace INFO outright and BigRefGene drops the "." it may start
+with, so each depends on the stage before it; refGene parses positionType
+and name out of the INFO written by BigRefGene. The region stages after it
+only append to INFO and are independent of each other.
+"""
+STAGE_DEPENDENCIES = dict(
+    [("dbSNP", []), ("BigRefGene", ["dbSNP"]), ("refGene", ["BigRefGene"])]
+    + [(label, ["refGene"]) for (stage_class, kwargs, label) in STAGES[3:]]
+)
+
+
+"""Stage indices grouped into waves of consecutive stages that depend on
+no stage of their own wave
+
+A new wave starts at a stage that depends on a stage of the current one,
+so running the waves in turn keeps the stages in pipeline order.
+"""
+
+
+def stageWaves():
+    waves = []
+    current = []
+    for k, (stage_class, kwargs, label) in enumerate(STAGES):
+        labels = [STAGES[j][2] for j in current]
+        if any(dep in labels for dep in STAGE_DEPENDENCIES.get(label, labels)):
+            waves.append(current)
+            current = []
+        current.append(k)
+    if len(current) > 0:
+        waves.append(current)
+    return waves
+
+
+"""Connection of each stage of STAGES when the stages of each wave run
+threads at a time, taken from conns
+
+Stage j of a wave runs in task j % threads (see annotate.annotateWave), so
+it gets conns[j % threads]; stages that share a connection never run at
+the same time. Needs min(threads, size of the largest wave) connections.
+"""
+
+
+def waveConnections(waves, conns, threads):
+    stageConns = [None] * len(STAGES)
+    for wave in waves:
+        for j, k in enumerate(wave):
+            stageConns[k] = conns[(j % threads) % len(conns)]
+    return stageConns
+
+
+"""Maximum number of lines per chunk when annotating with several workers
+"""
+CHUNK_LINES = 100000
+
+
+"""Creates one instance of every stage, each with its own cursor on conn,
+or on its own connection if conn is a list of one connection per stage
+"""
+
+
+def makeStages(conn, format, options):
+    conns = conn if isinstance(conn, list) else [conn] * len(STAGES)
+    return [
+        stage_class(
+            c.cursor() if c is not None else None,
+            format=format,
+            **stageOptions(options, label),
+            **kwargs,
+        )
+        for (stage_class, kwargs, label), c in zip(STAGES, conns)
+    ]
+
+
+"""Options that hold the planner's results rather than stage options
+"""
+PLAN_OPTIONS = ("plans", "planLog")
+
+
+"""Options of the stage labelled label: the run's options, with the lookup
+options the planner picked for the stage (see planOptions) in place of the
+run-wide ones
+"""
+
+
+def stageOptions(options, label):
+    merged = dict(
+        (name, options[name]) for name in options if name not in PLAN_OPTIONS
     )
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    merged.update(options.get("plans", {}).get(label, {}))
+    return merged
+
+
+"""Has the planner pick the lookup strategies of every stage for infile
+(see planner.py) and adds them to options under "plans", and the lines
+describing them under "planLog" (see writePlanLog)
+"""
+
+
+def planOptions(infile, options, batchSize):
+    stats = planner.scanInput(infile)
+    with db_pool.connection() as conn:
+        options["plans"], options["planLog"] = planner.plan(
+            STAGES,
+            stats,
+            rf.reader(conn.cursor()),
+            batchSize,
+            options.get("window", 1),
+        )
+    return options
+
+
+"""Runs the pipeline
+
+With fused=True every record goes through all stages in memory in a
+single pass over the input; otherwise each stage reads the previous
+stage's temp file (.1, .2, ...) and writes the next one. With indexed=True
+the region stages load their tables into memory instead of sending one
+query per variant; with batched=True dbSNP is queried once per batch of
+batchSize variants. With sweep=True a coordinate-sorted input has each
+region table read once per chromosome and merge-walked against the
+variants; unsorted input falls back to per-variant queries. With workers > 1
+the input is split into chunks that are annotated in parallel by that many
+processes (see runParallel). snapshotDir points the indexed lookups at
+reference snapshots built by snapshot.py; only those built for the
+version in referenceVersionFile are used. queryCache is the path of the
+host's query cache (see query_cache.py), which keeps up to
+queryCacheEntries lookup results for as long as the reference version
+named in referenceVersionFile stays the same; its hit, miss and eviction
+counts are added to the .count.log file. Without a readable version file
+the query cache is not used. With a stageStore directory the
+staged pipeline keeps every stage's output there, so that reannotate() can
+later re-run only the stages from a refreshed table on; the staged
+pipeline is then run whatever fused and workers are. With fused=True
+and stageThreads > 1, independent stages (see STAGE_DEPENDENCIES) annotate
+each batch at the same time in a pool of that many threads. With
+lookupWindow > 1, stages that query per variant keep up to that many of
+the lookups of a batch in flight at once (see lookup_engine.py). With a
+referenceDb file, the stages look up a local copy of the reference tables
+built by reference.py instead of the RDS database. bloomFilterDir holds
+the Bloom filters built by bloom.py; point lookups the filter of their
+table rules out are not sent. With planned=True, indexed, batched and
+sweep are ignored: the planner picks the lookup strategy of each stage,
+and of each chromosome, from the input and the size of the stage's
+tables (see planner.py).
+"""
+
+
+def run(
+    infile,
+    format,
+    fused=False,
+    indexed=False,
+    batched=False,
+    batchSize=ann.BATCH_SIZE,
+    sweep=False,
+    workers=1,
+    chunkLines=CHUNK_LINES,
+    snapshotDir=None,
+    queryCache=None,
+    queryCacheEntries=qc.MAX_ENTRIES,
+    referenceVersionFile=None,
+    stageStore=None,
+    stageThreads=1,
+    lookupWindow=1,
+    referenceDb=None,
+    bloomFilterDir=None,
+    planned=False,
+):
+
+    print("Running . . .")
+
+    finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
+
+    configure(
+        snapshotDir,
+        queryCache,
+        queryCacheEntries,
+        referenceVersionFile,
+        referenceDb,
+        bloomFilterDir,
     )
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+
+    windows = None
+    if sweep and not planned:
+        windows = ann.scanSortedWindows(infile, format=format)
+        if windows is None:
+            print("Input is not coordinate-sorted, sweep disabled.")
+
+    options = {
+        "indexed": indexed,
+        "batched": batched,
+        "sweep": windows,
+        "window": lookupWindow,
+    }
+    if planned:
+        planOptions(infile, options, batchSize)
+
+    version = qc.readVersion(referenceVersionFile)
+
+    if stageStore is not None and (fused or workers > 1):
+        print("Stage store set, running the staged pipeline.")
+        fused = False
+        workers = 1
+
+    if workers > 1:
+        counters = runParallel(
+            infile, finalout, format, options, batchSize, workers, chunkLines
+        )
+        writeCounts(infile, version, counters)
+        writePlanLog(infile, options)
+        print("Parallel pipeline - done.")
+        return
+
+    if fused:
+        if stageThreads > 1:
+            # Stages running at the same time need connections of their own
+            waves = stageWaves()
+            count = min(stageThreads, max([len(wave) for wave in waves]))
+            with contextlib.ExitStack() as stack:
+                conns = [
+                    stack.enter_context(db_pool.connection()) for i in range(count)
+                ]
+                stages = makeStages(
+                    waveConnections(waves, conns, stageThreads), format, options
+                )
+                ann.runPipeline(
+                    stages,
+                    infile,
+                    finalout,
+                    batchSize=batchSize,
+                    waves=waves,
+                    threads=stageThreads,
+                )
+        else:
+            with db_pool.connection() as conn:
+                stages = makeStages(conn, format, options)
+                ann.runPipeline(stages, infile, finalout, batchSize=batchSize)
+        writeCounts(infile, version, [stage.counterValues() for stage in stages])
+        writePlanLog(infile, options)
+        writeCacheStats(infile)
+        print("Fused pipeline - done.")
+        printPoolStats()
+        return
+
+    manifest = None
+    if stageStore is not None:
+        manifest = ss.newManifest()
+    counters = runStages(
+        infile, finalout, format, options, batchSize, 0, stageStore, manifest
     )
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    writeCounts(infile, version, counters)
+    writePlanLog(infile, options)
+    writeCacheStats(infile)
+    printPoolStats()
+
+
+"""Sets up the reference database, its snapshots, the query cache and the
+Bloom filters for a run
+"""
+
+
+def configure(
+    snapshotDir,
+    queryCache,
+    queryCacheEntries,
+    referenceVersionFile,
+    referenceDb=None,
+    bloomFilterDir=None,
+):
+    if referenceDb != rf.localDb:
+        # Idle connections of the pool are to the other database
+        db_pool.getPool().closeAll()
+        rf.localDb = referenceDb
+    version = qc.readVersion(referenceVersionFile)
+    iv.snapshotDir = snapshotDir
+    iv.snapshotVersion = version
+    if snapshotDir is not None and version is None:
+        print("Reference version unknown, snapshots not used.")
+        iv.snapshotDir = None
+    qc.cache = None
+    if queryCache is not None:
+        if version is None:
+            print("Reference version unknown, query cache disabled.")
+        else:
+            qc.cache = qc.QueryCache(queryCache, version, queryCacheEntries)
+    bloom.filters = {}
+    if bloomFilterDir is not None:
+        if version is None:
+            print("Reference version unknown, Bloom filters not used.")
+        else:
+            bloom.load(bloomFilterDir, version)
+
+
+"""Runs STAGES[first:] one file pass at a time and renames the last output
+to finalout
+
+Stage N reads <infile>.N (the input itself for N = 0) and writes
+<infile>.N+1. With a stageStore directory, every stage output and the
+.count.log after it are stored there and recorded in manifest, which is
+saved under the input's digest. Returns the counters of the stages run.
+"""
+
+
+def runStages(
+    infile, finalout, format, options, batchSize, first, stageStore, manifest
+):
+    store = None
+    if stageStore is not None:
+        store = ss.StageStore(stageStore)
+        for name in manifest:
+            manifest[name] = manifest[name][:first]
+
+    counters = []
+    tmpextin = "" if first == 0 else "." + str(first)
+    for i in range(first, len(STAGES)):
+        stage_class, kwargs, label = STAGES[i]
+        tmpextout = "." + str(i + 1)
+        with db_pool.connection() as conn:
+            stage = stage_class(
+                conn.cursor(),
+                format=format,
+                **stageOptions(options, label),
+                **kwargs,
+            )
+            ann.runStage(
+                stage,
+                infile,
+                tmpextin=tmpextin,
+                tmpextout=tmpextout,
+                batchSize=batchSize,
+            )
+        print(label + " - done.")
+        tmpextin = tmpextout
+        counters.append(stage.counterValues())
+
+        if store is not None:
+            manifest["labels"].append(label)
+            manifest["outputs"].append(store.put(infile + tmpextout))
+            manifest["logs"].append(store.put(infile + ".count.log"))
+            manifest["counters"].append(counters[-1])
+
+    if store is not None:
+        store.putManifest(ss.fileDigest(infile), manifest)
+
+    ## Cleanup
+    for i in range(1, len(STAGES)):
+        fu.delete(infile + "." + str(i))
+
+    os.rename(infile + tmpextin, infile + ".annot")
+    os.rename(infile + ".annot", finalout)
+    return counters
+
+
+"""Re-runs the pipeline on infile from the stage labelled fromLabel on,
+after that stage's reference table has been refreshed
+
+The output of the stage before it, and the .count.log up to there, are
+taken from the manifest that an earlier staged run with the same
+stageStore saved for infile; the stages from fromLabel on are run as in
+run() and their outputs replace the stored ones, and <infile>.counts.json
+is rewritten. If nothing usable is stored for infile, all stages are run.
+Stages run one file pass at a time, as in the staged pipeline, so there is
+no stageThreads; lookupWindow is as in run().
+"""
+
+
+def reannotate(
+    infile,
+    format,
+    fromLabel,
+    stageStore,
+    indexed=False,
+    batched=False,
+    batchSize=ann.BATCH_SIZE,
+    sweep=False,
+    snapshotDir=None,
+    queryCache=None,
+    queryCacheEntries=qc.MAX_ENTRIES,
+    referenceVersionFile=None,
+    referenceDb=None,
+    bloomFilterDir=None,
+    planned=False,
+    lookupWindow=1,
+):
+
+    labels = [label for (stage_class, kwargs, label) in STAGES]
+    if fromLabel not in labels:
+        raise ValueError(
+            f"Unknown stage {fromLabel}; stages are: " + ", ".join(labels)
+        )
+    first = labels.index(fromLabel)
+
+    print(f"Re-annotating from {fromLabel} . . .")
+
+    finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
+    configure(
+        snapshotDir,
+        queryCache,
+        queryCacheEntries,
+        referenceVersionFile,
+        referenceDb,
+        bloomFilterDir,
     )
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
-        format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+
+    store = ss.StageStore(stageStore)
+    manifest = store.manifest(ss.fileDigest(infile))
+    if first > 0 and (
+        manifest is None
+        or manifest["labels"][:first] != labels[:first]
+        or not store.has(manifest["outputs"][first - 1])
+        or not store.has(manifest["logs"][first - 1])
+        or len(manifest.get("counters", [])) < first
+    ):
+        print("No stored intermediates for this input, running all stages.")
+        first = 0
+        manifest = None
+    if manifest is None:
+        manifest = ss.newManifest()
+
+    if first > 0:
+        store.get(manifest["outputs"][first - 1], infile + "." + str(first))
+        store.get(manifest["logs"][first - 1], infile + ".count.log")
+
+    windows = None
+    if sweep and not planned:
+        windows = ann.scanSortedWindows(infile, format=format)
+
+    options = {
+        "indexed": indexed,
+        "batched": batched,
+        "sweep": windows,
+        "window": lookupWindow,
+    }
+    if planned:
+        planOptions(infile, options, batchSize)
+    counters = manifest["counters"][:first] + runStages(
+        infile, finalout, format, options, batchSize, first, stageStore, manifest
     )
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    writeCounts(infile, qc.readVersion(referenceVersionFile), counters)
+    writePlanLog(infile, options)
+    writeCacheStats(infile)
+    printPoolStats()
+
+
+"""Writes the stage counters of a run on infile to <infile>.counts.json,
+with the reference version and stage labels they hold for, so that a
+later runDelta() against infile can start from them
+
+A referenceVersion of None is written as null, which runDelta() never
+starts from.
+"""
+
+
+def writeCounts(infile, referenceVersion, counters):
+    fh = open(infile + ".counts.json", "w")
+    json.dump(
+        {
+            "version": referenceVersion,
+            "labels": [label for (stage_class, kwargs, label) in STAGES],
+            "counters": counters,
+        },
+        fh,
     )
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    fh.close()
 
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + "." + str(i))
 
-    os.rename(infile + "." + str(tmpextin), infile + ".annot")
+"""Lines of the file at path, stripped as the pipeline reads them, or with
+only their line ends removed if strip=False
+"""
+
+
+def readLines(path, strip=True):
+    fh = open(path)
+    if strip:
+        lines = [line.strip() for line in fh]
+    else:
+        lines = [line.rstrip("\n") for line in fh]
+    fh.close()
+    return lines
+
+
+"""For each line of lines, the index of an identical line of prevLines,
+or None; each line of prevLines is matched at most once, in order
+"""
+
+
+def matchLines(lines, prevLines):
+    positions = {}
+    for j in range(len(prevLines) - 1, -1, -1):
+        positions.setdefault(prevLines[j], []).append(j)
+
+    matches = []
+    for line in lines:
+        js = positions.get(line)
+        matches.append(js.pop() if js else None)
+    return matches
+
+
+"""Fraction of the lines of infile and prevInput, whichever has more, that
+are shared by both
+"""
+
+
+def lineOverlap(infile, prevInput):
+    lines = readLines(infile)
+    prevLines = readLines(prevInput)
+    if max(len(lines), len(prevLines)) == 0:
+        return 0.0
+    shared = len([m for m in matchLines(lines, prevLines) if m is not None])
+    return shared / float(max(len(lines), len(prevLines)))
+
+
+"""Annotates infile from the results of an earlier run on prevInput
+
+Lines of infile that are also in prevInput are copied from prevOutput, the
+annotated output of that run; only the new lines are annotated, with
+run() and the given options. Each line is annotated on its own, so the
+output is the same as a full run. So is the .count.log, since the stage
+counters are sums over lines: they are the counters of the earlier run,
+read from prevCounts (its .counts.json), minus those of the lines that were
+dropped -- which are annotated too, for their counters only -- plus those
+of the new lines. Raises ValueError if the reference version of either run
+is unknown, the earlier run used another reference version or stage list,
+or prevOutput does not match prevInput.
+"""
+
+
+def runDelta(infile, format, prevInput, prevOutput, prevCounts, **options):
+
+    print("Running delta . . .")
+
     finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
-    os.rename(infile + ".annot", finalout)
+    version = qc.readVersion(options.get("referenceVersionFile"))
+    labels = [label for (stage_class, kwargs, label) in STAGES]
+
+    fh = open(prevCounts)
+    prev = json.load(fh)
+    fh.close()
+    if version is None or prev["version"] is None:
+        raise ValueError("Reference version unknown")
+    if prev["version"] != version or prev["labels"] != labels:
+        raise ValueError("Earlier run used another reference version or stages")
+
+    lines = readLines(infile)
+    prevLines = readLines(prevInput)
+    prevOut = readLines(prevOutput, strip=False)
+    if len(prevOut) != len(prevLines):
+        raise ValueError("Earlier output does not match its input")
+
+    matches = matchLines(lines, prevLines)
+    added = [line for line, m in zip(lines, matches) if m is None]
+    kept = set(matches)
+    removed = [line for j, line in enumerate(prevLines) if j not in kept]
+    print(
+        f"{len(lines) - len(added)} lines unchanged, {len(added)} new, "
+        + f"{len(removed)} dropped"
+    )
+
+    # The parts are not worth keeping intermediates of
+    options = dict(options, stageStore=None)
+
+    # Stages without a cursor, only used to add up and write the counters
+    stages = makeStages(None, format, {})
+    for stage, values in zip(stages, prev["counters"]):
+        stage.addCounters(values)
+
+    cacheStats = None
+    annotated = []
+    for part, partLines, sign in [("added", added, 1), ("removed", removed, -1)]:
+        if len(partLines) == 0:
+            continue
+        partfile = infile + "." + part + ".vcf"
+        fh_part = open(partfile, "w")
+        for line in partLines:
+            fh_part.write(line + "\n")
+        fh_part.close()
+
+        run(partfile, format, **options)
+        if qc.cache is not None:
+            cacheStats = addCacheStats(cacheStats, qc.cache.stats())
+
+        partout = (partfile + ".annot").replace(".vcf.annot", ".annot.vcf")
+        fh_part = open(partfile + ".counts.json")
+        counters = json.load(fh_part)["counters"]
+        fh_part.close()
+        for stage, values in zip(stages, counters):
+            stage.addCounters(values if sign > 0 else negateCounters(values))
+        if sign > 0:
+            annotated = readLines(partout, strip=False)
+        for path in [partfile, partout, partfile + ".count.log"]:
+            fu.delete(path)
+        fu.delete(partfile + ".counts.json")
+
+    fh_out = open(finalout, "w")
+    new = iter(annotated)
+    for m in matches:
+        fh_out.write((prevOut[m] if m is not None else next(new)) + "\n")
+    fh_out.close()
+
+    fh_log = open(infile + ".count.log", "w")
+    for stage in stages:
+        stage.writeLog(fh_log)
+    if cacheStats is not None:
+        qc.writeLog(fh_log, cacheStats)
+    fh_log.close()
+    writeCounts(infile, version, [stage.counterValues() for stage in stages])
+    print("Delta pipeline - done.")
+
+
+"""Counters with every value negated, for subtracting them with
+addCounters()
+"""
+
+
+def negateCounters(values):
+    if isinstance(values, list):
+        return [negateCounters(v) for v in values]
+    return dict((name, -value) for name, value in values.items())
+
+
+"""Byte ranges (start, end) of the chunks of infile
+
+A chunk ends where the chromosome changes or after chunkLines lines, so a
+chromosome of a sorted input is only split when it is longer than that.
+Header lines go with the first chunk.
+"""
+
+
+def splitChunks(infile, chunkLines=CHUNK_LINES):
+    chunks = []
+    start = 0
+    offset = 0
+    count = 0
+    chrom = None
+
+    fh = open(infile, "rb")
+    for line in fh:
+        if not line.startswith(b"#"):
+            c = line.split(b"\t", 1)[0]
+            if count > 0 and (c != chrom or count >= chunkLines):
+                chunks.append((start, offset))
+                start = offset
+                count = 0
+            chrom = c
+            count = count + 1
+        offset = offset + len(line)
+    fh.close()
+
+    if offset > start:
+        chunks.append((start, offset))
+    return chunks
+
+
+"""Annotates one chunk with all stages, writes it to partfile and returns
+the counters of every stage and the query cache counts of the chunk
+"""
+
+
+def annotateChunk(task):
+    infile, start, end, partfile, format, options, batchSize = task
+
+    fh = open(infile, "rb")
+    fh.seek(start)
+    data = fh.read(end - start).decode()
+    fh.close()
+
+    if qc.cache is not None:
+        qc.cache.resetStats()
+
+    with db_pool.connection() as conn:
+        stages = makeStages(conn, format, options)
+        fh_out = open(partfile, "w")
+        for lines in ann.readBatches(io.StringIO(data, newline=None), batchSize):
+            for line in ann.annotateLines(stages, lines):
+                fh_out.write(line + "\n")
+        fh_out.close()
+        for stage in stages:
+            stage.close()
+
+    cacheStats = None
+    if qc.cache is not None:
+        qc.cache.commit()
+        cacheStats = qc.cache.stats()
+    return [stage.counterValues() for stage in stages], cacheStats
+
+
+"""Annotates the chunks of infile in a pool of worker processes
+
+Each worker has its own reference DB connections. The annotated chunks are
+concatenated in input order and the stage counters of all chunks are added
+up, so the output and .count.log are the same as a single-process run.
+Returns the added up counters.
+"""
+
+
+def runParallel(infile, finalout, format, options, batchSize, workers, chunkLines):
+    chunks = splitChunks(infile, chunkLines)
+    tasks = [
+        (infile, start, end, infile + ".part" + str(i), format, options, batchSize)
+        for i, (start, end) in enumerate(chunks)
+    ]
+    print(f"Annotating {len(tasks)} chunks with {workers} workers")
+
+    try:
+        with multiprocessing.Pool(workers, initializer=db_pool.reset) as pool:
+            results = pool.map(annotateChunk, tasks, chunksize=1)
+
+        fh_out = open(finalout, "w")
+        for task in tasks:
+            fh_part = open(task[3])
+            for line in fh_part:
+                fh_out.write(line)
+            fh_part.close()
+        fh_out.close()
+    finally:
+        for task in tasks:
+            fu.delete(task[3])
+
+    # Stages without a cursor, only used to add up and write the counters
+    stages = makeStages(None, format, {})
+    cacheStats = None
+    for counters, chunkStats in results:
+        for stage, values in zip(stages, counters):
+            stage.addCounters(values)
+        cacheStats = addCacheStats(cacheStats, chunkStats)
+
+    fh_log = open(infile + ".count.log", "w")
+    for stage in stages:
+        stage.writeLog(fh_log)
+    if cacheStats is not None:
+        qc.writeLog(fh_log, cacheStats)
+    fh_log.close()
+    return [stage.counterValues() for stage in stages]
+
+
+"""Sum of two sets of query cache counts, either of which may be None
+"""
+
+
+def addCacheStats(total, stats):
+    if stats is None:
+        return total
+    if total is None:
+        return dict(stats)
+    return dict((name, total[name] + stats[name]) for name in total)
+
+
+"""Adds the plans the planner picked for the run, if any, to the .count.log
+file of infile
+"""
+
+
+def writePlanLog(infile, options):
+    if "planLog" not in options:
+        return
+    fh_log = open(infile + ".count.log", "a")
+    planner.writeLog(fh_log, options["planLog"])
+    fh_log.close()
+
+
+"""Saves the query cache, if any, and adds its counts to the .count.log
+file of infile
+"""
+
+
+def writeCacheStats(infile):
+    if qc.cache is None:
+        return
+    qc.cache.commit()
+    fh_log = open(infile + ".count.log", "a")
+    qc.writeLog(fh_log, qc.cache.stats())
+    fh_log.close()
+
+
+"""Content hash of infile, the reference version and the stage list
+
+Jobs with the same hash produce the same output and stage counts in the
+.count.log, whatever the lookup options (fused, indexed, ...), which do
+not change either; only the lines on how the lookups went may differ.
+Returns None if the reference version is unknown (see qc.readVersion),
+since results of an unknown reference must not be reused.
+"""
+
+
+def inputHash(infile, referenceVersion):
+    if referenceVersion is None:
+        return None
+    digest = hashlib.sha256()
+    digest.update(str(referenceVersion).encode() + b"\n")
+    for stage_class, kwargs, label in STAGES:
+        digest.update(
+            repr((stage_class.__name__, sorted(kwargs.items()))).encode() + b"\n"
+        )
+
+    fh = open(infile, "rb")
+    for block in iter(lambda: fh.read(1 << 20), b""):
+        digest.update(block)
+    fh.close()
+    return digest.hexdigest()
+
+
+"""Prints how often reference database connections were reused
+"""
+
+
+def printPoolStats():
+    stats = db_pool.getPool().stats()
+    print(
+        f"Reference DB connections opened: {stats['opened']}, "
+        + f"reused: {stats['reuse_ratio'] * 100:.1f}%, "
+        + f"reconnects: {stats['reconnects']}"
+    )
 
 
 ### EOF
@@ -0,0 +1,269 @@
+# intervals.py
+#
+# In-memory interval index for the reference region tables
+#
+# Region stages ask "which rows of <table> on <chrom> have
+# start <= pos <= end" once per variant. The tables are small next to a
+# VCF, so we read each one once and answer those questions in memory.
+#
+##
+
+from array import array
+from bisect import bisect_right
+
+import batch
+import snapshot
+import utils as u
+
+"""Index over the rows of one table, grouped by chromosome
+
+Rows on a chromosome are sorted by start. maxEnds[k] is the largest end
+among the first k + 1 rows, so a query walks back from the last row that
+starts at or before pos and stops as soon as no earlier row can reach pos.
+Matches are returned in the order the rows were loaded; tables loaded
+with reference.rows() come in the order snapshot.rowOrder fixes, which is
+the order the equivalent SQL query returns them in. With a margin, rows
+match if they come within margin of pos, i.e. start - margin <= pos <= end
++ margin.
+"""
+
+
+class IntervalIndex(object):
+    def __init__(self, rows, chrom_ind, start_ind, end_ind):
+        by_chrom = {}
+        for ordinal, row in enumerate(rows):
+            # NULL coordinates never satisfy the SQL range predicate
+            if row[chrom_ind] is None or row[start_ind] is None or row[end_ind] is None:
+                continue
+            by_chrom.setdefault(u.text(row[chrom_ind]), []).append(
+                (int(row[start_ind]), int(row[end_ind]), ordinal, row)
+            )
+
+        self.chroms = {}
+        for chrom, entries in by_chrom.items():
+            entries.sort(key=lambda e: (e[0], e[2]))
+            starts = []
+            maxEnds = []
+            maxEnd = None
+            for e in entries:
+                if maxEnd is None or e[1] > maxEnd:
+                    maxEnd = e[1]
+                starts.append(e[0])
+                maxEnds.append(maxEnd)
+            self.chroms[chrom] = (starts, maxEnds, entries)
+        # Search columns for overlappingMany(), made on first use
+        self.columns = {}
+
+    def overlapping(self, chrom, pos, margin=0):
+        if chrom not in self.chroms:
+            return []
+
+        pos = int(pos)
+        starts, maxEnds, entries = self.chroms[chrom]
+        hits = []
+        k = bisect_right(starts, pos + margin) - 1
+        while k >= 0 and maxEnds[k] >= pos - margin:
+            if entries[k][1] >= pos - margin:
+                hits.append(entries[k])
+            k = k - 1
+
+        hits.sort(key=lambda e: e[2])
+        return [e[3] for e in hits]
+
+    # overlapping() for a list of positions on chrom, one list of rows each
+    def overlappingMany(self, chrom, positions, margin=0):
+        if chrom not in self.chroms:
+            return [[] for p in positions]
+
+        if chrom not in self.columns:
+            starts, maxEnds, entries = self.chroms[chrom]
+            self.columns[chrom] = (
+                batch.column(starts),
+                batch.column([e[1] for e in entries]),
+                batch.column(maxEnds),
+            )
+        starts, ends, maxEnds = self.columns[chrom]
+        entries = self.chroms[chrom][2]
+
+        found = batch.matchesMany(starts, ends, maxEnds, positions, margin)
+        return [
+            [entries[k][3] for k in sorted(ks, key=lambda k: entries[k][2])]
+            for ks in found
+        ]
+
+
+"""Rows of one chromosome with their coordinates in typed arrays
+
+Same lookup as IntervalIndex, for tables that are loaded one chromosome at
+a time: starts, ends and running maximum ends are int64 arrays sorted by
+start, and rows are only touched to return the matches, in load order.
+"""
+
+
+class IntervalArray(object):
+    def __init__(self, rows, start_ind, end_ind):
+        entries = []
+        for ordinal, row in enumerate(rows):
+            if row[start_ind] is None or row[end_ind] is None:
+                continue
+            entries.append((int(row[start_ind]), ordinal))
+        entries.sort()
+
+        self.starts = array("q")
+        self.ends = array("q")
+        self.maxEnds = array("q")
+        self.rows = []
+        maxEnd = None
+        for start, ordinal in entries:
+            row = rows[ordinal]
+            end = int(row[end_ind])
+            if maxEnd is None or end > maxEnd:
+                maxEnd = end
+            self.starts.append(start)
+            self.ends.append(end)
+            self.maxEnds.append(maxEnd)
+            self.rows.append((ordinal, row))
+
+    def overlapping(self, pos):
+        pos = int(pos)
+        hits = []
+        k = bisect_right(self.starts, pos) - 1
+        while k >= 0 and self.maxEnds[k] >= pos:
+            if self.ends[k] >= pos:
+                hits.append(self.rows[k])
+            k = k - 1
+
+        hits.sort(key=lambda h: h[0])
+        return [h[1] for h in hits]
+
+
+"""Sweep-line walk over the rows of one chromosome
+
+For coordinate-sorted input: rows are sorted by start once, and each query
+only adds the rows that start at or before pos to the active list and drops
+the ones that end before it. Positions must not go down between queries;
+overlapping() returns None if they do so the caller can fall back to SQL.
+"""
+
+
+class IntervalSweep(object):
+    def __init__(self, rows, start_ind, end_ind):
+        self.entries = []
+        for ordinal, row in enumerate(rows):
+            if row[start_ind] is None or row[end_ind] is None:
+                continue
+            self.entries.append((int(row[start_ind]), int(row[end_ind]), ordinal, row))
+        self.entries.sort(key=lambda e: (e[0], e[2]))
+
+        self.next = 0
+        self.active = []
+        self.last = None
+
+    def overlapping(self, pos):
+        pos = int(pos)
+        if self.last is not None and pos < self.last:
+            return None
+        self.last = pos
+
+        while self.next < len(self.entries) and self.entries[self.next][0] <= pos:
+            self.active.append(self.entries[self.next])
+            self.next = self.next + 1
+        self.active = [e for e in self.active if e[1] >= pos]
+
+        return [e[3] for e in sorted(self.active, key=lambda e: e[2])]
+
+
+"""Rows of one table keyed on (chrom, pos), for equality lookups
+
+Rows at a key are kept in the order they were loaded. columns holds the
+table's column names so callers can find other columns of the rows.
+"""
+
+
+class PointIndex(object):
+    def __init__(self, rows, columns, chrom_ind, pos_ind):
+        self.columns = columns
+        self.rows = {}
+        for row in rows:
+            if row[chrom_ind] is None or row[pos_ind] is None:
+                continue
+            key = (u.text(row[chrom_ind]), int(row[pos_ind]))
+            self.rows.setdefault(key, []).append(row)
+
+    def at(self, chrom, pos):
+        return self.rows.get((chrom, int(pos)), [])
+
+    def column(self, name):
+        return [c.lower() for c in self.columns].index(name.lower())
+
+
+"""Indexes loaded so far, keyed by table and column names
+"""
+_indexes = {}
+
+"""Directory of reference snapshots built by snapshot.py, or None, and the
+reference version they must have been built for
+"""
+snapshotDir = None
+snapshotVersion = None
+
+
+"""Loads table once through reference (see reference.py) and returns its
+interval index
+
+The index is kept for the life of the process, so every stage (and every
+file pass in staged mode) that asks for the same table shares one copy.
+If snapshotDir holds a snapshot of the table for snapshotVersion, that is
+mapped instead of reading the table from the database.
+"""
+
+
+def getIndex(reference, table, chrom_col, start_col, end_col):
+    key = (table, chrom_col, start_col, end_col)
+    if key not in _indexes and snapshotDir is not None:
+        index = snapshot.openTable(
+            snapshotDir, table, chrom_col, start_col, end_col, snapshotVersion
+        )
+        if index is not None:
+            _indexes[key] = index
+    if key not in _indexes:
+        _indexes[key] = IntervalIndex(
+            reference.rows(table),
+            reference.column(table, chrom_col),
+            reference.column(table, start_col),
+            reference.column(table, end_col),
+        )
+    return _indexes[key]
+
+
+"""Loads table once and returns its rows keyed on (chrom_col, pos_col)
+"""
+
+
+def getPointIndex(reference, table, chrom_col, pos_col):
+    key = (table, chrom_col, pos_col)
+    if key not in _indexes:
+        _indexes[key] = PointIndex(
+            reference.rows(table),
+            reference.names(table),
+            reference.column(table, chrom_col),
+            reference.column(table, pos_col),
+        )
+    return _indexes[key]
+
+
+"""Reads the rows of table on chrom that overlap window = (min, max) with a
+single range query and returns a sweep over them
+"""
+
+
+def getSweep(reference, table, chrom, window, chrom_col, start_col, end_col):
+    rows = reference.overlapping(
+        table, chrom_col, start_col, end_col, chrom, window[0], window[1]
+    )
+    return IntervalSweep(
+        rows, reference.column(table, start_col), reference.column(table, end_col)
+    )
+
+
+### EOF
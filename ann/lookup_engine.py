@@ -0,0 +1,202 @@
+# lookup_engine.py
+#
+# Makes the per-variant lookups of a stage ahead of it, several at a time
+#
+# A stage that queries per variant waits out a round trip to the reference
+# database for every distinct position. Before a batch is annotated, the
+# engine collects the lookups annotate() is going to make (Stage.lookups)
+# and keeps up to window of them in flight at once on an asyncio event
+# loop. The results go into the stage's memo, so annotate() then runs
+# through the batch in input order without waiting. The MySQL driver is
+# blocking, so each lookup runs in a thread of the engine; asyncio only
+# schedules them and bounds how many are out.
+#
+# Lookups run on lanes: connections shared by all engines of the process,
+# which runs one job (see db_pool.py), and kept open across its batches and
+# stages. There are as many lanes as the connection pool keeps idle
+# connections, so however many stages prefetch at once, no more lookups
+# than that are in flight per process.
+#
+##
+
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool
+import reference as rf
+
+"""Connections the lookups of every engine of the process run on
+
+acquire() hands out a free lane, opening up to size of them from the pool
+and waiting for one to be released after that. Lanes are kept for the
+job, or until the pool or reference database changes (see getLanes).
+"""
+
+
+class Lanes(object):
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.size = size
+        # Reference database the lanes are connected to, see reference.py
+        self.db = rf.localDb
+        self.free = queue.Queue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            fresh = self.free.empty() and self.opened < self.size
+            if fresh:
+                self.opened = self.opened + 1
+        if not fresh:
+            return self.free.get()
+        try:
+            return self.pool.acquire()
+        except Exception:
+            with self.lock:
+                self.opened = self.opened - 1
+            raise
+
+    def release(self, conn):
+        self.free.put(conn)
+
+    # Closes a lane that raised, so a broken connection is not reused
+    def discard(self, conn):
+        db_pool.discard(conn)
+        with self.lock:
+            self.opened = self.opened - 1
+
+    # Connections that are not in use
+    def takeIdle(self):
+        idle = []
+        while True:
+            try:
+                idle.append(self.free.get_nowait())
+            except queue.Empty:
+                return idle
+
+    # Ends the read transactions of the idle lanes, so the next stage does
+    # not see a snapshot left over from this one
+    def endTransactions(self):
+        for conn in self.takeIdle():
+            try:
+                conn.rollback()
+            except Exception:
+                self.discard(conn)
+                continue
+            self.release(conn)
+
+    def close(self):
+        for conn in self.takeIdle():
+            self.discard(conn)
+
+
+_lanes = None
+_lanes_lock = threading.Lock()
+
+"""Lanes of the process, as many as the process-wide pool keeps idle
+connections
+
+They are replaced when the pool is (see db_pool.reset; the connections of
+a parent process are left alone) or when the reference database changes.
+"""
+
+
+def getLanes():
+    global _lanes
+    pool = db_pool.getPool()
+    with _lanes_lock:
+        if _lanes is not None and (_lanes.pool is not pool or _lanes.db != rf.localDb):
+            if _lanes.pool is pool:
+                _lanes.close()
+            _lanes = None
+        if _lanes is None:
+            _lanes = Lanes(pool, pool.size)
+        return _lanes
+
+
+"""Runs the lookups of one stage, up to window at a time
+
+Each lane gets a copy of the stage (see Stage.lookupCopy) with a cursor
+on it and an empty memo, made on first use and kept until close(), so
+that lookups that fill inner memos of the stage do not interfere.
+"""
+
+
+class LookupEngine(object):
+    def __init__(self, stage, window):
+        self.stage = stage
+        self.lanes = getLanes()
+        self.window = max(1, min(window, self.lanes.size))
+        # Copy of the stage on each lane used so far
+        self.slots = {}
+        self.executor = ThreadPoolExecutor(self.window)
+        self.loop = asyncio.new_event_loop()
+
+    # Makes the lookups of records that are not in the stage's memo yet
+    def prefetch(self, records):
+        wanted = {}
+        for fields in records:
+            for key, name, args in self.stage.lookups(fields):
+                if key not in self.stage.memo and key not in wanted:
+                    wanted[key] = (name, args)
+        if len(wanted) == 0:
+            return
+
+        self.stage.makeRoom(len(wanted))
+        before = dict(
+            (conn, (slot.filter_checks, slot.filter_skips))
+            for conn, slot in self.slots.items()
+        )
+        results = self.loop.run_until_complete(self.fetchAll(wanted))
+        for key, value in results:
+            self.stage.memo[key] = value
+
+        # Bloom filter checks made by the lookups on the slots count toward
+        # the stage
+        for conn, slot in list(self.slots.items()):
+            checks, skips = before.get(conn, (0, 0))
+            self.stage.filter_checks += slot.filter_checks - checks
+            self.stage.filter_skips += slot.filter_skips - skips
+
+    # One lookup, on a lane taken for its duration
+    def fetch(self, key, name, args):
+        conn = self.lanes.acquire()
+        try:
+            slot = self.slots.get(conn)
+            if slot is None:
+                slot = self.stage.lookupCopy(conn.cursor())
+                self.slots[conn] = slot
+            value = slot.fetchShared(key, getattr(slot, name), args)
+        except Exception:
+            self.slots.pop(conn, None)
+            self.lanes.discard(conn)
+            raise
+        self.lanes.release(conn)
+        return value
+
+    async def fetchAll(self, wanted):
+        # At most window lookups of the stage are out at once
+        limit = asyncio.Semaphore(self.window)
+
+        async def fetchOne(key, name, args):
+            async with limit:
+                value = await self.loop.run_in_executor(
+                    self.executor, self.fetch, key, name, args
+                )
+            return key, value
+
+        return await asyncio.gather(
+            *[fetchOne(key, name, args) for key, (name, args) in wanted.items()]
+        )
+
+    def close(self):
+        self.loop.close()
+        self.executor.shutdown()
+        self.slots = {}
+        self.lanes.endTransactions()
+
+
+### EOF
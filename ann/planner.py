@@ -0,0 +1,332 @@
+# planner.py
+#
+# Picks how each stage looks up its reference tables, per input
+#
+# No one lookup strategy suits every job: a VCF of a few dozen variants is
+# best served by a query per variant, while a whole-genome VCF is better
+# off reading each table once. Before a run, plan() estimates what each
+# strategy a stage supports would cost on the input -- from the number of
+# variants on each chromosome, whether they are coordinate-sorted there,
+# and the number of rows of the stage's tables -- and picks the cheapest:
+#   point   - a query per variant (what every stage can do)
+#   batched - one IN query per chromosome per batch of variants (dbSNP)
+#   sweep   - on each sorted chromosome where it beats point queries, one
+#             range query over the span of the variants, merge-walked
+#             against them
+#   indexed - the whole table held in memory, loaded or mapped from its
+#             snapshot (see snapshot.py)
+# Costs are rough estimates in milliseconds; only how they compare
+# matters. Each choice is printed with its estimated cost, and the driver
+# adds it to the job's .count.log.
+#
+##
+
+import math
+
+import intervals as iv
+import reference as rf
+import snapshot
+
+POINT = "point"
+BATCHED = "batched"
+SWEEP = "sweep"
+INDEXED = "indexed"
+
+
+"""Estimated cost of a round trip to RDS, and to the local copy of the
+reference tables (see reference.py)
+"""
+QUERY_MS = 1.0
+LOCAL_QUERY_MS = 0.05
+
+"""Estimated cost of reading one row of a query result, and of loading one
+row into an in-memory index
+"""
+ROW_MS = 0.002
+LOAD_ROW_MS = 0.01
+
+"""Estimated cost of mapping a table's snapshot, and of one lookup in
+memory
+"""
+MAP_MS = 1.0
+MEMORY_MS = 0.002
+
+"""Approximate length of the genome, and of its average chromosome, for
+estimating how many rows of a table fall within a span of positions
+"""
+GENOME_LENGTH = 3.1e9
+CHROMOSOMES = 24
+CHROM_LENGTH = GENOME_LENGTH / CHROMOSOMES
+
+
+"""Variants of the input on one chromosome
+
+sorted is False if the chromosome's lines are not one block of
+non-decreasing positions, as a sweep needs.
+"""
+
+
+class ChromStats(object):
+    def __init__(self):
+        self.count = 0
+        self.low = None
+        self.high = None
+        self.sorted = True
+
+    def add(self, pos):
+        self.count = self.count + 1
+        if pos is None:
+            self.sorted = False
+            return
+        if self.high is not None and pos < self.high:
+            self.sorted = False
+        self.low = pos if self.low is None else min(self.low, pos)
+        self.high = pos if self.high is None else max(self.high, pos)
+
+    def span(self):
+        return 0 if self.low is None else self.high - self.low + 1
+
+
+"""ChromStats of each chromosome of vcf, keyed without the "chr" prefix
+like the windows of annotate.scanSortedWindows
+"""
+
+
+def scanInput(vcf, sep="\t"):
+    stats = {}
+    chrom = None
+
+    fh = open(vcf)
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#") or line.startswith("CHROM") or len(line) == 0:
+            continue
+        fields = line.split(sep)
+        c = fields[0].strip().replace("chr", "")
+        try:
+            pos = int(fields[1].strip())
+        except ValueError:
+            pos = None
+
+        if c != chrom:
+            if c in stats:
+                # The chromosome's lines are split over several blocks
+                stats[c].sorted = False
+            else:
+                stats[c] = ChromStats()
+            chrom = c
+        stats[c].add(pos)
+    fh.close()
+
+    return stats
+
+
+"""Row counts of the reference tables, keyed on (reference database,
+table); they only change with the reference, so they are read once per
+process
+"""
+_rowCounts = {}
+
+
+def rowCount(reference, table):
+    key = (rf.localDb, table)
+    if key not in _rowCounts:
+        _rowCounts[key] = reference.rowCount(table)
+    return _rowCounts[key]
+
+
+"""True if table has a snapshot of the reference version in use, which the
+indexed lookups map instead of loading the table
+"""
+
+
+def snapshotted(table):
+    if iv.snapshotDir is None:
+        return False
+    if table == "dbSNP":
+        return snapshot.getDbSnp(iv.snapshotDir, iv.snapshotVersion) is not None
+    return snapshot.hasTable(iv.snapshotDir, table, iv.snapshotVersion)
+
+
+"""Estimated costs of the strategies of one stage on an input
+"""
+
+
+class StageCosts(object):
+    def __init__(self, stage_class, kwargs, stats, reference, batchSize, window):
+        self.stage_class = stage_class
+        self.kwargs = kwargs
+        self.stats = stats
+        self.reference = reference
+        self.batchSize = batchSize
+        self.window = max(1, window)
+        if isinstance(reference, rf.LocalReference):
+            self.queryMs = LOCAL_QUERY_MS
+        else:
+            self.queryMs = QUERY_MS
+
+    def tables(self, chrom):
+        return self.stage_class.plannerTables(self.kwargs, chrom)
+
+    # Rows of table on chrom
+    def chromRows(self, table):
+        rows = rowCount(self.reference, table)
+        if self.stage_class.chromTables:
+            return rows
+        return rows / float(CHROMOSOMES)
+
+    # A query per table per variant, window of them in flight at once
+    def point(self, chrom):
+        count = self.stats[chrom].count
+        return count * self.queryMs * len(self.tables(chrom)) / self.window
+
+    def batched(self, chrom):
+        count = self.stats[chrom].count
+        batches = math.ceil(count / float(self.batchSize))
+        return batches * self.queryMs * len(self.tables(chrom)) + count * ROW_MS
+
+    # None on a chromosome that is not sorted
+    def sweep(self, chrom):
+        stats = self.stats[chrom]
+        if not stats.sorted or stats.low is None:
+            return None
+        share = min(1.0, stats.span() / CHROM_LENGTH)
+        cost = stats.count * MEMORY_MS
+        for table in self.tables(chrom):
+            cost = cost + self.queryMs + self.chromRows(table) * share * ROW_MS
+        return cost
+
+    # Every table the input's chromosomes need is loaded (or mapped) once
+    def indexed(self):
+        tables = set()
+        cost = 0.0
+        for chrom in self.stats:
+            tables.update(self.tables(chrom))
+            cost = cost + self.stats[chrom].count * MEMORY_MS
+        for table in tables:
+            if self.stage_class.snapshotIndexes and snapshotted(table):
+                cost = cost + MAP_MS
+            else:
+                rows = rowCount(self.reference, table)
+                cost = cost + self.queryMs + rows * LOAD_ROW_MS
+        return cost
+
+
+"""The strategy picked for one stage: the stage options that apply it and
+its estimated cost
+"""
+
+
+class Plan(object):
+    def __init__(self, label, strategies, cost, pointCost, windows=None):
+        self.label = label
+        # Strategy on each chromosome of the input
+        self.strategies = strategies
+        self.cost = cost
+        self.pointCost = pointCost
+        self.windows = windows
+
+    def options(self):
+        used = set(self.strategies.values())
+        return {
+            "indexed": INDEXED in used,
+            "batched": BATCHED in used,
+            "sweep": self.windows if SWEEP in used else None,
+        }
+
+    def describe(self):
+        chroms = {}
+        for chrom in sorted(self.strategies, key=chromOrder):
+            chroms.setdefault(self.strategies[chrom], []).append(chrom)
+        if len(chroms) <= 1:
+            choice = list(chroms)[0] if len(chroms) > 0 else POINT
+        else:
+            choice = "; ".join(
+                [s + " on " + ", ".join(chroms[s]) for s in sorted(chroms)]
+            )
+        return (
+            f"Plan for {self.label}: {choice}, est. {self.cost:.1f} ms "
+            + f"(point queries: {self.pointCost:.1f} ms)"
+        )
+
+
+"""Sort key of chromosome names: numbered ones in numeric order first
+"""
+
+
+def chromOrder(chrom):
+    return (0, int(chrom), "") if chrom.isdigit() else (1, 0, chrom)
+
+
+"""Picks the cheapest strategy for a stage among those it supports
+"""
+
+
+def planStage(stage_class, kwargs, label, stats, reference, batchSize, window):
+    costs = StageCosts(stage_class, kwargs, stats, reference, batchSize, window)
+    supported = stage_class.plannerStrategies()
+
+    pointCost = sum([costs.point(chrom) for chrom in stats])
+    best = Plan(label, dict((chrom, POINT) for chrom in stats), pointCost, pointCost)
+
+    if BATCHED in supported:
+        cost = sum([costs.batched(chrom) for chrom in stats])
+        if cost < best.cost:
+            best = Plan(label, dict((c, BATCHED) for c in stats), cost, pointCost)
+
+    if SWEEP in supported:
+        strategies = {}
+        windows = {}
+        cost = 0.0
+        for chrom in stats:
+            point = costs.point(chrom)
+            sweep = costs.sweep(chrom)
+            if sweep is not None and sweep < point:
+                strategies[chrom] = SWEEP
+                windows[chrom] = (stats[chrom].low, stats[chrom].high)
+                cost = cost + sweep
+            else:
+                strategies[chrom] = POINT
+                cost = cost + point
+        if cost < best.cost:
+            best = Plan(label, strategies, cost, pointCost, windows)
+
+    if INDEXED in supported:
+        cost = costs.indexed()
+        if cost < best.cost:
+            best = Plan(label, dict((c, INDEXED) for c in stats), cost, pointCost)
+
+    return best
+
+
+"""Plans every stage of stages, (stage class, kwargs, label) triples as in
+driver.STAGES, for an input with stats (see scanInput)
+
+Prints each plan and returns the stage options that apply them, keyed by
+stage label, and the printed lines.
+"""
+
+
+def plan(stages, stats, reference, batchSize, window=1):
+    plans = {}
+    lines = []
+    for stage_class, kwargs, label in stages:
+        best = planStage(
+            stage_class, kwargs, label, stats, reference, batchSize, window
+        )
+        lines.append(best.describe())
+        print(lines[-1])
+        plans[label] = best.options()
+    return plans, lines
+
+
+"""Writes the lines printed by plan() to fh_log
+"""
+
+
+def writeLog(fh_log, lines):
+    for line in lines:
+        fh_log.write(line + "\n")
+
+
+### EOF
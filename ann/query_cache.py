@@ -0,0 +1,210 @@
+# query_cache.py
+#
+# Persistent cache of reference lookups, shared by the jobs on a host
+#
+# Users keep submitting variants at the same common positions, so the
+# result of a per-variant lookup is kept on disk in an SQLite file and
+# reused by later jobs. Entries are keyed on the reference version, the
+# table and the lookup's own key (chr, pos[, alleles]); the least recently
+# used ones are evicted once the cache holds more than maxEntries, and all
+# entries of other reference versions are dropped when the version changes.
+#
+##
+
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+"""Number of entries kept by default
+"""
+MAX_ENTRIES = 1000000
+
+"""Number of writes made between commits
+"""
+COMMIT_EVERY = 1000
+
+"""Fraction of maxEntries evicted down to when the cache is full, so
+eviction does not run on every insert
+"""
+EVICT_TO = 0.9
+
+
+"""Returned by QueryCache.get() for keys that are not cached
+"""
+MISSING = object()
+
+
+"""An SQLite-backed LRU cache of lookup results
+
+Values are pickled, so any lookup result -- rows, sets, None -- can be
+cached. Counts of hits,
+misses and evictions are kept for the job log. The connection is opened
+on first use in each process, so worker processes forked from a parent
+that used the cache get their own; within a process it is shared by the
+threads of concurrently running stages, one call at a time.
+"""
+
+
+class QueryCache(object):
+    def __init__(self, path, version, maxEntries=MAX_ENTRIES):
+        self.path = path
+        self.version = str(version)
+        self.maxEntries = maxEntries
+        self.conn = None
+        self.pid = None
+        self.writes = 0
+        self.touched = {}
+        self.lock = threading.Lock()
+        self.resetStats()
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def connect(self):
+        if self.conn is not None and self.pid == os.getpid():
+            return self.conn
+
+        # A connection inherited from the parent process is not used
+        self.conn = None
+        self.pid = os.getpid()
+        self.writes = 0
+        self.touched = {}
+        self.resetStats()
+
+        directory = os.path.dirname(self.path)
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory)
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("pragma journal_mode=wal;")
+        conn.execute(
+            "create table if not exists entries ("
+            + "key text primary key, version text, value blob, used real);"
+        )
+        conn.execute("create index if not exists entries_used on entries (used);")
+        conn.execute(
+            "create table if not exists meta (name text primary key, value text);"
+        )
+
+        # The reference changed: drop every entry of an older version
+        row = conn.execute("select value from meta where name = 'version';").fetchone()
+        if row is None or row[0] != self.version:
+            conn.execute("delete from entries where version != ?;", (self.version,))
+            conn.execute(
+                "insert or replace into meta (name, value) values ('version', ?);",
+                (self.version,),
+            )
+        conn.commit()
+        self.conn = conn
+        return conn
+
+    def makeKey(self, table, key):
+        return json.dumps([self.version, table] + [str(k) for k in key])
+
+    def get(self, table, key):
+        with self.lock:
+            return self.getLocked(table, key)
+
+    def put(self, table, key, value):
+        with self.lock:
+            self.putLocked(table, key, value)
+
+    def commit(self):
+        with self.lock:
+            self.commitLocked()
+
+    def getLocked(self, table, key):
+        conn = self.connect()
+        k = self.makeKey(table, key)
+        row = conn.execute("select value from entries where key = ?;", (k,)).fetchone()
+        if row is None:
+            self.misses = self.misses + 1
+            return MISSING
+
+        self.hits = self.hits + 1
+        # Last use times are written in bulk with the next commit
+        self.touched[k] = time.time()
+        return pickle.loads(row[0])
+
+    def putLocked(self, table, key, value):
+        conn = self.connect()
+        conn.execute(
+            "insert or replace into entries (key, version, value, used) "
+            + "values (?, ?, ?, ?);",
+            (self.makeKey(table, key), self.version, pickle.dumps(value), time.time()),
+        )
+        self.writes = self.writes + 1
+        if self.writes >= COMMIT_EVERY:
+            self.commitLocked()
+
+    def commitLocked(self):
+        if self.conn is None or self.pid != os.getpid():
+            return
+        conn = self.conn
+        if len(self.touched) > 0:
+            conn.executemany(
+                "update entries set used = ? where key = ?;",
+                [(used, k) for k, used in self.touched.items()],
+            )
+            self.touched = {}
+
+        count = conn.execute("select count(*) from entries;").fetchone()[0]
+        if count > self.maxEntries:
+            evict = count - int(self.maxEntries * EVICT_TO)
+            conn.execute(
+                "delete from entries where key in "
+                + "(select key from entries order by used limit ?);",
+                (evict,),
+            )
+            self.evictions = self.evictions + evict
+        conn.commit()
+        self.writes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+"""Cache used by the stages, or None; set by driver.run
+"""
+cache = None
+
+
+"""Reference version named by the marker file at path, or None if there
+is no marker file or it cannot be read
+
+Without a version nothing can tell results of the current reference from
+stale ones, so callers must not cache or reuse anything keyed on it.
+"""
+
+
+def readVersion(path):
+    if path is None:
+        return None
+    try:
+        fh = open(path)
+        version = fh.read().strip()
+        fh.close()
+    except OSError as e:
+        print(f"Unable to read reference version from {path}: {e}")
+        return None
+    return version if len(version) > 0 else None
+
+
+"""Writes the hit/miss/eviction counts of stats to fh_log
+"""
+
+
+def writeLog(fh_log, stats):
+    lookups = stats["hits"] + stats["misses"]
+    ratio = (stats["hits"] / float(lookups)) * 100 if lookups > 0 else 0.0
+    fh_log.write(
+        f"Query cache: {stats['hits']} hits, {stats['misses']} misses "
+        + f"({ratio:.1f}% hits), {stats['evictions']} evictions\n"
+    )
+
+
+### EOF
@@ -0,0 +1,100 @@
+# reannotate.py
+#
+# Re-annotates inputs after one reference table has been refreshed
+#
+# Usage: python reannotate.py <stage> <input.vcf> [<input.vcf> ...]
+#   <stage> is the label of the stage whose table changed, as printed by
+#   the pipeline (e.g. GwasCatalog); only it and the stages after it are
+#   re-run, from the intermediates kept in the StageStore directory
+#
+# Inputs named like the job files run.py annotates (<user id>:<job id>~<name>)
+# have their new results uploaded over the job's, and the job record updated.
+#
+##
+
+import sys
+import os
+
+if __name__ == "__main__":
+    # The secret cache is shared with the utility scripts, see common/
+    sys.path.insert(
+        1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+    )
+
+import boto3
+import driver
+import run
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read("annotator_config.ini")
+
+
+"""Uploads the results of the job input input_file_name over the job's
+earlier ones and updates its record; inputs that are not job files are
+left alone
+"""
+
+
+def publish(input_file_name):
+    try:
+        user_id, job_id, name, files = run.job_files(input_file_name)
+    except ValueError:
+        return
+
+    result_bucket = config.get("s3", "ResultsBucketName")
+    try:
+        s3 = boto3.client("s3")
+        for path, key in files:
+            s3.upload_file(path, result_bucket, key)
+        run.complete_job(job_id, result_bucket, *[key for path, key in files])
+    except (ClientError, BotoCoreError) as e:
+        print(f"Error updating the results of job {job_id}: {e}")
+        return
+    for path, key in files:
+        os.remove(path)
+    print(f"Results of job {job_id} updated")
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python reannotate.py <stage> <input.vcf> [<input.vcf> ...]")
+        sys.exit(1)
+
+    stage_store = config.get("ann", "StageStore", fallback="") or None
+    if stage_store is None:
+        print("No StageStore directory configured in annotator_config.ini")
+        sys.exit(1)
+
+    for input_file_name in sys.argv[2:]:
+        driver.reannotate(
+            input_file_name,
+            "vcf",
+            sys.argv[1],
+            stage_store,
+            indexed=config.getboolean("ann", "Indexed", fallback=False),
+            batched=config.getboolean("ann", "Batched", fallback=False),
+            batchSize=config.getint("ann", "BatchSize", fallback=1000),
+            sweep=config.getboolean("ann", "Sweep", fallback=False),
+            snapshotDir=config.get("ann", "SnapshotDir", fallback="") or None,
+            queryCache=config.get("ann", "QueryCache", fallback="") or None,
+            queryCacheEntries=config.getint(
+                "ann", "QueryCacheEntries", fallback=1000000
+            ),
+            referenceVersionFile=config.get("ann", "ReferenceVersionFile", fallback="")
+            or None,
+            referenceDb=config.get("ann", "ReferenceDb", fallback="") or None,
+            bloomFilterDir=config.get("ann", "BloomFilterDir", fallback="") or None,
+            planned=config.getboolean("ann", "Planned", fallback=False),
+            lookupWindow=config.getint("ann", "LookupWindow", fallback=1),
+        )
+        publish(input_file_name)
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
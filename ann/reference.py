@@ -0,0 +1,534 @@
+# reference.py
+#
+# The lookups the stages make in the reference database
+#
+# Stages ask the reference tables three kinds of question: which rows sit
+# at a position (point), which rows' [start, end] overlap a position or a
+# range (overlapping), and which is the first such row (first). A reference
+# answers them over one cursor: MySqlReference on the RDS database, and
+# LocalReference on a local SQLite copy of the tables built by main(), so
+# an annotator host can run without reaching RDS. reader() picks the one
+# that fits a cursor; connect() opens the local copy when localDb is set,
+# and the connection pool (see db_pool.py) opens connections with it.
+#
+# Usage: python reference.py <file> [<table> ...]
+#   copies the reference tables (all of them by default) from RDS into the
+#   SQLite file <file>
+#
+##
+
+import os
+import shutil
+import sqlite3
+import sys
+import urllib.request
+
+if __name__ == "__main__":
+    # The secret cache is shared with the utility scripts, see common/
+    sys.path.insert(
+        1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+    )
+
+import binning as bn
+import snapshot
+import utils as u
+
+"""Path of the local copy of the reference database, or None to use RDS;
+set by driver.configure
+"""
+localDb = None
+
+"""Ranges wider than this are queried without a bin clause; the bins of a
+sweep window span most of a chromosome and would not narrow the query
+"""
+BIN_SPAN = 1 << 20
+
+"""Tables queried on an interval, with their (chrom, start, end) columns;
+the local copy gives each an R*Tree over [start, end]
+"""
+RANGE_TABLES = snapshot.SNAPSHOT_TABLES + [("chrom_pos_unequal", "CHR", "start", "end")]
+
+"""Tables queried on an exact position, with their (chrom, pos) columns
+"""
+POINT_TABLES = [
+    ("dbSNP", "CHR", "POS"),
+    ("chrom_pos_equal_base", "CHR", "start"),
+    ("chrom_pos_equal_nobase", "CHR", "start"),
+]
+
+"""Rows copied per round trip by main()
+"""
+FETCH_SIZE = 100000
+
+
+"""Lookups on the RDS database
+
+Queries are the ones the stages used to send themselves, with the bin
+clause on tables that have a bin column (see binning.py). Rows come back
+in the order snapshot.rowOrder fixes for the table, whichever index MySQL
+picks, so first() is the first row overlapping() returns and the indexes
+of intervals.py, which load tables with rows(), match in the same order.
+"""
+
+
+class MySqlReference(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+        # Column names of the tables seen so far
+        self.columns = {}
+
+    # Column names of table, lower-cased
+    def names(self, table):
+        if table not in self.columns:
+            self.cursor.execute("select * from " + table + " limit 0;")
+            self.cursor.fetchall()
+            self.columns[table] = [str(d[0]).lower() for d in self.cursor.description]
+        return self.columns[table]
+
+    # Position of column name in the rows of table
+    def column(self, table, name):
+        return self.names(table).index(name.lower())
+
+    # All rows of table
+    def rows(self, table, select="*"):
+        self.cursor.execute(
+            "select "
+            + select
+            + " from "
+            + table
+            + snapshot.rowOrder(self.cursor, table)
+            + ";"
+        )
+        if select == "*":
+            self.columns[table] = [str(d[0]).lower() for d in self.cursor.description]
+        return self.cursor.fetchall()
+
+    # Number of rows of table as estimated by the server's table statistics,
+    # which costs no scan of the table; 0 if it has none
+    def rowCount(self, table):
+        self.cursor.execute(
+            "select table_rows from information_schema.tables "
+            + "where table_schema = database() AND table_name = %s;",
+            [table],
+        )
+        rows = self.cursor.fetchall()
+        if len(rows) == 0 or rows[0][0] is None:
+            return 0
+        return int(rows[0][0])
+
+    # Rows of table on chrom at any of positions whose columns also equal
+    # the values in equal, a list of (column, value) pairs
+    def point(self, table, chrom_col, pos_col, chrom, positions, equal=()):
+        sql = "select * from " + table + " where " + chrom_col + "=%s"
+        args = [str(chrom)]
+        for column, value in equal:
+            sql = sql + " AND " + column + "=%s"
+            args.append(value)
+        if len(positions) == 1:
+            sql = sql + " AND " + pos_col + "=%s"
+        else:
+            sql = (
+                sql
+                + " AND "
+                + pos_col
+                + " IN ("
+                + ",".join(["%s"] * len(positions))
+                + ")"
+            )
+        sql = sql + snapshot.rowOrder(self.cursor, table)
+        self.cursor.execute(sql + ";", args + [int(p) for p in positions])
+        return self.cursor.fetchall()
+
+    def overlappingSql(
+        self, table, chrom_col, start_col, end_col, chrom, low, high, select
+    ):
+        sql = "select " + select + " from " + table + " where "
+        if chrom_col is not None:
+            sql = sql + chrom_col + '="' + str(chrom) + '" AND '
+        sql = (
+            sql
+            + "("
+            + start_col
+            + " <= "
+            + str(high)
+            + " AND "
+            + str(low)
+            + " <= "
+            + end_col
+            + ")"
+        )
+        if high - low <= BIN_SPAN:
+            sql = sql + bn.rangeClause(self.cursor, table, low, high)
+        return sql + snapshot.rowOrder(self.cursor, table)
+
+    # Rows of table on chrom whose [start_col, end_col] overlaps [low, high];
+    # chrom_col is None for tables that hold one chromosome
+    def overlapping(
+        self, table, chrom_col, start_col, end_col, chrom, low, high=None, select="*"
+    ):
+        high = int(low if high is None else high)
+        sql = self.overlappingSql(
+            table, chrom_col, start_col, end_col, chrom, int(low), high, select
+        )
+        self.cursor.execute(sql + ";")
+        return self.cursor.fetchall()
+
+    # First row overlapping() would return, or None
+    def first(
+        self, table, chrom_col, start_col, end_col, chrom, low, high=None, select="*"
+    ):
+        high = int(low if high is None else high)
+        sql = self.overlappingSql(
+            table, chrom_col, start_col, end_col, chrom, int(low), high, select
+        )
+        self.cursor.execute(sql + " limit 1;")
+        return self.cursor.fetchone()
+
+    # Those of tables that have a row overlapping pos, with one round trip
+    def tablesOverlapping(self, tables, chrom_col, start_col, end_col, chrom, pos):
+        sql = " UNION ALL ".join(
+            [
+                "("
+                + self.overlappingSql(
+                    table,
+                    chrom_col,
+                    start_col,
+                    end_col,
+                    chrom,
+                    int(pos),
+                    int(pos),
+                    "'" + table + "'",
+                )
+                + " limit 1)"
+                for table in tables
+            ]
+        )
+        self.cursor.execute(sql + ";")
+        return set([u.text(row[0]) for row in self.cursor.fetchall()])
+
+
+"""Lookups on the local SQLite copy built by main()
+
+Rows are returned in the order they were copied, which is the order
+snapshot.rowOrder fixes for RDS. Interval lookups on a table of RANGE_TABLES go through
+its R*Tree (<table>__ranges); the rows found there are still checked
+against the exact predicate.
+"""
+
+
+class LocalReference(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.columns = {}
+        # (start, end) columns of the R*Tree of each table, or None
+        self.ranges = None
+
+    def names(self, table):
+        if table not in self.columns:
+            self.cursor.execute('select * from "' + table + '" limit 0;')
+            self.cursor.fetchall()
+            self.columns[table] = [str(d[0]).lower() for d in self.cursor.description]
+        return self.columns[table]
+
+    def column(self, table, name):
+        return self.names(table).index(name.lower())
+
+    def rows(self, table, select="*"):
+        self.cursor.execute(
+            "select " + select + ' from "' + table + '" order by rowid;'
+        )
+        if select == "*":
+            self.columns[table] = [str(d[0]).lower() for d in self.cursor.description]
+        return self.cursor.fetchall()
+
+    # Rows are copied in without gaps, so the last rowid is the row count;
+    # 0 for a table that was not copied
+    def rowCount(self, table):
+        try:
+            self.cursor.execute('select max(rowid) from "' + table + '";')
+        except sqlite3.OperationalError:
+            return 0
+        rows = self.cursor.fetchall()
+        return int(rows[0][0]) if rows[0][0] is not None else 0
+
+    def point(self, table, chrom_col, pos_col, chrom, positions, equal=()):
+        sql = 'select * from "' + table + '" where "' + chrom_col + '" = ?'
+        args = [str(chrom)]
+        # Columns that come back from MySQL as bytes were copied as blobs
+        for column, value in equal:
+            sql = sql + ' AND CAST("' + column + '" AS TEXT) = ?'
+            args.append(value)
+        sql = (
+            sql
+            + ' AND "'
+            + pos_col
+            + '" IN ('
+            + ",".join(["?"] * len(positions))
+            + ") order by rowid;"
+        )
+        self.cursor.execute(sql, args + [int(p) for p in positions])
+        return self.cursor.fetchall()
+
+    def hasRanges(self, table, start_col, end_col):
+        if self.ranges is None:
+            self.cursor.execute("select tbl, start_col, end_col from reference_ranges;")
+            self.ranges = dict(
+                (tbl, (s.lower(), e.lower())) for (tbl, s, e) in self.cursor.fetchall()
+            )
+        return self.ranges.get(table) == (start_col.lower(), end_col.lower())
+
+    def overlappingSql(
+        self, table, chrom_col, start_col, end_col, chrom, low, high, select
+    ):
+        if select == "*":
+            select = "t.*"
+        sql = "select " + select + ' from "' + table + '" t'
+        where = []
+        args = []
+        if self.hasRanges(table, start_col, end_col):
+            sql = sql + ' join "' + table + '__ranges" r on r._id = t.rowid'
+            where = ["r._low <= ?", "r._high >= ?"]
+            args = [high, low]
+        if chrom_col is not None:
+            where.append('t."' + chrom_col + '" = ?')
+            args.append(str(chrom))
+        where = where + ['t."' + start_col + '" <= ?', 't."' + end_col + '" >= ?']
+        args = args + [high, low]
+        return sql + " where " + " AND ".join(where) + " order by t.rowid", args
+
+    def overlapping(
+        self, table, chrom_col, start_col, end_col, chrom, low, high=None, select="*"
+    ):
+        high = int(low if high is None else high)
+        sql, args = self.overlappingSql(
+            table, chrom_col, start_col, end_col, chrom, int(low), high, select
+        )
+        self.cursor.execute(sql + ";", args)
+        return self.cursor.fetchall()
+
+    def first(
+        self, table, chrom_col, start_col, end_col, chrom, low, high=None, select="*"
+    ):
+        high = int(low if high is None else high)
+        sql, args = self.overlappingSql(
+            table, chrom_col, start_col, end_col, chrom, int(low), high, select
+        )
+        self.cursor.execute(sql + " limit 1;", args)
+        return self.cursor.fetchone()
+
+    # No round trips to save locally, so the tables are checked in turn
+    def tablesOverlapping(self, tables, chrom_col, start_col, end_col, chrom, pos):
+        return set(
+            [
+                table
+                for table in tables
+                if self.first(
+                    table, chrom_col, start_col, end_col, chrom, pos, select="1"
+                )
+                is not None
+            ]
+        )
+
+
+"""Reference lookups over cursor, or None for a stage without a cursor
+"""
+
+
+def reader(cursor):
+    if cursor is None:
+        return None
+    if isinstance(cursor, sqlite3.Cursor):
+        return LocalReference(cursor)
+    return MySqlReference(cursor)
+
+
+"""SQLite connection that the connection pool can check like a MySQL one
+"""
+
+
+class LocalConnection(sqlite3.Connection):
+    def ping(self, reconnect=False):
+        self.execute("select 1;").fetchall()
+
+
+"""Opens a connection to the reference database: the local copy if
+localDb is set, RDS otherwise
+"""
+
+
+def connect():
+    if localDb is None:
+        return u.db_connect()
+    if not os.path.isfile(localDb):
+        raise FileNotFoundError(f"No local reference database at {localDb}")
+    uri = "file:" + urllib.request.pathname2url(os.path.abspath(localDb)) + "?mode=ro"
+    return sqlite3.connect(
+        uri, uri=True, check_same_thread=False, factory=LocalConnection
+    )
+
+
+"""Value as SQLite stores it; DECIMAL, date and other values are kept as
+the text str() gives for them, which is how the stages write them out
+"""
+
+
+def localValue(value):
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        if isinstance(value, bool):
+            return int(value)
+        return value
+    return str(value)
+
+
+"""Copies table from an RDS cursor into db, a sqlite3 connection,
+replacing any earlier copy
+
+Rows are streamed fetchSize at a time. The chrom column is stored as text
+and the coordinate columns as integers, so that lookups match them like
+MySQL does. Tables get an index on (chrom_col, start_col) and, if end_col
+is given, an R*Tree over [start_col, end_col]. Returns the number of rows.
+"""
+
+
+def copyTable(
+    cursor, db, table, chrom_col, start_col, end_col=None, fetchSize=FETCH_SIZE
+):
+    cursor.execute("select * from " + table + snapshot.rowOrder(cursor, table) + ";")
+    names = [str(d[0]) for d in cursor.description]
+    lower = [n.lower() for n in names]
+    chrom_ind = lower.index(chrom_col.lower())
+    coord_inds = [lower.index(start_col.lower())]
+    if end_col is not None:
+        coord_inds.append(lower.index(end_col.lower()))
+
+    db.execute('drop table if exists "' + table + '";')
+    db.execute('drop table if exists "' + table + '__ranges";')
+    db.execute("delete from reference_ranges where tbl = ?;", (table,))
+    db.execute(
+        'create table "'
+        + table
+        + '" ('
+        + ", ".join(['"' + n + '"' for n in names])
+        + ");"
+    )
+
+    insert = (
+        'insert into "' + table + '" values (' + ",".join(["?"] * len(names)) + ");"
+    )
+    count = 0
+    while True:
+        rows = cursor.fetchmany(fetchSize)
+        if len(rows) == 0:
+            break
+        values = []
+        for row in rows:
+            row = [localValue(v) for v in row]
+            if row[chrom_ind] is not None:
+                row[chrom_ind] = u.text(row[chrom_ind])
+            for i in coord_inds:
+                if row[i] is not None:
+                    row[i] = int(row[i])
+            values.append(row)
+        db.executemany(insert, values)
+        count = count + len(rows)
+
+    db.execute(
+        'create index "'
+        + table
+        + '__chrom" on "'
+        + table
+        + '" ("'
+        + chrom_col
+        + '", "'
+        + start_col
+        + '");'
+    )
+    if end_col is not None:
+        db.execute(
+            'create virtual table "'
+            + table
+            + '__ranges" using rtree_i32(_id, _low, _high);'
+        )
+        # NULL coordinates never match, and the R*Tree needs low <= high
+        db.execute(
+            'insert into "'
+            + table
+            + '__ranges" select rowid, min("'
+            + start_col
+            + '", "'
+            + end_col
+            + '"), max("'
+            + start_col
+            + '", "'
+            + end_col
+            + '") from "'
+            + table
+            + '" where "'
+            + start_col
+            + '" is not null AND "'
+            + end_col
+            + '" is not null;'
+        )
+        db.execute(
+            "insert into reference_ranges (tbl, start_col, end_col) values (?, ?, ?);",
+            (table, start_col, end_col),
+        )
+    db.commit()
+    return count
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python reference.py <file> [<table> ...]")
+        sys.exit(1)
+
+    import pymysql
+
+    path = sys.argv[1]
+    tables = sys.argv[2:]
+
+    # Built next to the file and moved into place once complete, so running
+    # annotators never see a partial copy
+    tmp = path + ".tmp"
+    if os.path.isfile(path):
+        shutil.copyfile(path, tmp)
+    elif os.path.isfile(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    db.execute(
+        "create table if not exists reference_ranges "
+        + "(tbl text primary key, start_col text, end_col text);"
+    )
+
+    conn = u.db_connect()
+    copies = [(t, c, s, e) for (t, c, s, e) in RANGE_TABLES] + [
+        (t, c, p, None) for (t, c, p) in POINT_TABLES
+    ]
+    for table, chrom_col, start_col, end_col in copies:
+        if len(tables) > 0 and table not in tables:
+            continue
+        try:
+            # Unbuffered cursor, so the rows are streamed from the server
+            count = copyTable(
+                conn.cursor(pymysql.cursors.SSCursor),
+                db,
+                table,
+                chrom_col,
+                start_col,
+                end_col,
+            )
+            print(f"{table}: {count} rows")
+        except Exception as e:
+            db.rollback()
+            print(f"{table}: skipped ({e})")
+    conn.close()
+
+    db.execute("vacuum;")
+    db.close()
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
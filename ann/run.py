@@ -12,10 +12,20 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import sys
 import time
+import os
+
+if __name__ == "__main__":
+    # The secret cache is shared with the utility scripts, see common/
+    sys.path.insert(
+        1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+    )
+
 import driver
 import boto3
-import os
 import json
+import query_cache as qc
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import BotoCoreError, ClientError
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
 
@@ -42,55 +52,199 @@ class Timer(object):
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
-def main():
+"""The latest completed job that annotated the same input (see
+driver.inputHash), looked up on the content_hash index of the annotations
+table, or None
+"""
 
-    # Get job parameters
-    input_file_name = sys.argv[1]
-    # Run the AnnTools pipeline
-    with Timer():
-        driver.run(input_file_name, "vcf")
 
+def find_duplicate(content_hash):
+    dynamodb = boto3.resource('dynamodb', region_name=config.get("aws", "AwsRegionName"))
+    table = dynamodb.Table(config.get("gas", "AnnotationsTable"))
+    items = []
+    query = {
+        'IndexName': config.get("gas", "AnnotationsHashIndex"),
+        'KeyConditionExpression': Key('content_hash').eq(content_hash)
+    }
     try:
-        s3 = boto3.client('s3')
-        result_bucket = config.get("s3", "ResultsBucketName")
-        localfile = sys.argv[1]
-        arr = localfile.split("/")
-        dir ="/".join(arr[:-1])
-        id_name = arr[-1]
-        userId, iad = id_name.split(":")
-        id, name = ("".join(iad)).split("~")
-        pre, suf = name.split(".")
-
-        result = pre + ".annot." + suf
-        results_file_key = config.get("DEFAULT", "CnetId") + '/'+userId+'/' + id + "~" + result
-        res = dir + "/" +userId +":"+ id + "~" + result
-        log_file_key = config.get("DEFAULT", "CnetId") +  '/'+userId+'/' + id + "~"+ name+ ".count.log"
-        log_res = localfile  + ".count.log"
-
-        # # 2. Upload the log file to S3 results bucket
-        s3.upload_file(res, result_bucket, results_file_key)
-        s3.upload_file(log_res, result_bucket, log_file_key)
-
-        # update to db
-        table_name = config.get("gas","AnnotationsTable")
-        
-        dynamodb = boto3.resource('dynamodb', region_name=config.get("aws", "AwsRegionName"))
-        # Get a reference to the DynamoDB table
-        table = dynamodb.Table(table_name)
+        while True:
+            response = table.query(**query)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except (ClientError, BotoCoreError) as e:
+        print(f"Error looking up annotation hash: {e}")
+        return None
+
+    done = [
+        i for i in items
+        if i.get('job_status') == "COMPLETED" and 's3_key_counts_file' in i
+    ]
+    if len(done) == 0:
+        return None
+    return max(done, key=lambda i: int(i['complete_time']))
+
+
+"""Copies the results of an earlier job to this job's keys, server-side
+
+Returns False if they cannot be copied (e.g. they have been archived).
+"""
+
 
-        # Update the job item in DynamoDB
-        completed_time = int(time.time())
-        response = table.update_item(
+def copy_results(item, result_bucket, results_file_key, log_file_key, counts_file_key):
+    if 's3_key_counts_file' not in item:
+        return False
+    s3 = boto3.client('s3')
+    try:
+        s3.copy_object(
+            CopySource={'Bucket': item['s3_results_bucket'], 'Key': item['s3_key_result_file']},
+            Bucket=result_bucket,
+            Key=results_file_key
+        )
+        s3.copy_object(
+            CopySource={'Bucket': item['s3_results_bucket'], 'Key': item['s3_key_log_file']},
+            Bucket=result_bucket,
+            Key=log_file_key
+        )
+        s3.copy_object(
+            CopySource={'Bucket': item['s3_results_bucket'], 'Key': item['s3_key_counts_file']},
+            Bucket=result_bucket,
+            Key=counts_file_key
+        )
+    except (ClientError, BotoCoreError) as e:
+        print(f"Error copying results of job {item['job_id']}: {e}")
+        return False
+    return True
+
+
+"""Records on the job's item that its input has content_hash, so later jobs
+with the same input find it (see find_duplicate)
+"""
+
+
+def record_hash(content_hash, job_id):
+    dynamodb = boto3.resource('dynamodb', region_name=config.get("aws", "AwsRegionName"))
+    table = dynamodb.Table(config.get("gas", "AnnotationsTable"))
+    table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET #content_hash = :content_hash',
+        ExpressionAttributeNames={'#content_hash': 'content_hash'},
+        ExpressionAttributeValues={':content_hash': content_hash}
+    )
+
+
+"""Finds an earlier completed job of the user whose input shares at least
+DeltaMinOverlap of its lines with localfile, and downloads its input,
+result and stage counters next to localfile
+
+Up to DeltaCandidates of the user's latest jobs are checked, those of an
+input with the same file name first. Returns the paths of the three
+downloaded files, or None.
+"""
+
+
+def find_previous_job(user_id, job_id, input_file_name, localfile):
+    dynamodb = boto3.resource('dynamodb', region_name=config.get("aws", "AwsRegionName"))
+    table = dynamodb.Table(config.get("gas", "AnnotationsTable"))
+    items = []
+    query = {
+        'IndexName': 'user_id_index',
+        'KeyConditionExpression': Key('user_id').eq(user_id)
+    }
+    try:
+        while True:
+            response = table.query(**query)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except (ClientError, BotoCoreError) as e:
+        print(f"Error listing earlier jobs: {e}")
+        return None
+
+    candidates = [
+        i for i in items
+        if i['job_id'] != job_id and i.get('job_status') == "COMPLETED"
+        and 's3_key_counts_file' in i
+    ]
+    candidates.sort(
+        key=lambda i: (i.get('input_file_name') == input_file_name, int(i['complete_time'])),
+        reverse=True
+    )
+
+    s3 = boto3.client('s3')
+    paths = [localfile + ".prev.vcf", localfile + ".prev.annot.vcf", localfile + ".prev.counts.json"]
+    for item in candidates[:config.getint("ann", "DeltaCandidates", fallback=3)]:
+        try:
+            s3.download_file(item['s3_inputs_bucket'], item['s3_key_input_file'], paths[0])
+            overlap = driver.lineOverlap(localfile, paths[0])
+            if overlap < config.getfloat("ann", "DeltaMinOverlap", fallback=0.5):
+                continue
+            s3.download_file(item['s3_results_bucket'], item['s3_key_result_file'], paths[1])
+            s3.download_file(item['s3_results_bucket'], item['s3_key_counts_file'], paths[2])
+        except ClientError as e:
+            # e.g. the results have been archived
+            print(f"Error downloading job {item['job_id']}: {e}")
+            continue
+        print(f"Input shares {overlap * 100:.1f}% of its lines with job {item['job_id']}")
+        return paths
+
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    return None
+
+
+"""User id, job id and input file name of the job whose input is localfile,
+<dir>/<user id>:<job id>~<name>, and the (local path, S3 key) pairs of its
+result, log and counts files
+"""
+
+
+def job_files(localfile):
+    arr = localfile.split("/")
+    dir ="/".join(arr[:-1])
+    id_name = arr[-1]
+    userId, iad = id_name.split(":")
+    id, name = ("".join(iad)).split("~")
+    pre, suf = name.split(".")
+
+    result = pre + ".annot." + suf
+    prefix = config.get("DEFAULT", "CnetId") + '/' + userId + '/' + id + "~"
+    files = [
+        (dir + "/" + userId + ":" + id + "~" + result, prefix + result),
+        (localfile + ".count.log", prefix + name + ".count.log"),
+        (localfile + ".counts.json", prefix + name + ".counts.json")
+    ]
+    return userId, id, name, files
+
+
+"""Marks the job completed in DynamoDB, with the keys of its results;
+returns the completion time
+"""
+
+
+def complete_job(id, result_bucket, results_file_key, log_file_key, counts_file_key):
+    dynamodb = boto3.resource('dynamodb', region_name=config.get("aws", "AwsRegionName"))
+    # Get a reference to the DynamoDB table
+    table = dynamodb.Table(config.get("gas", "AnnotationsTable"))
+
+    # Update the job item in DynamoDB
+    completed_time = int(time.time())
+    table.update_item(
         Key={'job_id': id},
         UpdateExpression='SET #s3_results_bucket = :s3_results_bucket, '
-                        '#s3_key_result_file = :s3_key_result_file, '
-                        '#s3_key_log_file = :s3_key_log_file, '
-                        '#complete_time = :complete_time, '
-                        '#job_status = :job_status',
+                         '#s3_key_result_file = :s3_key_result_file, '
+                         '#s3_key_log_file = :s3_key_log_file, '
+                         '#s3_key_counts_file = :s3_key_counts_file, '
+                         '#complete_time = :complete_time, '
+                         '#job_status = :job_status',
         ExpressionAttributeNames={
             '#s3_results_bucket': 's3_results_bucket',
             '#s3_key_result_file': 's3_key_result_file',
             '#s3_key_log_file': 's3_key_log_file',
+            '#s3_key_counts_file': 's3_key_counts_file',
             '#complete_time': 'complete_time',
             '#job_status': 'job_status'
         },
@@ -98,11 +252,93 @@ def main():
             ':s3_results_bucket': result_bucket,
             ':s3_key_result_file': results_file_key,
             ':s3_key_log_file': log_file_key,
+            ':s3_key_counts_file': counts_file_key,
             ':complete_time': completed_time,
             ':job_status': "COMPLETED"
         },
         ReturnValues='UPDATED_NEW'
+    )
+    return completed_time
+
+
+def main():
+
+    # Get job parameters
+    input_file_name = sys.argv[1]
+    reference_version_file = config.get("ann", "ReferenceVersionFile", fallback="") or None
+
+    localfile = sys.argv[1]
+    userId, id, name, files = job_files(localfile)
+    (res, results_file_key), (log_res, log_file_key), (counts_res, counts_file_key) = files
+
+    result_bucket = config.get("s3", "ResultsBucketName")
+
+    # Skip annotation if the same input was annotated against the same
+    # reference before and its results are still in S3; not possible while
+    # the reference version is unknown
+    content_hash = None
+    if config.getboolean("ann", "ReuseResults", fallback=False):
+        content_hash = driver.inputHash(input_file_name, qc.readVersion(reference_version_file))
+    duplicate = None
+    if content_hash is not None:
+        duplicate = find_duplicate(content_hash)
+    annotated = False
+    if duplicate is not None and copy_results(duplicate, result_bucket, results_file_key, log_file_key, counts_file_key):
+        print(f"Same input as job {duplicate['job_id']}, results copied")
+    else:
+        run_options = dict(
+            fused=config.getboolean("ann", "Fused", fallback=False),
+            indexed=config.getboolean("ann", "Indexed", fallback=False),
+            batched=config.getboolean("ann", "Batched", fallback=False),
+            batchSize=config.getint("ann", "BatchSize", fallback=1000),
+            sweep=config.getboolean("ann", "Sweep", fallback=False),
+            workers=config.getint("ann", "Workers", fallback=1),
+            chunkLines=config.getint("ann", "ChunkLines", fallback=100000),
+            snapshotDir=config.get("ann", "SnapshotDir", fallback="") or None,
+            queryCache=config.get("ann", "QueryCache", fallback="") or None,
+            queryCacheEntries=config.getint(
+                "ann", "QueryCacheEntries", fallback=1000000
+            ),
+            referenceVersionFile=reference_version_file,
+            stageStore=config.get("ann", "StageStore", fallback="") or None,
+            stageThreads=config.getint("ann", "StageThreads", fallback=1),
+            lookupWindow=config.getint("ann", "LookupWindow", fallback=1),
+            referenceDb=config.get("ann", "ReferenceDb", fallback="") or None,
+            bloomFilterDir=config.get("ann", "BloomFilterDir", fallback="") or None,
+            planned=config.getboolean("ann", "Planned", fallback=False),
         )
+
+        # Annotate only the lines that are not in an earlier job's input;
+        # not possible while the reference version is unknown
+        previous = None
+        if config.getboolean("ann", "DeltaAnnotation", fallback=False) \
+                and qc.readVersion(reference_version_file) is not None:
+            previous = find_previous_job(userId, id, name, localfile)
+
+        # Run the AnnTools pipeline
+        with Timer():
+            done = False
+            if previous is not None:
+                try:
+                    driver.runDelta(input_file_name, "vcf", *previous, **run_options)
+                    done = True
+                except ValueError as e:
+                    print(f"Delta annotation not possible: {e}")
+                for path in previous:
+                    os.remove(path)
+            if not done:
+                driver.run(input_file_name, "vcf", **run_options)
+        annotated = True
+
+    try:
+        s3 = boto3.client('s3')
+
+        if annotated:
+            # # 2. Upload the log file to S3 results bucket
+            for path, key in files:
+                s3.upload_file(path, result_bucket, key)
+
+        completed_time = complete_job(id, result_bucket, results_file_key, log_file_key, counts_file_key)
         
         data = {
             "job_id": id,
@@ -117,9 +353,19 @@ def main():
             TopicArn=config.get("sns", "Sqs_res_arn"),
             Message=message
         )
+
+        # Only lets later jobs with the same input reuse these results, so
+        # the job is done even if this fails
+        if annotated and content_hash is not None:
+            try:
+                record_hash(content_hash, id)
+            except (ClientError, BotoCoreError) as e:
+                print(f"Error recording annotation hash: {e}")
     # 3. Clean up (delete) local job files
-        os.remove(res)
-        os.remove(log_res)
+        if annotated:
+            os.remove(res)
+            os.remove(log_res)
+            os.remove(counts_res)
         os.remove(localfile)
     except Exception as e:
         print(f"Error adding item to DynamoDB or uploading to s3: {e}")
@@ -0,0 +1,709 @@
+# snapshot.py
+#
+# Memory-mapped columnar snapshots of the reference tables
+#
+# The builder exports every region table used by annotate.py into one
+# binary file per chromosome: integer and float columns as fixed-width
+# arrays, string columns dictionary-encoded, rows sorted by start. The
+# reader maps those files instead of loading the table over MySQL, so
+# annotator processes on the same host share one copy in the page cache.
+# dbSNP goes into a separate point store (see buildDbSnp).
+#
+# Usage: python snapshot.py <directory> [<reference version>] [<table> ...]
+#
+##
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from decimal import Decimal
+
+if __name__ == "__main__":
+    # The secret cache is shared with the utility scripts, see common/
+    sys.path.insert(
+        1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+    )
+
+import batch
+
+"""File layout version, bumped whenever the layout changes
+"""
+FORMAT_VERSION = 1
+MAGIC = b"GASSNAP\x00"
+
+# magic, format version, length of the JSON header that follows
+PREAMBLE = struct.Struct("<8sII")
+
+"""Code that marks a NULL in a dictionary-encoded column
+"""
+NULL_CODE = 0xFFFFFFFF
+
+"""Chromosomes with a tfbsConsSites<chrom> table
+"""
+TFBS_CHROMS = [str(i) for i in range(1, 23)] + ["X", "Y"]
+
+"""Tables exported by default, with their (chrom, start, end) columns
+
+The columns are the ones the stages in annotate.py query the table on.
+"""
+SNAPSHOT_TABLES = [
+    ("refGene", "chrom", "txStart", "txEnd"),
+    ("cytoBand", "chrom", "chromStart", "chromEnd"),
+    ("gadAll", "chromosome", "chromStart", "chromEnd"),
+    ("gwasCatalog", "chrom", "chromEnd", "chromEnd"),
+    ("hugo", "chrom", "chromStart", "chromEnd"),
+    ("targetScanS", "chrom", "chromStart", "chromEnd"),
+    ("dgv_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("conrad_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("mcCarroll_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("abParts_IG_T_CelReceptors", "chrom", "chromStart", "chromEnd"),
+    ("genomicSuperDups", "chrom", "chromStart", "chromEnd"),
+    ("cpgIslandExt", "chrom", "chromStart", "chromEnd"),
+] + [("tfbsConsSites" + c, "chrom", "chromStart", "chromEnd") for c in TFBS_CHROMS]
+
+"""ORDER BY clauses found so far, keyed by table
+"""
+_rowOrders = {}
+
+"""ORDER BY clause that reads the rows of table from MySQL in one fixed
+order: its primary key, or all of its columns if it has none
+
+Without it MySQL returns rows in whatever order the index it picks gives
+(the bin clauses of binning.py change that pick), so the reference lookups
+and every snapshot or index loaded from a full read of the table use it,
+and matches come back from them in the same order.
+"""
+
+
+def rowOrder(cursor, table):
+    if table not in _rowOrders:
+        cursor.execute(
+            "select column_name from information_schema.key_column_usage "
+            + "where table_schema = database() AND table_name = %s "
+            + "AND constraint_name = 'PRIMARY' order by ordinal_position;",
+            [table],
+        )
+        columns = [str(row[0]) for row in cursor.fetchall()]
+        if len(columns) == 0:
+            cursor.execute("select * from " + table + " limit 0;")
+            cursor.fetchall()
+            columns = [str(d[0]) for d in cursor.description]
+        _rowOrders[table] = " order by " + ", ".join(["`" + c + "`" for c in columns])
+    return _rowOrders[table]
+
+
+"""Column kind of a list of values: i(nt), f(loat), s(tr), b(ytes) or
+d(ecimal); None if the values cannot be stored
+"""
+
+
+def columnKind(values):
+    kinds = set()
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            return None
+        if isinstance(v, int):
+            kinds.add("i")
+        elif isinstance(v, float):
+            kinds.add("f")
+        elif isinstance(v, str):
+            kinds.add("s")
+        elif isinstance(v, bytes):
+            kinds.add("b")
+        elif isinstance(v, Decimal):
+            kinds.add("d")
+        else:
+            return None
+
+    if len(kinds) == 0:
+        return "s"
+    if len(kinds) > 1:
+        return None
+    return kinds.pop()
+
+
+def encodeValue(kind, value):
+    if kind == "b":
+        return value
+    return str(value).encode("utf-8")
+
+
+# Column value as text, like utils.text
+def textValue(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
+def decodeValue(kind, data):
+    if kind == "b":
+        return data
+    if kind == "d":
+        return Decimal(data.decode("utf-8"))
+    return data.decode("utf-8")
+
+
+"""Writes the rows of one chromosome to path
+
+rows are (ordinal, row) pairs sorted by (start, ordinal), where ordinal is
+the row's position in the table. The file holds, after its header:
+    values.<i>, nulls.<i>        - int64/float64 array and NULL flags
+    codes.<i>, offsets.<i>, dict.<i>
+                                 - per-row dictionary codes, and the
+                                   offsets of each distinct value in dict
+    ordinals, maxEnds            - load order and running maximum end
+"""
+
+
+def writeChromosome(path, header, names, rows, end_ind):
+    sections = []
+
+    for i, name in enumerate(names):
+        values = [row[i] for (ordinal, row) in rows]
+        kind = columnKind(values)
+        if kind is None:
+            raise ValueError(f"Column {name} has values that cannot be stored")
+        header["columns"].append({"name": name, "kind": kind})
+
+        if kind in ("i", "f"):
+            numbers = array("q" if kind == "i" else "d")
+            nulls = array("B")
+            for v in values:
+                numbers.append(v if v is not None else 0)
+                nulls.append(1 if v is None else 0)
+            sections.append(("values." + str(i), numbers.tobytes()))
+            if 1 in nulls:
+                sections.append(("nulls." + str(i), nulls.tobytes()))
+        else:
+            codes = array("I")
+            offsets = array("I", [0])
+            blob = bytearray()
+            dictionary = {}
+            for v in values:
+                if v is None:
+                    codes.append(NULL_CODE)
+                    continue
+                if v not in dictionary:
+                    dictionary[v] = len(dictionary)
+                    blob.extend(encodeValue(kind, v))
+                    offsets.append(len(blob))
+                codes.append(dictionary[v])
+            sections.append(("codes." + str(i), codes.tobytes()))
+            sections.append(("offsets." + str(i), offsets.tobytes()))
+            sections.append(("dict." + str(i), bytes(blob)))
+
+    for ind in (header["start"], header["end"]):
+        if header["columns"][ind]["kind"] != "i":
+            raise ValueError(f"Coordinate column {names[ind]} is not an integer")
+
+    ordinals = array("I")
+    maxEnds = array("q")
+    maxEnd = None
+    for ordinal, row in rows:
+        if maxEnd is None or row[end_ind] > maxEnd:
+            maxEnd = row[end_ind]
+        ordinals.append(ordinal)
+        maxEnds.append(maxEnd)
+    sections.append(("ordinals", ordinals.tobytes()))
+    sections.append(("maxEnds", maxEnds.tobytes()))
+
+    writeSections(path, MAGIC, header, sections)
+
+
+"""Writes the preamble, header and sections of a snapshot file
+
+A section's data is either bytes or the path of a file to copy in, for
+sections too large to hold in memory.
+"""
+
+
+def writeSections(path, magic, header, sections):
+    # Every section starts on an 8 byte boundary so it can be cast in place
+    offset = 0
+    for name, data in sections:
+        length = os.path.getsize(data) if isinstance(data, str) else len(data)
+        header["sections"][name] = [offset, length]
+        offset = offset + length + (-length % 8)
+
+    head = json.dumps(header).encode("utf-8")
+    head = head + b" " * (-(PREAMBLE.size + len(head)) % 8)
+
+    fh = open(path, "wb")
+    fh.write(PREAMBLE.pack(magic, FORMAT_VERSION, len(head)))
+    fh.write(head)
+    for name, data in sections:
+        length = header["sections"][name][1]
+        if isinstance(data, str):
+            fh_data = open(data, "rb")
+            shutil.copyfileobj(fh_data, fh)
+            fh_data.close()
+        else:
+            fh.write(data)
+        fh.write(b"\x00" * (-length % 8))
+    fh.close()
+
+
+"""Exports table to <directory>/<table>/, one file per chromosome plus a
+manifest.json that maps chromosome names to files
+
+Rows with a NULL chromosome or coordinate are left out; no lookup can
+match them. The table is written to a temporary directory and moved into
+place once complete, so readers never see half a snapshot.
+"""
+
+
+def buildTable(cursor, directory, table, chrom_col, start_col, end_col, version):
+    cursor.execute("select * from " + table + rowOrder(cursor, table) + ";")
+    rows = cursor.fetchall()
+    names = [str(d[0]) for d in cursor.description]
+    lower = [n.lower() for n in names]
+    chrom_ind = lower.index(chrom_col.lower())
+    start_ind = lower.index(start_col.lower())
+    end_ind = lower.index(end_col.lower())
+
+    by_chrom = {}
+    for ordinal, row in enumerate(rows):
+        if row[chrom_ind] is None or row[start_ind] is None or row[end_ind] is None:
+            continue
+        by_chrom.setdefault(textValue(row[chrom_ind]), []).append((ordinal, row))
+
+    target = os.path.join(directory, table)
+    tmpdir = target + ".tmp"
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "version": version,
+        "table": table,
+        "index": [chrom_col, start_col, end_col],
+        "columns": names,
+        "chroms": {},
+    }
+    for n, chrom in enumerate(sorted(by_chrom)):
+        entries = by_chrom[chrom]
+        entries.sort(key=lambda e: (int(e[1][start_ind]), e[0]))
+        filename = str(n) + ".snap"
+        header = {
+            "version": version,
+            "table": table,
+            "chrom": chrom,
+            "byteorder": sys.byteorder,
+            "rows": len(entries),
+            "start": start_ind,
+            "end": end_ind,
+            "columns": [],
+            "sections": {},
+        }
+        writeChromosome(os.path.join(tmpdir, filename), header, names, entries, end_ind)
+        manifest["chroms"][chrom] = filename
+
+    fh = open(os.path.join(tmpdir, "manifest.json"), "w")
+    json.dump(manifest, fh, indent=2)
+    fh.close()
+
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(tmpdir, target)
+    return len(rows)
+
+
+"""A memory-mapped snapshot file; section() casts a section in place
+"""
+
+
+class MappedFile(object):
+    def __init__(self, path, magic):
+        fh = open(path, "rb")
+        self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+
+        found, version, length = PREAMBLE.unpack_from(self.map, 0)
+        if found != magic or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} snapshot")
+        self.header = json.loads(self.map[PREAMBLE.size : PREAMBLE.size + length])
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written on a machine of other byte order")
+
+        self.base = PREAMBLE.size + length
+        self.view = memoryview(self.map)
+        self.sections = {}
+
+    def section(self, name, format):
+        if name not in self.sections:
+            self.sections[name] = None
+            if name in self.header["sections"]:
+                offset, length = self.header["sections"][name]
+                start = self.base + offset
+                self.sections[name] = self.view[start : start + length].cast(format)
+        return self.sections[name]
+
+
+"""One memory-mapped chromosome file
+"""
+
+
+class SnapshotFile(MappedFile):
+    def __init__(self, path):
+        MappedFile.__init__(self, path, MAGIC)
+        self.rows = self.header["rows"]
+        self.kinds = [c["kind"] for c in self.header["columns"]]
+
+        self.starts = self.section("values." + str(self.header["start"]), "q")
+        self.ends = self.section("values." + str(self.header["end"]), "q")
+        self.ordinals = self.section("ordinals", "I")
+        self.maxEnds = self.section("maxEnds", "q")
+        # Search columns for overlappingMany(), made on first use
+        self.columns = None
+
+    def value(self, i, k):
+        kind = self.kinds[i]
+        if kind in ("i", "f"):
+            nulls = self.section("nulls." + str(i), "B")
+            if nulls is not None and nulls[k]:
+                return None
+            return self.section("values." + str(i), "q" if kind == "i" else "d")[k]
+
+        code = self.section("codes." + str(i), "I")[k]
+        if code == NULL_CODE:
+            return None
+        offsets = self.section("offsets." + str(i), "I")
+        data = self.section("dict." + str(i), "B")[offsets[code] : offsets[code + 1]]
+        return decodeValue(kind, data.tobytes())
+
+    def row(self, k):
+        return tuple(self.value(i, k) for i in range(len(self.kinds)))
+
+    # Same walk as intervals.IntervalIndex, over the mapped arrays
+    def overlapping(self, pos, margin=0):
+        pos = int(pos)
+        hits = []
+        k = bisect_right(self.starts, pos + margin) - 1
+        while k >= 0 and self.maxEnds[k] >= pos - margin:
+            if self.ends[k] >= pos - margin:
+                hits.append(k)
+            k = k - 1
+
+        hits.sort(key=lambda h: self.ordinals[h])
+        return [self.row(h) for h in hits]
+
+    def overlappingMany(self, positions, margin=0):
+        if self.columns is None:
+            self.columns = (
+                batch.column(self.starts),
+                batch.column(self.ends),
+                batch.column(self.maxEnds),
+            )
+        starts, ends, maxEnds = self.columns
+
+        found = batch.matchesMany(starts, ends, maxEnds, positions, margin)
+        return [
+            [self.row(k) for k in sorted(ks, key=lambda k: self.ordinals[k])]
+            for ks in found
+        ]
+
+
+"""Snapshot of one table; chromosome files are mapped on first use
+
+Answers overlapping(chrom, pos) like intervals.IntervalIndex does.
+"""
+
+
+class SnapshotTable(object):
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.version = manifest["version"]
+        self.columns = manifest["columns"]
+        self.files = manifest["chroms"]
+        self.opened = {}
+
+    def chromosome(self, chrom):
+        if chrom not in self.opened:
+            self.opened[chrom] = None
+            if chrom in self.files:
+                path = os.path.join(self.directory, self.files[chrom])
+                self.opened[chrom] = SnapshotFile(path)
+        return self.opened[chrom]
+
+    def overlapping(self, chrom, pos, margin=0):
+        snapshot = self.chromosome(chrom)
+        if snapshot is None:
+            return []
+        return snapshot.overlapping(pos, margin)
+
+    def overlappingMany(self, chrom, positions, margin=0):
+        snapshot = self.chromosome(chrom)
+        if snapshot is None:
+            return [[] for p in positions]
+        return snapshot.overlappingMany(positions, margin)
+
+
+"""Manifest of the snapshot of table in directory, or None if there is
+none or it is of another file layout
+"""
+
+
+def tableManifest(directory, table):
+    path = os.path.join(directory, table, "manifest.json")
+    if not os.path.isfile(path):
+        return None
+
+    fh = open(path)
+    manifest = json.load(fh)
+    fh.close()
+
+    if manifest["format"] != FORMAT_VERSION:
+        return None
+    return manifest
+
+
+"""True if directory holds a snapshot of table for reference version
+"""
+
+
+def hasTable(directory, table, version):
+    manifest = tableManifest(directory, table)
+    return manifest is not None and manifest["version"] == str(version)
+
+
+"""Opens the snapshot of table in directory
+
+Returns None if there is none, if it is for another reference version
+than version, or if it was built on other columns than (chrom_col,
+start_col, end_col).
+"""
+
+
+def openTable(directory, table, chrom_col, start_col, end_col, version):
+    manifest = tableManifest(directory, table)
+    if manifest is None:
+        return None
+    if manifest["version"] != str(version):
+        print(
+            f"Snapshot of {table} is for reference version "
+            + f"{manifest['version']}, not {version}; not used"
+        )
+        return None
+    path = os.path.join(directory, table, "manifest.json")
+    wanted = [c.lower() for c in (chrom_col, start_col, end_col)]
+    if [c.lower() for c in manifest["index"]] != wanted:
+        return None
+    return SnapshotTable(os.path.dirname(path), manifest)
+
+
+"""dbSNP point store
+
+dbSNP is only ever looked up on exact (CHR, POS), so it is stored as a
+point index rather than intervals: for each chromosome a sorted array of
+distinct positions, the index of each position's first record, and the
+offsets of the records in a blob. A record holds the rsID, REF, GMAF and
+INFO of one row, as the text the SQL path writes out.
+"""
+DBSNP_MAGIC = b"GASDBSNP"
+DBSNP_FILE = "dbSNP.store"
+
+# Separates the fields of a record in the blob
+FIELD_SEP = "\x00"
+
+
+"""Exports dbSNP to <directory>/dbSNP.store
+
+Rows are streamed in (CHR, POS) order, fetchSize at a time; only the
+positions and offsets are held in memory while the records are written to
+a temporary file that is copied in at the end.
+"""
+
+
+def buildDbSnp(cursor, directory, version, fetchSize=100000):
+    cursor.execute("select * from dbSNP order by CHR, POS;")
+    lower = [str(d[0]).lower() for d in cursor.description]
+    chr_ind = lower.index("chr")
+    pos_ind = lower.index("pos")
+    ref_ind = lower.index("ref")
+    info_ind = lower.index("info")
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    target = os.path.join(directory, DBSNP_FILE)
+    blobfile = target + ".blob.tmp"
+
+    positions = array("q")
+    firsts = array("Q")
+    offsets = array("Q", [0])
+    chroms = {}
+    chrom = None
+    last = None
+    count = 0
+
+    fh_blob = open(blobfile, "wb")
+    try:
+        while True:
+            rows = cursor.fetchmany(fetchSize)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                if row[chr_ind] is None or row[pos_ind] is None:
+                    continue
+                c = textValue(row[chr_ind])
+                pos = int(row[pos_ind])
+                if c != chrom:
+                    if c in chroms:
+                        raise ValueError(f"dbSNP rows of {c} are not contiguous")
+                    chroms[c] = [len(positions), 0]
+                    chrom = c
+                    last = None
+                if pos != last:
+                    if last is not None and pos < last:
+                        raise ValueError(f"dbSNP rows of {c} are not sorted")
+                    positions.append(pos)
+                    firsts.append(len(offsets) - 1)
+                    chroms[c][1] = chroms[c][1] + 1
+                    last = pos
+
+                # rsID (row[3]) and GMAF (row[7]) as DbSnpStage writes them
+                record = FIELD_SEP.join(
+                    [
+                        str(row[3]),
+                        textValue(row[ref_ind]),
+                        str(row[7]),
+                        textValue(row[info_ind]),
+                    ]
+                ).encode("utf-8")
+                fh_blob.write(record)
+                offsets.append(offsets[-1] + len(record))
+                count = count + 1
+        fh_blob.close()
+        firsts.append(len(offsets) - 1)
+
+        header = {
+            "version": version,
+            "table": "dbSNP",
+            "byteorder": sys.byteorder,
+            "records": count,
+            "chroms": chroms,
+            "sections": {},
+        }
+        sections = [
+            ("positions", positions.tobytes()),
+            ("firsts", firsts.tobytes()),
+            ("offsets", offsets.tobytes()),
+            ("records", blobfile),
+        ]
+        writeSections(target + ".tmp", DBSNP_MAGIC, header, sections)
+        os.replace(target + ".tmp", target)
+    finally:
+        fh_blob.close()
+        if os.path.isfile(blobfile):
+            os.remove(blobfile)
+    return count
+
+
+"""Memory-mapped dbSNP point store
+
+positions(chrom) is the sorted array of distinct positions on chrom, for
+the caller to search; records(chrom, k) are the (rsID, REF, GMAF, INFO)
+records at the k-th of them, in the order they were exported.
+"""
+
+
+class DbSnpSnapshot(MappedFile):
+    def __init__(self, path):
+        MappedFile.__init__(self, path, DBSNP_MAGIC)
+        self.version = self.header["version"]
+        self.chroms = self.header["chroms"]
+        self.all_positions = self.section("positions", "q")
+        self.firsts = self.section("firsts", "Q")
+        self.offsets = self.section("offsets", "Q")
+        self.blob = self.section("records", "B")
+
+    def positions(self, chrom):
+        if chrom not in self.chroms:
+            return self.all_positions[0:0]
+        first, count = self.chroms[chrom]
+        return self.all_positions[first : first + count]
+
+    def records(self, chrom, k):
+        g = self.chroms[chrom][0] + k
+        records = []
+        for r in range(self.firsts[g], self.firsts[g + 1]):
+            data = self.blob[self.offsets[r] : self.offsets[r + 1]].tobytes()
+            records.append(tuple(data.decode("utf-8").split(FIELD_SEP)))
+        return records
+
+
+"""dbSNP stores opened so far, keyed by directory and reference version
+"""
+_dbsnp = {}
+
+
+"""Opens the dbSNP store in directory once per process, or returns None
+if there is none or it is for another reference version than version
+"""
+
+
+def getDbSnp(directory, version):
+    key = (directory, str(version))
+    if key not in _dbsnp:
+        _dbsnp[key] = None
+        path = os.path.join(directory, DBSNP_FILE)
+        if os.path.isfile(path):
+            store = DbSnpSnapshot(path)
+            if store.version == str(version):
+                _dbsnp[key] = store
+            else:
+                print(
+                    f"dbSNP snapshot is for reference version {store.version}, "
+                    + f"not {version}; not used"
+                )
+    return _dbsnp[key]
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python snapshot.py <directory> [<version>] [<table> ...]")
+        sys.exit(1)
+
+    import db_pool
+    import pymysql
+
+    directory = sys.argv[1]
+    version = sys.argv[2] if len(sys.argv) > 2 else time.strftime("%Y%m%d")
+    tables = sys.argv[3:]
+
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        for table, chrom_col, start_col, end_col in SNAPSHOT_TABLES:
+            if len(tables) > 0 and table not in tables:
+                continue
+            try:
+                count = buildTable(
+                    cursor, directory, table, chrom_col, start_col, end_col, version
+                )
+                print(f"{table}: {count} rows")
+            except Exception as e:
+                print(f"{table}: skipped ({e})")
+
+        if len(tables) == 0 or "dbSNP" in tables:
+            try:
+                # Unbuffered cursor, so the rows are streamed from the server
+                count = buildDbSnp(
+                    conn.cursor(pymysql.cursors.SSCursor), directory, version
+                )
+                print(f"dbSNP: {count} rows")
+            except Exception as e:
+                print(f"dbSNP: skipped ({e})")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
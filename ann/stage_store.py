@@ -0,0 +1,104 @@
+# stage_store.py
+#
+# Content-addressed store of the per-stage intermediate outputs
+#
+# The staged pipeline writes the output of stage N to <input>.N. With a
+# store, each of those files -- and the .count.log as it stood after the
+# stage -- is kept under the SHA-256 of its contents, and a manifest keyed
+# on the input's own hash lists them in stage order. When one reference
+# table is refreshed, driver.reannotate() starts from the stored output of
+# the stage before it instead of re-running the whole pipeline. Identical
+# intermediates of different jobs are stored once.
+#
+##
+
+import hashlib
+import json
+import os
+import shutil
+
+"""SHA-256 of the contents of the file at path, as hex
+"""
+
+
+def fileDigest(path):
+    digest = hashlib.sha256()
+    fh = open(path, "rb")
+    for block in iter(lambda: fh.read(1 << 20), b""):
+        digest.update(block)
+    fh.close()
+    return digest.hexdigest()
+
+
+"""A directory of blobs named by their digest, plus one manifest per input
+
+Blobs live in objects/<first two hex digits>/<digest> and manifests in
+manifests/<input digest>.json. Files are written under a temporary name
+and renamed into place, so concurrent jobs never see a partial file.
+"""
+
+
+class StageStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def objectPath(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def manifestPath(self, inputDigest):
+        return os.path.join(self.directory, "manifests", inputDigest + ".json")
+
+    def install(self, source, path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmp = path + ".tmp" + str(os.getpid())
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, path)
+
+    # Stores a copy of the file at path and returns its digest
+    def put(self, path):
+        digest = fileDigest(path)
+        if not os.path.isfile(self.objectPath(digest)):
+            self.install(path, self.objectPath(digest))
+        return digest
+
+    # Copies the blob with digest to path
+    def get(self, digest, path):
+        shutil.copyfile(self.objectPath(digest), path)
+
+    def has(self, digest):
+        return os.path.isfile(self.objectPath(digest))
+
+    # The manifest of the input with inputDigest, or None
+    def manifest(self, inputDigest):
+        path = self.manifestPath(inputDigest)
+        if not os.path.isfile(path):
+            return None
+        fh = open(path)
+        manifest = json.load(fh)
+        fh.close()
+        return manifest
+
+    def putManifest(self, inputDigest, manifest):
+        path = self.manifestPath(inputDigest)
+        tmp = path + ".new" + str(os.getpid())
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        fh = open(tmp, "w")
+        json.dump(manifest, fh, indent=1)
+        fh.close()
+        os.replace(tmp, path)
+
+
+"""Manifest of a pipeline run: for each stage its label, the digests of
+its output and of the .count.log after it, and its counters
+"""
+
+
+def newManifest():
+    return {"labels": [], "outputs": [], "logs": [], "counters": []}
+
+
+### EOF
@@ -0,0 +1,111 @@
+# test_intervals.py
+#
+# Checks that the in-memory indexes of intervals.py find the same rows, in
+# the same order, as the reference lookups they stand in for
+#
+# Usage: python -m pytest test_intervals.py (or python -m unittest test_intervals)
+#
+##
+
+import os
+import sqlite3
+import sys
+import unittest
+
+# The secret cache is shared with the utility scripts, see common/
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import intervals as iv
+import reference as rf
+
+"""Rows of a small region table: (chrom, chromStart, chromEnd, name), with
+overlapping, nested, zero-length and NULL-coordinate rows on two chromosomes
+"""
+REGIONS = [
+    ("1", 100, 200, "a"),
+    ("1", 150, 160, "b"),
+    ("1", 150, 160, "c"),
+    ("1", 120, 400, "d"),
+    ("1", 300, 300, "e"),
+    ("1", None, 310, "f"),
+    ("2", 100, 200, "g"),
+    ("1", 50, 100, "h"),
+]
+
+"""Rows of a small point table: (chrom, start, ref)
+"""
+POINTS = [
+    ("1", 100, "A"),
+    ("1", 100, "C"),
+    ("1", 150, "G"),
+    ("2", 100, "T"),
+    ("1", None, "T"),
+]
+
+# Positions looked up on each chromosome
+POSITIONS = [40, 50, 99, 100, 101, 150, 160, 161, 200, 201, 300, 310, 401]
+
+
+def makeReference():
+    db = sqlite3.connect(":memory:")
+    db.execute(
+        "create table reference_ranges (tbl text, start_col text, end_col text);"
+    )
+    db.execute('create table regions ("chrom", "chromStart", "chromEnd", "name");')
+    db.executemany("insert into regions values (?, ?, ?, ?);", REGIONS)
+    db.execute('create table points ("chrom", "start", "ref");')
+    db.executemany("insert into points values (?, ?, ?);", POINTS)
+    return rf.reader(db.cursor())
+
+
+# Rows as MySQL returns them, with the chromosome as bytes
+def asBytes(rows):
+    return [(row[0].encode("utf-8"),) + tuple(row[1:]) for row in rows]
+
+
+# Rows with the chromosome as text again, to compare them with local ones
+def asText(rows):
+    return [(row[0].decode("utf-8"),) + tuple(row[1:]) for row in rows]
+
+
+class IntervalIndexTest(unittest.TestCase):
+    def test_overlapping_matches_reference(self):
+        reference = makeReference()
+        rows = reference.rows("regions")
+        for loaded in (rows, asBytes(rows)):
+            index = iv.IntervalIndex(loaded, 0, 1, 2)
+            for chrom in ("1", "2", "3"):
+                expected = [
+                    reference.overlapping(
+                        "regions", "chrom", "chromStart", "chromEnd", chrom, pos
+                    )
+                    for pos in POSITIONS
+                ]
+                found = [index.overlapping(chrom, pos) for pos in POSITIONS]
+                many = index.overlappingMany(chrom, POSITIONS)
+                if loaded is not rows:
+                    found = [asText(hits) for hits in found]
+                    many = [asText(hits) for hits in many]
+                self.assertEqual(found, expected)
+                self.assertEqual(many, expected)
+
+
+class PointIndexTest(unittest.TestCase):
+    def test_at_matches_reference(self):
+        reference = makeReference()
+        rows = reference.rows("points")
+        for loaded in (rows, asBytes(rows)):
+            index = iv.PointIndex(loaded, reference.names("points"), 0, 1)
+            for chrom in ("1", "2", "3"):
+                for pos in POSITIONS:
+                    expected = reference.point("points", "chrom", "start", chrom, [pos])
+                    found = index.at(chrom, pos)
+                    if loaded is not rows:
+                        found = asText(found)
+                    self.assertEqual(found, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+### EOF
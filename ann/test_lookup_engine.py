@@ -0,0 +1,168 @@
+# test_lookup_engine.py
+#
+# Checks that a LookupEngine fills the stage's memo with the lookups of a
+# batch, keeps no more than its window of them in flight, and drops the
+# lane of a lookup that raised
+#
+# Usage: python -m pytest test_lookup_engine.py (or python -m unittest test_lookup_engine)
+#
+##
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+# The secret cache is shared with the utility scripts, see common/
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import annotate as ann
+import db_pool
+import lookup_engine as le
+
+"""Connection that the pool and the lanes can hand out without a database
+"""
+
+
+class FakeConnection(object):
+    # Every connection opened so far
+    made = []
+
+    def __init__(self):
+        self.closed = False
+        FakeConnection.made.append(self)
+
+    def cursor(self):
+        return None
+
+    def ping(self, reconnect=False):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+"""Lookups made by a SlowStage and its lane copies, which share it
+"""
+
+
+class Tracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.most = 0
+        self.calls = []
+
+
+"""Stage with one lookup per position that takes a while, so several of
+them overlap; positions in fail raise instead
+"""
+
+
+class SlowStage(ann.Stage):
+    def __init__(self, window, fail=()):
+        ann.Stage.__init__(self, None, window=window)
+        self.tracker = Tracker()
+        self.fail = fail
+
+    def lookups(self, fields):
+        return [(("pos", fields[1]), "fetchPos", (fields[1],))]
+
+    def fetchPos(self, pos):
+        tracker = self.tracker
+        with tracker.lock:
+            tracker.inFlight = tracker.inFlight + 1
+            tracker.most = max(tracker.most, tracker.inFlight)
+            tracker.calls.append(pos)
+        time.sleep(0.02)
+        with tracker.lock:
+            tracker.inFlight = tracker.inFlight - 1
+        if pos in self.fail:
+            raise ValueError(f"Lookup of {pos} failed")
+        return "row" + pos
+
+
+# Records at positions, with each position twice
+def makeRecords(positions):
+    records = []
+    for pos in positions:
+        records.append(["chr1", str(pos), ".", "A", "C"])
+        records.append(["chr1", str(pos), ".", "A", "G"])
+    return records
+
+
+class LookupEngineTest(unittest.TestCase):
+    def setUp(self):
+        db_pool._pool = db_pool.ConnectionPool(connect=FakeConnection)
+        le._lanes = None
+        FakeConnection.made = []
+
+    def tearDown(self):
+        le.getLanes().close()
+        le._lanes = None
+        db_pool.reset()
+
+    def test_results_go_to_memo_in_input_order(self):
+        positions = [7, 3, 11, 5, 2, 13, 1]
+        stage = SlowStage(3)
+        stage.memo[("pos", "5")] = "memoized"
+        engine = le.LookupEngine(stage, stage.window)
+        try:
+            engine.prefetch(makeRecords(positions))
+        finally:
+            engine.close()
+
+        expected = [("pos", "5")] + [("pos", str(p)) for p in positions if p != 5]
+        self.assertEqual(list(stage.memo.keys()), expected)
+        self.assertEqual(stage.memo[("pos", "5")], "memoized")
+        self.assertEqual(stage.memo[("pos", "13")], "row13")
+        # Each position not in the memo is looked up once
+        self.assertEqual(
+            sorted(stage.tracker.calls), sorted([str(p) for p in positions if p != 5])
+        )
+
+    def test_window_bounds_lookups_in_flight(self):
+        for window in (1, 2, 3):
+            stage = SlowStage(window)
+            engine = le.LookupEngine(stage, stage.window)
+            try:
+                engine.prefetch(makeRecords(range(1, 13)))
+            finally:
+                engine.close()
+            self.assertEqual(len(stage.tracker.calls), 12)
+            self.assertLessEqual(stage.tracker.most, window)
+            self.assertLessEqual(le.getLanes().opened, db_pool.POOL_SIZE)
+
+    def test_lane_that_raised_is_discarded(self):
+        stage = SlowStage(2, fail=set(["4"]))
+        engine = le.LookupEngine(stage, stage.window)
+        try:
+            with self.assertRaises(ValueError):
+                engine.prefetch(makeRecords(range(1, 7)))
+            closed = [conn for conn in FakeConnection.made if conn.closed]
+            self.assertEqual(len(closed), 1)
+            self.assertNotIn(closed[0], engine.slots)
+        finally:
+            engine.close()
+        self.assertNotIn(("pos", "4"), stage.memo)
+
+        # Later lookups run on the lanes that are left and new ones
+        stage.fail.clear()
+        engine = le.LookupEngine(stage, stage.window)
+        try:
+            engine.prefetch(makeRecords(range(1, 7)))
+            self.assertTrue(all(not conn.closed for conn in engine.slots))
+        finally:
+            engine.close()
+        self.assertEqual(stage.memo[("pos", "4")], "row4")
+        self.assertEqual(len([c for c in FakeConnection.made if c.closed]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+### EOF
@@ -0,0 +1,124 @@
+# test_pipeline.py
+#
+# Checks that the fused pipeline and the parallel chunked one give the same
+# output and counters as running the stages one after another, using the
+# fake stages of test_waves.py
+#
+# Usage: python -m pytest test_pipeline.py (or python -m unittest test_pipeline)
+#
+##
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# The secret cache is shared with the utility scripts, see common/
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import annotate as ann
+import driver
+import reference as rf
+from test_waves import INFOS, makeStages
+
+"""The fake stages, as driver.STAGES entries
+"""
+FAKE_STAGES = [
+    (stage.__class__, {}, stage.__class__.__name__) for stage in makeStages()
+]
+
+
+# Lines of an input with several chromosomes, each longer than a chunk
+def makeLines():
+    lines = ["##fileformat=VCFv4.1", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO"]
+    for chrom in ("chr1", "chr2", "chrX"):
+        for pos in range(1, 61):
+            info = INFOS[pos % len(INFOS)]
+            lines.append(f"{chrom}\t{pos * 7}\t.\tA\tC\t.\tPASS\t{info}")
+    return lines
+
+
+def readFile(path):
+    fh = open(path)
+    text = fh.read()
+    fh.close()
+    return text
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.dir, "in.vcf")
+        fh = open(self.infile, "w")
+        for line in makeLines():
+            fh.write(line + "\n")
+        fh.close()
+
+        # Expected output, .count.log and counters: all lines through the
+        # stages one after another in memory
+        stages = makeStages()
+        self.expected = "".join(
+            [line + "\n" for line in ann.annotateLines(stages, makeLines())]
+        )
+        self.counters = [stage.counterValues() for stage in stages]
+        logfile = os.path.join(self.dir, "expected.count.log")
+        fh = open(logfile, "w")
+        for stage in stages:
+            stage.writeLog(fh)
+        fh.close()
+        self.log = readFile(logfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_chunks_match_serial(self):
+        chunks = driver.splitChunks(self.infile, 25)
+        fh = open(self.infile, "rb")
+        chroms = []
+        for start, end in chunks:
+            fh.seek(start)
+            lines = fh.read(end - start).decode().splitlines()
+            chroms.append(
+                set([line.split("\t")[0] for line in lines if line[0] != "#"])
+            )
+        fh.close()
+        self.assertEqual(len(chunks), 9)
+        self.assertTrue(all(len(c) == 1 for c in chroms))
+
+        # Workers open reference connections, here to an empty local copy
+        localDb = os.path.join(self.dir, "reference.db")
+        sqlite3.connect(localDb).close()
+        outfile = os.path.join(self.dir, "in.annot.vcf")
+        with mock.patch.object(driver, "STAGES", FAKE_STAGES), mock.patch.object(
+            rf, "localDb", localDb
+        ):
+            counters = driver.runParallel(self.infile, outfile, "vcf", {}, 16, 2, 25)
+        self.assertEqual(readFile(outfile), self.expected)
+        self.assertEqual(counters, self.counters)
+        self.assertEqual(readFile(self.infile + ".count.log"), self.log)
+
+    def test_fused_matches_staged(self):
+        stages = makeStages()
+        for i, stage in enumerate(stages):
+            tmpextin = "" if i == 0 else "." + str(i)
+            ann.runStage(stage, self.infile, tmpextin, "." + str(i + 1), 16)
+        staged = readFile(self.infile + "." + str(len(stages)))
+        self.assertEqual(staged, self.expected)
+        self.assertEqual([stage.counterValues() for stage in stages], self.counters)
+        self.assertEqual(readFile(self.infile + ".count.log"), self.log)
+
+        stages = makeStages()
+        outfile = os.path.join(self.dir, "in.annot.vcf")
+        ann.runPipeline(stages, self.infile, outfile, 16)
+        self.assertEqual(readFile(outfile), staged)
+        self.assertEqual([stage.counterValues() for stage in stages], self.counters)
+        self.assertEqual(readFile(self.infile + ".count.log"), self.log)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+### EOF
@@ -0,0 +1,107 @@
+# test_waves.py
+#
+# Checks that running the stages of a wave at the same time gives the same
+# output and counters as running them one after another
+#
+# Usage: python -m pytest test_waves.py (or python -m unittest test_waves)
+#
+##
+
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+# The secret cache is shared with the utility scripts, see common/
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import annotate as ann
+
+"""Answers the lookups of an overlap stage without a database: positions
+divisible by every overlap one row
+"""
+
+
+class FakeRows(object):
+    every = 1
+
+    def lookup(self, chr, pos):
+        pos = int(pos)
+        if pos % self.every != 0:
+            return []
+        return [(chr, pos, pos, "n" + str(pos), 0, 0, 0, "chr2", pos, pos + 1)]
+
+
+class FakeCytoband(FakeRows, ann.CytobandStage):
+    every = 2
+
+
+class FakeGadAll(FakeRows, ann.GadAllStage):
+    every = 3
+
+
+class FakeGenomicSuperDups(FakeRows, ann.GenomicSuperDupsStage):
+    every = 5
+
+    def lookup(self, chr, pos):
+        rows = FakeRows.lookup(self, chr, pos)
+        return rows[0] if len(rows) > 0 else None
+
+
+class FakeHugo(FakeRows, ann.HugoStage):
+    every = 4
+
+
+def makeStages():
+    return [
+        FakeCytoband(None),
+        FakeGadAll(None),
+        FakeGenomicSuperDups(None),
+        FakeHugo(None),
+    ]
+
+
+# INFO columns with and without a trailing ";"
+INFOS = [".", ".;", "DB;VC=SNV", "DB;"]
+
+
+def makeLines():
+    lines = ["##fileformat=VCFv4.1", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO"]
+    for pos in range(1, 121):
+        info = INFOS[pos % len(INFOS)]
+        lines.append(f"chr1\t{pos}\t.\tA\tC\t.\tPASS\t{info}")
+    return lines
+
+
+class WaveTest(unittest.TestCase):
+    def test_wave_matches_sequential(self):
+        lines = makeLines()
+        stages = makeStages()
+        expected = ann.annotateLines(stages, lines)
+        counters = [stage.counterValues() for stage in stages]
+
+        for threads in (1, 2, 4):
+            stages = makeStages()
+            executor = ThreadPoolExecutor(threads)
+            try:
+                out = ann.annotateLines(
+                    stages, lines, [[0, 1, 2, 3]], executor, threads
+                )
+            finally:
+                executor.shutdown()
+            self.assertEqual(out, expected)
+            self.assertEqual([stage.counterValues() for stage in stages], counters)
+
+    def test_merge_adds_separator(self):
+        record = ["1", "5", ".", "A", "C", ".", "PASS", ".;"]
+        annotated = record[:1] + [" " + f for f in record[1:7]] + [" .;gadAll=x"]
+        current = record[:7] + [".;cytoBand=p1"]
+        merged = ann.mergeAnnotation(record, annotated, current)
+        self.assertEqual(merged[1], " 5")
+        self.assertEqual(merged[7], " .;cytoBand=p1;gadAll=x")
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+### EOF
@@ -12,31 +12,51 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 
 import os
-import json
 import pymysql
-import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# The secret cache is shared with the utility scripts; the entry scripts put
+# the repository root, which holds common/, on the path
+from common.secret_cache import SecretCache
+
+"""MySQL error code for a rejected user name/password
 """
+ER_ACCESS_DENIED_ERROR = 1045
 
 
-def db_connect():
-    AWS_REGION_NAME = (
-        os.environ["AWS_REGION_NAME"]
-        if ("AWS_REGION_NAME" in os.environ)
-        else "us-east-1"
-    )
+_secrets = SecretCache(
+    os.environ["AWS_REGION_NAME"] if ("AWS_REGION_NAME" in os.environ) else "us-east-1"
+)
+
+"""Get RDS secret from AWS Secrets Manager (cached)
+"""
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+
+def get_rds_secret(force=False):
     try:
-        asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
-        rds_secret = json.loads(asm_response["SecretString"])
+        return _secrets.get("rds/anntools_database", force=force)
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
+
+"""Get connection to reference database
+
+If the cached credentials are rejected the secret is re-read from Secrets
+Manager and the connection retried once.
+"""
+
+
+def db_connect():
+    try:
+        return connect_with_secret(get_rds_secret())
+    except pymysql.err.OperationalError as e:
+        if e.args[0] != ER_ACCESS_DENIED_ERROR:
+            raise e
+        return connect_with_secret(get_rds_secret(force=True))
+
+
+def connect_with_secret(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret["host"]
     mysql_port = rds_secret["port"]
@@ -123,6 +143,16 @@ def dedup(mylist):
     return outlist
 
 
+"""Column value as text; binary columns come back from MySQL as bytes
+"""
+
+
+def text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
 """Helper method to parse fields
 """
 
@@ -0,0 +1,83 @@
+# secret_cache.py
+#
+# Cached Secrets Manager lookups, shared by the annotator (ann/) and the
+# utility scripts (util/)
+#
+##
+
+import json
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+"""Seconds a Secrets Manager secret is served from the cache
+"""
+SECRET_TTL = 900
+
+
+"""Process-wide cache of Secrets Manager secrets
+
+A secret is fetched on first use and then served from memory for ttl
+seconds. Once it is past refresh (a fraction of ttl) it is refreshed in a
+background thread while callers keep getting the cached value, so only an
+expired or forced lookup waits on Secrets Manager. Callers force a refresh
+when the cached credentials are rejected, e.g. after a rotation.
+"""
+
+
+class SecretCache(object):
+    def __init__(self, region_name, ttl=SECRET_TTL, refresh=0.75):
+        self.region_name = region_name
+        self.ttl = ttl
+        self.refresh = refresh
+        self.client = None
+        self.values = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def fetch(self, secret_id):
+        if self.client is None:
+            self.client = boto3.client("secretsmanager", region_name=self.region_name)
+        asm_response = self.client.get_secret_value(SecretId=secret_id)
+        value = json.loads(asm_response["SecretString"])
+        with self.lock:
+            self.values[secret_id] = (value, time.time())
+        return value
+
+    def refreshInBackground(self, secret_id):
+        try:
+            self.fetch(secret_id)
+        except ClientError as e:
+            # Keep serving the cached value until it expires
+            print(f"Background refresh of {secret_id} failed: {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(secret_id)
+
+    def get(self, secret_id, force=False):
+        with self.lock:
+            entry = self.values.get(secret_id)
+
+        if entry is None or force:
+            return self.fetch(secret_id)
+
+        value, fetched = entry
+        age = time.time() - fetched
+        if age >= self.ttl:
+            return self.fetch(secret_id)
+
+        if age >= self.ttl * self.refresh:
+            with self.lock:
+                start = secret_id not in self.refreshing
+                self.refreshing.add(secret_id)
+            if start:
+                threading.Thread(
+                    target=self.refreshInBackground, args=(secret_id,), daemon=True
+                ).start()
+
+        return value
+
+
+### EOF
@@ -15,9 +15,11 @@ import json
 from botocore.exceptions import ClientError
 from datetime import datetime
 
-# Import utility helpers
+# Import utility helpers, and the secret cache shared with the annotator
 sys.path.insert(1, os.path.realpath(os.path.pardir))
+sys.path.insert(1, os.path.realpath(os.path.join(os.path.pardir, os.path.pardir)))
 import helpers
+import secret_cache
 
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
@@ -67,7 +69,7 @@ def handle_archive_queue(sqs=None):
             res_file = job_data['s3_key_result_file']
             complete_time = int(job_data['complete_time'])
             if (time.time() - complete_time > int(config.get('gas','time'))):
-                profile = helpers.get_user_profile(id=user_id, db_name=config.get('aws', "AwsAccount"))
+                profile = secret_cache.get_user_profile(id=user_id, db_name=config.get('aws', "AwsAccount"))
                 print(profile[4])
                 if profile[4] == "free_user":
                                 
@@ -0,0 +1,73 @@
+# secret_cache.py
+#
+# Cached Secrets Manager lookups for the utility scripts
+#
+# helpers.get_user_profile reads rds/accounts_database from Secrets Manager
+# on every call, i.e. once per archive message. The functions here serve the
+# secret from a process-wide cache instead and re-read it only when it
+# expires or when the database rejects the cached credentials.
+#
+# helpers.py must not be modified, so the profile query is repeated here
+# rather than changed there. Every utility that reads profiles calls this
+# get_user_profile; at present that is only archive/archive_script.py, as
+# notify, thaw and restore do not look profiles up. Scripts importing this
+# module must also put the repository root on sys.path for common/.
+#
+##
+
+import psycopg2
+import psycopg2.extras
+
+import helpers
+
+# The secret cache is shared with the annotator, see common/
+from common.secret_cache import SecretCache
+
+_secrets = SecretCache(helpers.config["aws"]["AwsRegionName"])
+
+
+def _query_user_profile(rds_secret, id, db_name):
+    db_uri = (
+        "postgresql://"
+        + rds_secret["username"]
+        + ":"
+        + rds_secret["password"]
+        + "@"
+        + rds_secret["host"]
+        + ":"
+        + str(rds_secret["port"])
+        + "/"
+        + (db_name if db_name else helpers.config["gas"]["AccountsDatabase"])
+    )
+
+    # Connect to accounts database and get a cursor
+    connection = psycopg2.connect(db_uri)
+    try:
+        cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+        # Query the database and get the user's profile record
+        cursor.execute("SELECT * FROM profiles WHERE identity_id = %s", (id,))
+        return cursor.fetchall()[0]
+    finally:
+        connection.close()
+
+
+"""Access user profile in accounts database
+
+Same as helpers.get_user_profile, but with the accounts database secret
+cached. If the cached credentials are rejected (e.g. after a rotation) the
+secret is re-read and the query retried once.
+"""
+
+
+def get_user_profile(id=None, db_name=None):
+    try:
+        return _query_user_profile(_secrets.get("rds/accounts_database"), id, db_name)
+    except psycopg2.OperationalError as e:
+        if "authentication failed" not in str(e):
+            raise e
+        rds_secret = _secrets.get("rds/accounts_database", force=True)
+        return _query_user_profile(rds_secret, id, db_name)
+
+
+### EOF